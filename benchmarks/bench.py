@@ -0,0 +1,246 @@
+"""Offline benchmark for the HTP pipeline.
+
+Runs HTPModel.workflow, /v1/predict and the batch runner against a replaying
+fake chat model, so encoding, caching and scheduling overhead can be
+measured without API calls. Every scenario runs in a fresh process so peak
+RSS is per scenario.
+
+    python -m benchmarks.bench --drawings 40 --concurrency 8 --latency 0.05
+    python -m benchmarks.bench --save_baseline
+"""
+import argparse
+import asyncio
+import base64
+import glob
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_PATH = os.path.join(ROOT, "benchmarks", "baseline.json")
+SCENARIOS = ["workflow", "api", "batch"]
+# 与基线比较的指标，以及数值变大是否代表变好
+COMPARED = {
+    "throughput_per_min": True,
+    "p50": False,
+    "p95": False,
+    "p99": False,
+    "cpu_per_drawing": False,
+    "peak_rss_mb": False,
+}
+
+# 仓库中没有提示词时使用的占位提示词，长度接近真实提示词
+FILLER = "You are a professional House-Tree-Person drawing analyst. " * 40
+PLACEHOLDER_PROMPTS = {
+    **{f"{stage}_feature": FILLER for stage in ["overall", "house", "tree", "person"]},
+    **{f"{stage}_analysis": FILLER + "\n{FEATURES}" for stage in ["overall", "house", "tree", "person"]},
+    "analysis_merge": FILLER,
+    "merge_format": "{overall_analysis}\n{house_analysis}\n{tree_analysis}\n{person_analysis}",
+    "final_result": FILLER,
+    "signal_judge": FILLER,
+    "clf": FILLER,
+}
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description="HTP offline benchmark")
+    parser.add_argument("--scenarios", type=str, default=",".join(SCENARIOS), help="Comma separated scenarios: workflow, api, batch")
+    parser.add_argument("--drawings", type=int, default=40, help="Number of drawings per scenario")
+    parser.add_argument("--concurrency", type=int, default=8, help="Concurrent drawings")
+    parser.add_argument("--latency", type=float, default=0.05, help="Simulated seconds per LLM call")
+    parser.add_argument("--jitter", type=float, default=0.02, help="Uniform jitter added to the simulated latency")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the latency jitter")
+    parser.add_argument("--language", type=str, default="en", help="Language of the analysis")
+    parser.add_argument("--cache", action="store_true", help="Keep the result and LLM caches enabled")
+    parser.add_argument("--baseline", type=str, default=BASELINE_PATH, help="Baseline file to compare against")
+    parser.add_argument("--save_baseline", action="store_true", help="Write this run to --baseline")
+    parser.add_argument("--max_regression", type=float, default=None, help="Exit non-zero if a compared metric is worse by more than this fraction")
+    parser.add_argument("--scenario", type=str, default=None, help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, max(0, int(round(q / 100 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def load_images():
+    return [open(path, "rb").read() for path in sorted(glob.glob(os.path.join(ROOT, "example", "*.jpg")))]
+
+
+def ensure_prompts():
+    if os.getenv("HTP_PROMPT_DIR") or os.path.isdir(os.path.join(ROOT, "src", "prompt")):
+        return
+    root = tempfile.mkdtemp(prefix="htp-bench-prompt-")
+    for language in ["zh", "en"]:
+        os.makedirs(os.path.join(root, language))
+        for name, text in PLACEHOLDER_PROMPTS.items():
+            with open(os.path.join(root, language, f"{name}.txt"), "w", encoding="utf-8") as f:
+                f.write(text)
+    os.environ["HTP_PROMPT_DIR"] = root
+
+
+def build_model(config):
+    ensure_prompts()
+    from benchmarks.replay_model import ReplayChatModel, load_stage_texts
+    from src.model_langchain import HTPModel
+    from src.result_cache import ResultCache
+
+    texts = load_stage_texts()
+    text_model = ReplayChatModel(model_name="replay-text", stage_texts=texts, latency=config.latency, jitter=config.jitter, seed=config.seed)
+    multimodal_model = ReplayChatModel(model_name="replay-vision", stage_texts=texts, latency=config.latency, jitter=config.jitter, seed=config.seed + 1)
+    model = HTPModel(
+        text_model=text_model,
+        multimodal_model=multimodal_model,
+        language=config.language,
+        use_cache=config.cache,
+        result_cache=ResultCache() if config.cache else None,
+        llm_cache_path=os.path.join(tempfile.mkdtemp(prefix="htp-bench-cache-"), "llm_cache.db") if config.cache else None,
+    )
+    model.preload_prompts()
+    return model
+
+
+def run_workflow(model, images, config):
+    def one(index):
+        start = time.perf_counter()
+        model.workflow(images[index % len(images)], language=config.language)
+        return time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=config.concurrency) as executor:
+        return list(executor.map(one, range(config.drawings)))
+
+
+def run_api(model, images, config):
+    import httpx
+    from src.app.api import create_app
+
+    app = create_app(model, max_concurrency=config.concurrency, max_queue=config.drawings, job_dir=tempfile.mkdtemp(prefix="htp-bench-jobs-"))
+    payloads = [base64.b64encode(image).decode() for image in images]
+
+    async def main():
+        semaphore = asyncio.Semaphore(config.concurrency)
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+            async def one(index):
+                async with semaphore:
+                    start = time.perf_counter()
+                    response = await client.post("/v1/predict", json={
+                        "image_path": payloads[index % len(payloads)], "language": config.language
+                    })
+                    response.raise_for_status()
+                    return time.perf_counter() - start
+            return await asyncio.gather(*[one(i) for i in range(config.drawings)])
+
+    return asyncio.run(main())
+
+
+def run_batch(model, images, config):
+    from src.batch_runner import BatchRunner
+
+    runner = BatchRunner(model, language=config.language, concurrency=config.concurrency, retries=0)
+    items = ((f"drawing-{i}", images[i % len(images)]) for i in range(config.drawings))
+    latencies = []
+    for outcome in runner.run(items):
+        assert outcome.success, outcome.error
+        latencies.append(outcome.duration)
+    return latencies
+
+
+def run_scenario(name, config) -> dict:
+    logging.disable(logging.INFO)
+    model = build_model(config)
+    images = load_images()
+    runner = {"workflow": run_workflow, "api": run_api, "batch": run_batch}[name]
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    latencies = runner(model, images, config)
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+    return {
+        "drawings": len(latencies),
+        "wall_seconds": round(wall, 3),
+        "throughput_per_min": round(len(latencies) / wall * 60, 2),
+        "p50": round(percentile(latencies, 50), 4),
+        "p95": round(percentile(latencies, 95), 4),
+        "p99": round(percentile(latencies, 99), 4),
+        "cpu_per_drawing": round(cpu / len(latencies), 5),
+        # Linux 上 ru_maxrss 的单位是 KB
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def run_isolated(name, config) -> dict:
+    args = [
+        sys.executable, "-m", "benchmarks.bench", "--scenario", name,
+        "--drawings", str(config.drawings), "--concurrency", str(config.concurrency),
+        "--latency", str(config.latency), "--jitter", str(config.jitter), "--seed", str(config.seed),
+        "--language", config.language,
+    ] + (["--cache"] if config.cache else [])
+    output = subprocess.run(args, cwd=ROOT, check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def compare(results, baseline, max_regression):
+    regressions = []
+    print(f"{'scenario':<10}{'metric':<20}{'baseline':>12}{'current':>12}{'change':>10}")
+    for name, current in results.items():
+        previous = baseline.get("results", {}).get(name)
+        if previous is None:
+            continue
+        for metric, higher_is_better in COMPARED.items():
+            old, new = previous.get(metric), current.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            print(f"{name:<10}{metric:<20}{old:>12}{new:>12}{change:>+10.1%}")
+            worse = -change if higher_is_better else change
+            if max_regression is not None and worse > max_regression:
+                regressions.append(f"{name}.{metric} {change:+.1%}")
+    return regressions
+
+
+def main():
+    config = get_args()
+    if config.scenario:
+        # 子进程：只运行一个场景，最后一行输出 JSON
+        print(json.dumps(run_scenario(config.scenario, config)))
+        return
+
+    settings = {key: getattr(config, key) for key in ["drawings", "concurrency", "latency", "jitter", "seed", "language", "cache"]}
+    results = {}
+    for name in [s.strip() for s in config.scenarios.split(",") if s.strip()]:
+        assert name in SCENARIOS, f"Scenario should be one of {SCENARIOS}."
+        results[name] = run_isolated(name, config)
+        print(f"{name}: {json.dumps(results[name])}")
+
+    regressions = []
+    if os.path.exists(config.baseline) and not config.save_baseline:
+        with open(config.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("settings") != settings:
+            print(f"Baseline settings differ: {baseline.get('settings')}")
+        regressions = compare(results, baseline, config.max_regression)
+
+    if config.save_baseline:
+        with open(config.baseline, "w", encoding="utf-8") as f:
+            json.dump({"settings": settings, "results": results}, f, indent=4)
+            f.write("\n")
+        print(f"Baseline saved to {config.baseline}")
+
+    if regressions:
+        print("Regressions: " + ", ".join(regressions))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
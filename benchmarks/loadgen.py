@@ -0,0 +1,128 @@
+"""Open-loop load generator for `/v1/predict`.
+
+Sends requests at each target rate for `--duration` seconds, whether or not
+earlier requests have finished, and reports for every step the achieved
+throughput, latency percentiles and the count of each response status, so
+the point where the service starts queueing or shedding load is visible.
+
+    python -m benchmarks.mock_openai --latency 1.5 &
+    OPENAI_BASE_URL=http://127.0.0.1:8900/v1 OPENAI_API_KEY=mock python deploy.py --workers 2 &
+    python -m benchmarks.loadgen --url http://127.0.0.1:9557 --rps 0.5,1,2,4 --duration 30
+"""
+import argparse
+import asyncio
+import base64
+import glob
+import json
+import os
+import random
+import time
+from collections import Counter
+
+import httpx
+
+from benchmarks.bench import percentile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description="HTP load generator")
+    parser.add_argument("--url", type=str, default="http://127.0.0.1:9557", help="Base URL of the HTP service")
+    parser.add_argument("--rps", type=str, default="0.5,1,2", help="Comma separated request rates to step through")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds to hold each rate")
+    parser.add_argument("--arrival", type=str, default="poisson", choices=["poisson", "constant"], help="Inter-arrival distribution")
+    parser.add_argument("--language", type=str, default="zh", help="Language of the analysis")
+    parser.add_argument("--images", type=str, default=os.path.join(ROOT, "example", "*.jpg"), help="Glob of drawings to send")
+    parser.add_argument("--timeout", type=float, default=300, help="Per request timeout in seconds")
+    parser.add_argument("--output", type=str, default=None, help="Write the per-step report to this JSON file")
+    parser.add_argument("--seed", type=int, default=None, help="Seed of the arrival process")
+    return parser.parse_args()
+
+
+def load_payloads(pattern: str):
+    paths = sorted(glob.glob(pattern))
+    assert paths, f"No images match {pattern}."
+    payloads = []
+    for path in paths:
+        with open(path, "rb") as f:
+            payloads.append(base64.b64encode(f.read()).decode())
+    return payloads
+
+
+async def run_step(client: httpx.AsyncClient, rps: float, config, payloads, rng: random.Random) -> dict:
+    latencies = []
+    statuses = Counter()
+
+    async def one(index: int):
+        start = time.perf_counter()
+        try:
+            response = await client.post("/v1/predict", json={
+                "image_path": payloads[index % len(payloads)], "language": config.language
+            })
+            status = str(response.status_code)
+        except httpx.TimeoutException:
+            status = "timeout"
+        except httpx.HTTPError as e:
+            status = type(e).__name__
+        elapsed = time.perf_counter() - start
+        statuses[status] += 1
+        if status == "200":
+            latencies.append(elapsed)
+
+    tasks = []
+    start = time.perf_counter()
+    next_at = start
+    index = 0
+    # 开环发送：按到达时间发出请求，不等待之前的请求完成
+    while next_at - start < config.duration:
+        delay = next_at - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.ensure_future(one(index)))
+        index += 1
+        next_at += rng.expovariate(rps) if config.arrival == "poisson" else 1 / rps
+    await asyncio.gather(*tasks)
+    wall = time.perf_counter() - start
+
+    return {
+        "target_rps": rps,
+        "sent": len(tasks),
+        "offered_rps": round(len(tasks) / config.duration, 3),
+        "throughput_rps": round(len(latencies) / wall, 3),
+        "success_rate": round(len(latencies) / len(tasks), 4) if tasks else 0.0,
+        "p50": round(percentile(latencies, 50), 3),
+        "p95": round(percentile(latencies, 95), 3),
+        "p99": round(percentile(latencies, 99), 3),
+        "statuses": dict(statuses),
+    }
+
+
+async def run(config) -> list:
+    payloads = load_payloads(config.images)
+    rng = random.Random(config.seed)
+    rates = [float(r) for r in config.rps.split(",") if r.strip()]
+    assert rates and all(r > 0 for r in rates), "--rps should be positive numbers."
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=64)
+    report = []
+    print(f"{'rps':>6}{'sent':>7}{'ok/s':>8}{'ok%':>8}{'p50':>9}{'p95':>9}{'p99':>9}  statuses")
+    async with httpx.AsyncClient(base_url=config.url, timeout=config.timeout, limits=limits) as client:
+        for rps in rates:
+            step = await run_step(client, rps, config, payloads, rng)
+            report.append(step)
+            print(f"{rps:>6g}{step['sent']:>7}{step['throughput_rps']:>8}{step['success_rate']:>8.1%}"
+                  f"{step['p50']:>9}{step['p95']:>9}{step['p99']:>9}  {json.dumps(step['statuses'])}")
+    return report
+
+
+def main():
+    config = get_args()
+    report = asyncio.run(run(config))
+    if config.output:
+        with open(config.output, "w", encoding="utf-8") as f:
+            json.dump({"url": config.url, "duration": config.duration, "arrival": config.arrival, "steps": report}, f, indent=4)
+            f.write("\n")
+
+
+if __name__ == "__main__":
+    main()
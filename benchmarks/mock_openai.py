@@ -0,0 +1,260 @@
+"""Local mock of the OpenAI chat-completions endpoint.
+
+Answers `POST /v1/chat/completions` with text replayed from
+example/*_result*.json, after a delay drawn from a configurable latency
+distribution. 429 and 5xx responses can be injected at fixed rates, and an
+optional requests/tokens per minute budget is enforced and reported through
+the same `x-ratelimit-*` and `retry-after` headers as the real API, so the
+scheduler's backoff can be exercised locally.
+
+    python -m benchmarks.mock_openai --port 8900 --latency 1.5 --latency_dist lognormal --error_429 0.02
+    OPENAI_BASE_URL=http://127.0.0.1:8900/v1 OPENAI_API_KEY=mock python deploy.py
+"""
+import argparse
+import asyncio
+import json
+import math
+import random
+import threading
+import time
+import uuid
+from collections import deque
+from typing import Optional
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+from benchmarks.replay_model import IMAGE_TOKENS, load_stage_texts
+
+LATENCY_DISTS = ["constant", "uniform", "normal", "lognormal", "exponential"]
+SERVER_ERRORS = [500, 502, 503]
+# 流式响应每个分块包含的字符数
+CHUNK_CHARS = 16
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Mock OpenAI-compatible chat completions server")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Host to bind")
+    parser.add_argument("--port", type=int, default=8900, help="Port number")
+    parser.add_argument("--latency", type=float, default=1.0, help="Mean seconds before the first token")
+    parser.add_argument("--latency_dist", type=str, default="lognormal", choices=LATENCY_DISTS, help="Latency distribution")
+    parser.add_argument("--latency_spread", type=float, default=0.5, help="Spread of the distribution: half width for uniform, stddev for normal, sigma for lognormal")
+    parser.add_argument("--token_latency", type=float, default=0.0, help="Extra seconds per completion token")
+    parser.add_argument("--error_429", type=float, default=0.0, help="Fraction of requests answered with 429")
+    parser.add_argument("--error_5xx", type=float, default=0.0, help="Fraction of requests answered with 500/502/503")
+    parser.add_argument("--rpm", type=int, default=None, help="Requests per minute before returning 429")
+    parser.add_argument("--tpm", type=int, default=None, help="Tokens per minute before returning 429")
+    parser.add_argument("--retry_after", type=float, default=1.0, help="retry-after seconds of injected 429s")
+    parser.add_argument("--seed", type=int, default=None, help="Seed of latency and error sampling")
+    return parser.parse_args()
+
+
+class LatencyModel(object):
+    """Samples response delays with mean `mean` from the named distribution."""
+    def __init__(self, mean: float, dist: str = "lognormal", spread: float = 0.5, token_latency: float = 0.0,
+                 rng: Optional[random.Random] = None):
+        assert dist in LATENCY_DISTS, f"Latency distribution should be one of {LATENCY_DISTS}."
+        self.mean = mean
+        self.dist = dist
+        self.spread = spread
+        self.token_latency = token_latency
+        self.rng = rng or random.Random()
+
+    def sample(self, completion_tokens: int = 0) -> float:
+        if self.dist == "constant":
+            delay = self.mean
+        elif self.dist == "uniform":
+            delay = self.rng.uniform(self.mean - self.spread, self.mean + self.spread)
+        elif self.dist == "normal":
+            delay = self.rng.gauss(self.mean, self.spread)
+        elif self.dist == "lognormal":
+            # 取 mu 使分布均值等于 mean，sigma 越大长尾越明显
+            mu = math.log(self.mean) - self.spread ** 2 / 2 if self.mean > 0 else 0.0
+            delay = self.rng.lognormvariate(mu, self.spread) if self.mean > 0 else 0.0
+        else:
+            delay = self.rng.expovariate(1 / self.mean) if self.mean > 0 else 0.0
+        return max(0.0, delay) + completion_tokens * self.token_latency
+
+
+class RateLimiter(object):
+    """Sliding one-minute request and token budget, reported like the OpenAI headers."""
+    def __init__(self, rpm: Optional[int] = None, tpm: Optional[int] = None):
+        self.rpm = rpm
+        self.tpm = tpm
+        self._lock = threading.Lock()
+        # (时间, token 数)
+        self._window: deque = deque()
+
+    def _trim(self, now: float):
+        while self._window and now - self._window[0][0] >= 60:
+            self._window.popleft()
+
+    def acquire(self, tokens: int):
+        """Return (allowed, headers, retry_after)."""
+        with self._lock:
+            now = time.monotonic()
+            self._trim(now)
+            used_requests = len(self._window)
+            used_tokens = sum(t for _, t in self._window)
+            allowed = (self.rpm is None or used_requests < self.rpm) and (self.tpm is None or used_tokens + tokens <= self.tpm)
+            if allowed:
+                self._window.append((now, tokens))
+                used_requests += 1
+                used_tokens += tokens
+            reset = 60 - (now - self._window[0][0]) if self._window else 0.0
+            headers = {}
+            if self.rpm is not None:
+                headers["x-ratelimit-limit-requests"] = str(self.rpm)
+                headers["x-ratelimit-remaining-requests"] = str(max(0, self.rpm - used_requests))
+                headers["x-ratelimit-reset-requests"] = f"{reset:.3f}s"
+            if self.tpm is not None:
+                headers["x-ratelimit-limit-tokens"] = str(self.tpm)
+                headers["x-ratelimit-remaining-tokens"] = str(max(0, self.tpm - used_tokens))
+                headers["x-ratelimit-reset-tokens"] = f"{reset:.3f}s"
+            return allowed, headers, (None if allowed else max(reset, 0.001))
+
+
+def count_prompt_tokens(messages) -> int:
+    chars = 0
+    images = 0
+    for message in messages:
+        content = message.get("content") or ""
+        if isinstance(content, str):
+            chars += len(content)
+            continue
+        for part in content:
+            if part.get("type") == "image_url":
+                images += 1
+            else:
+                chars += len(part.get("text", ""))
+    return chars // 4 + images * IMAGE_TOKENS
+
+
+def is_classification(messages) -> bool:
+    # 分类阶段的用户消息带有 JsonOutputParser 的格式说明
+    last = messages[-1].get("content") if messages else ""
+    return isinstance(last, str) and "JSON schema" in last and '"result"' in last
+
+
+def error_body(message: str, kind: str, code: Optional[str] = None) -> dict:
+    return {"error": {"message": message, "type": kind, "param": None, "code": code}}
+
+
+def create_mock_app(latency: LatencyModel, error_429: float = 0.0, error_5xx: float = 0.0,
+                    limiter: Optional[RateLimiter] = None, retry_after: float = 1.0,
+                    rng: Optional[random.Random] = None) -> FastAPI:
+    app = FastAPI(title="Mock OpenAI")
+    rng = rng or random.Random()
+    texts = [text for stages in load_stage_texts() for text in stages.values() if text]
+    limiter = limiter or RateLimiter()
+    state = {"index": 0, "requests": 0, "errors": {}}
+    lock = threading.Lock()
+
+    def next_text() -> str:
+        with lock:
+            state["index"] += 1
+            return texts[state["index"] % len(texts)]
+
+    def count(code: int):
+        with lock:
+            state["requests"] += 1
+            if code != 200:
+                state["errors"][str(code)] = state["errors"].get(str(code), 0) + 1
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        messages = body.get("messages", [])
+        model = body.get("model", "mock")
+        prompt_tokens = count_prompt_tokens(messages)
+
+        roll = rng.random()
+        # 注入的 429 不占用限额
+        if roll < error_429:
+            count(429)
+            return JSONResponse(error_body("Rate limit reached.", "requests", "rate_limit_exceeded"), status_code=429,
+                                headers={"retry-after": f"{retry_after:.3f}"})
+        allowed, headers, wait = limiter.acquire(prompt_tokens)
+        if not allowed:
+            count(429)
+            headers["retry-after"] = f"{wait:.3f}"
+            return JSONResponse(error_body("Rate limit reached.", "requests", "rate_limit_exceeded"), status_code=429, headers=headers)
+        if roll < error_429 + error_5xx:
+            code = rng.choice(SERVER_ERRORS)
+            count(code)
+            await asyncio.sleep(latency.sample())
+            return JSONResponse(error_body("The server had an error while processing your request.", "server_error"), status_code=code, headers=headers)
+
+        text = '{"result": true}' if is_classification(messages) else next_text()
+        completion_tokens = len(text) // 4
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:24]}"
+        created = int(time.time())
+        count(200)
+
+        if not body.get("stream"):
+            await asyncio.sleep(latency.sample(completion_tokens))
+            return JSONResponse({
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+                "usage": usage,
+            }, headers=headers)
+
+        include_usage = (body.get("stream_options") or {}).get("include_usage", False)
+        chunks = [text[i:i + CHUNK_CHARS] for i in range(0, len(text), CHUNK_CHARS)]
+
+        def event(delta: dict, finish_reason: Optional[str] = None, chunk_usage: Optional[dict] = None) -> str:
+            choices = [] if delta is None else [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+            payload = {"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model, "choices": choices}
+            if chunk_usage is not None:
+                payload["usage"] = chunk_usage
+            return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+        async def stream():
+            # 首个 token 前等待采样的延迟，之后按每 token 延迟逐块输出
+            await asyncio.sleep(latency.sample())
+            yield event({"role": "assistant", "content": ""})
+            for chunk in chunks:
+                if latency.token_latency:
+                    await asyncio.sleep(latency.token_latency * max(1, len(chunk) // 4))
+                yield event({"content": chunk})
+            yield event({}, "stop")
+            if include_usage:
+                yield event(None, chunk_usage=usage)
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(stream(), media_type="text/event-stream", headers=headers)
+
+    @app.get("/v1/models")
+    async def models():
+        return {"object": "list", "data": [{"id": "mock", "object": "model", "owned_by": "mock"}]}
+
+    @app.get("/stats")
+    async def stats():
+        with lock:
+            return {"requests": state["requests"], "errors": dict(state["errors"])}
+
+    return app
+
+
+def main():
+    config = get_args()
+    rng = random.Random(config.seed)
+    latency = LatencyModel(config.latency, config.latency_dist, config.latency_spread, config.token_latency, rng)
+    app = create_mock_app(
+        latency,
+        error_429=config.error_429,
+        error_5xx=config.error_5xx,
+        limiter=RateLimiter(config.rpm, config.tpm),
+        retry_after=config.retry_after,
+        rng=rng,
+    )
+    uvicorn.run(app, host=config.host, port=config.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+import asyncio
+import glob
+import json
+import os
+import random
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from pydantic import PrivateAttr
+
+from src.metrics import current_stage
+
+EXAMPLE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "example")
+BASIC_STAGES = ["overall", "house", "tree", "person"]
+# 每张图片按多模态输入计入的 token 数
+IMAGE_TOKENS = 765
+
+
+def load_stage_texts(pattern: str = os.path.join(EXAMPLE_DIR, "*_result*.json")) -> List[Dict[str, str]]:
+    """Read example results into {stage: text}, accepting the nested and the older flat layout."""
+    texts = []
+    for path in sorted(glob.glob(pattern)):
+        with open(path, "r", encoding="utf-8") as f:
+            result = json.load(f)
+        stages = {}
+        for stage in BASIC_STAGES:
+            if isinstance(result.get(stage), dict):
+                stages[f"{stage}_feature"] = result[stage]["feature"]
+                stages[f"{stage}_analysis"] = result[stage]["analysis"]
+            else:
+                # 早期的示例结果使用 human_* 表示 person 阶段
+                flat = "human" if stage == "person" and "human_feature" in result else stage
+                stages[f"{stage}_feature"] = result[f"{flat}_feature"]
+                stages[f"{stage}_analysis"] = result[f"{flat}_analysis"]
+        stages["merge"] = result["merge"]
+        stages["final"] = result["final"]
+        # example2_result.json 中的键拼写为 singal
+        stages["signal"] = result["signal"] if "signal" in result else result["singal"]
+        texts.append(stages)
+    assert texts, f"No example results match {pattern}."
+    return texts
+
+
+def count_tokens(messages: List[BaseMessage]) -> int:
+    chars = 0
+    images = 0
+    for message in messages:
+        if isinstance(message.content, str):
+            chars += len(message.content)
+            continue
+        for part in message.content:
+            if isinstance(part, dict) and part.get("type") == "image_url":
+                images += 1
+            else:
+                chars += len(part.get("text", "") if isinstance(part, dict) else str(part))
+    return chars // 4 + images * IMAGE_TOKENS
+
+
+class ReplayChatModel(BaseChatModel):
+    """Deterministic chat model that replays recorded stage outputs.
+
+    The stage comes from the `current_stage` contextvar set by
+    HTPModel.invoke_chain; calls of one stage cycle through `stage_texts`.
+    Each call sleeps `latency` seconds plus uniform jitter drawn from an RNG
+    seeded with `seed`, so runs with the same settings are repeatable.
+    """
+    model_name: str = "replay"
+    stage_texts: List[Dict[str, str]]
+    latency: float = 0.0
+    jitter: float = 0.0
+    seed: int = 0
+    _lock: Any = PrivateAttr(default_factory=threading.Lock)
+    _rng: Any = PrivateAttr(default=None)
+    _counters: Dict[str, int] = PrivateAttr(default_factory=dict)
+
+    @property
+    def _llm_type(self) -> str:
+        return "replay"
+
+    @property
+    def _identifying_params(self) -> Dict[str, Any]:
+        return {"model_name": self.model_name}
+
+    def _next(self):
+        stage = current_stage.get()
+        with self._lock:
+            if self._rng is None:
+                self._rng = random.Random(self.seed)
+            index = self._counters.get(stage, 0)
+            self._counters[stage] = index + 1
+            delay = max(0.0, self.latency + self._rng.uniform(-self.jitter, self.jitter))
+        if stage == "classification":
+            text = '{"result": true}'
+        else:
+            text = self.stage_texts[index % len(self.stage_texts)].get(stage, "")
+        return text, delay
+
+    def _result(self, messages: List[BaseMessage], text: str) -> ChatResult:
+        prompt_tokens = count_tokens(messages)
+        completion_tokens = len(text) // 4
+        message = AIMessage(
+            content=text,
+            usage_metadata={
+                "input_tokens": prompt_tokens,
+                "output_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+            response_metadata={"headers": {}},
+        )
+        return ChatResult(
+            generations=[ChatGeneration(message=message)],
+            llm_output={
+                "token_usage": {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                    "total_tokens": prompt_tokens + completion_tokens,
+                },
+                "model_name": self.model_name,
+            },
+        )
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None, **kwargs) -> ChatResult:
+        text, delay = self._next()
+        time.sleep(delay)
+        return self._result(messages, text)
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None, **kwargs) -> ChatResult:
+        text, delay = self._next()
+        await asyncio.sleep(delay)
+        return self._result(messages, text)
@@ -1,47 +1,105 @@
+import json
 import os
+from typing import Optional
 
 import uvicorn
-from langchain_openai import ChatOpenAI
 
 from src.app.api import create_app
+from src.app.jobs import JobStore
+from src.checkpoint_store import get_checkpoint_store
+from src.endpoint_pool import build_chat_model, parse_endpoints, prewarm_endpoints
+from src.hedging import Hedger
+from src.llm_scheduler import default_budget, get_scheduler
 from src.model_langchain import HTPModel
 import argparse
 
 def get_parse():
     parser = argparse.ArgumentParser(description="HTP Model")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Host to bind")
     parser.add_argument("--port", type=int, default=9557, help="Port number")
-    
+    parser.add_argument("--workers", type=int, default=1, help="Number of server processes sharing the port")
+    parser.add_argument("--max_concurrency", type=int, default=4, help="Maximum number of workflows running at once in each worker")
+    parser.add_argument("--max_queue", type=int, default=16, help="Maximum number of requests waiting for a slot before returning 429")
+    parser.add_argument("--job_dir", type=str, default=None, help="Directory of the persistent batch job queue")
+    parser.add_argument("--job_workers", type=int, default=2, help="Number of concurrent batch job workers in each worker")
+    parser.add_argument("--hedge_percentile", type=float, default=None, help="Send a duplicate LLM call when a stage runs longer than this latency percentile")
+    parser.add_argument("--hedge_budget", type=float, default=0.05, help="Maximum fraction of extra LLM calls spent on hedges")
+
     return parser.parse_args()
 
 
 TEXT_MODEL = "claude-3-5-sonnet-20240620"
 MULTIMODAL_MODEL = "gpt-4o-2024-08-06"
 
-text_model = ChatOpenAI(
-    api_key=os.getenv("OPENAI_API_KEY"),
-    base_url=os.getenv("OPENAI_BASE_URL"),
-    model = TEXT_MODEL,
-    temperature=0.2,
-    top_p = 0.75,
-    seed=42,
-)
-multimodal_model = ChatOpenAI(
-    api_key=os.getenv("OPENAI_API_KEY"),
-    base_url=os.getenv("OPENAI_BASE_URL"),
-    model = MULTIMODAL_MODEL,
-    temperature=0.2,
-    top_p = 0.75,
-    seed=42,
-)
-
-model = HTPModel(
-    text_model=text_model,
-    multimodal_model=multimodal_model,
-    language="zh",
-    use_cache=True
-)
-
-config = get_parse()
-
-app = create_app(model)
-uvicorn.run(app, host="127.0.0.1", port=config.port, log_level="info")
\ No newline at end of file
+# 多进程模式下子进程重新导入本模块，配置通过环境变量传递
+CONFIG_ENV = "HTP_DEPLOY_CONFIG"
+
+
+def build_model(workers: int = 1, hedge_percentile: Optional[float] = None, hedge_budget: float = 0.05) -> HTPModel:
+    # OPENAI_BASE_URL / OPENAI_API_KEY 中可以用逗号分隔多个端点或 key
+    endpoints = parse_endpoints(os.getenv("OPENAI_BASE_URL"), os.getenv("OPENAI_API_KEY"))
+    text_model = build_chat_model(
+        TEXT_MODEL,
+        endpoints,
+        temperature=0.2,
+        top_p = 0.75,
+        include_response_headers=True,
+        seed=42,
+    )
+    multimodal_model = build_chat_model(
+        MULTIMODAL_MODEL,
+        endpoints,
+        temperature=0.2,
+        top_p = 0.75,
+        include_response_headers=True,
+        seed=42,
+    )
+    model = HTPModel(
+        text_model=text_model,
+        multimodal_model=multimodal_model,
+        language="zh",
+        use_cache=True,
+        # 逐阶段结果存放在 WAL 模式的 SQLite 中，多个进程之间可以共享
+        checkpoints=get_checkpoint_store() if workers > 1 else None,
+        hedger=Hedger(percentile=hedge_percentile, max_ratio=hedge_budget) if hedge_percentile else None
+    )
+    model.preload_prompts()
+    # 启动时先建立连接，首个请求不再承担 TCP/TLS 握手
+    prewarm_endpoints(endpoints, connections=4)
+    if workers > 1:
+        # 每个进程只分到总预算的一部分，合计不超过服务商的限额
+        budget = default_budget()
+        for model_name in {TEXT_MODEL, MULTIMODAL_MODEL}:
+            get_scheduler().configure(
+                model_name,
+                max_concurrency=max(1, budget.max_concurrency // workers),
+                rpm=max(1, budget.rpm // workers) if budget.rpm else None,
+                tpm=max(1, budget.tpm // workers) if budget.tpm else None,
+            )
+    return model
+
+
+def build_app():
+    """App factory, called once in every server process."""
+    config = json.loads(os.environ[CONFIG_ENV])
+    workers = config["workers"]
+    return create_app(
+        build_model(workers, config.get("hedge_percentile"), config.get("hedge_budget", 0.05)),
+        max_concurrency=config["max_concurrency"],
+        max_queue=config["max_queue"],
+        job_dir=config["job_dir"],
+        job_workers=config["job_workers"],
+        # 多进程时由父进程统一恢复中断的任务
+        recover_jobs=workers == 1
+    )
+
+
+if __name__ == "__main__":
+    config = get_parse()
+    os.environ[CONFIG_ENV] = json.dumps(vars(config))
+    if config.workers > 1:
+        # 父进程先恢复上次中断的任务，再由 uvicorn 启动共享同一端口的子进程
+        JobStore(config.job_dir)
+        uvicorn.run("deploy:build_app", factory=True, host=config.host, port=config.port, workers=config.workers, log_level="info")
+    else:
+        uvicorn.run(build_app(), host=config.host, port=config.port, log_level="info")
@@ -2,11 +2,12 @@ import tkinter as tk
 from tkinter import ttk, filedialog, messagebox, scrolledtext
 import os
 from PIL import Image, ImageTk
-from langchain_openai import ChatOpenAI
 from datetime import datetime
 import webbrowser
 import traceback
 
+from src.endpoint_pool import build_chat_model, parse_endpoints
+from src.image_utils import ImageInput
 from src.model_langchain import HTPModel
 
 class HTPAnalyzer:
@@ -231,6 +232,18 @@ For more information, visit our website / 更多信息，请访问我们的网
         self.status_bar.config(text=message)
         self.root.update()
 
+    def stream_token(self, stage, token):
+        """把流式生成的 token 追加到预览区"""
+        self.preview_text.config(state='normal')
+        if stage != self.streaming_stage:
+            # 新阶段开始时清空预览，只显示当前正在生成的内容
+            self.streaming_stage = stage
+            self.preview_text.delete('1.0', tk.END)
+        self.preview_text.insert(tk.END, token)
+        self.preview_text.see(tk.END)
+        self.preview_text.config(state='disabled')
+        self.root.update()
+
     def analyze_image(self):
         """分析图片并更新预览"""
         if not self.image_path:
@@ -244,25 +257,25 @@ For more information, visit our website / 更多信息，请访问我们的网
         try:
             self.update_status("Analyzing... / 分析中...")
             # 创建模型实例
-            text_model = ChatOpenAI(
-                api_key=self.api_key.get(),
-                base_url=self.base_url.get(),
-                # model="claude-3-5-sonnet-20241022",
-                model="gpt-4o-2024-08-06",
+            # 多个 Base URL 或 API Key 用逗号分隔，调用在各端点之间均衡
+            endpoints = parse_endpoints(self.base_url.get(), self.api_key.get())
+            text_model = build_chat_model(
+                # "claude-3-5-sonnet-20241022",
+                "gpt-4o-2024-08-06",
+                endpoints,
                 temperature=0.2,
                 top_p=0.75,
+                include_response_headers=True,
                 seed=42,
-                max_retries=5,
             )
             
-            multimodal_model = ChatOpenAI(
-                api_key=self.api_key.get(),
-                base_url=self.base_url.get(),
-                model="gpt-4o-2024-08-06",
+            multimodal_model = build_chat_model(
+                "gpt-4o-2024-08-06",
+                endpoints,
                 temperature=0.2,
                 top_p=0.75,
+                include_response_headers=True,
                 seed=42,
-                max_retries=5,
             )
             
             model = HTPModel(
@@ -272,10 +285,12 @@ For more information, visit our website / 更多信息，请访问我们的网
                 use_cache=True
             )
             
-            # 分析图片
+            # 分析图片，final/signal 阶段的 token 实时写入预览区
+            self.streaming_stage = None
             result = model.workflow(
-                image_path=self.image_path,
-                language=self.language.get()  # 使用选择的语言
+                image_path=ImageInput.resolve(self.image_path),
+                language=self.language.get(),  # 使用选择的语言
+                on_token=self.stream_token
             )
             
             # 生成报告文件名
@@ -1,20 +1,35 @@
 import argparse
+import glob
 import json
+import logging
 import os
+import sys
 from dotenv import load_dotenv
 
-from langchain_openai import ChatOpenAI
-
+from src.batch_runner import BatchRunner
+from src.checkpoint_store import get_checkpoint_store
+from src.endpoint_pool import build_chat_model, parse_endpoints, prewarm_endpoints
+from src.image_utils import ImageInput
+from src.llm_scheduler import Priority
 from src.model_langchain import HTPModel
 
 TEXT_MODEL = "claude-3-5-sonnet-20240620"
 MULTIMODAL_MODEL = "gpt-4o-2024-08-06"
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg")
+
+logger = logging.getLogger(__name__)
 
 def get_args():
     parser = argparse.ArgumentParser(description="HTP Model")
     parser.add_argument("--image_file", type=str, help="Path to the image")
+    parser.add_argument("--input_dir", "--input-dir", type=str, help="Directory of images to analyze, results are written to --save_path as JSON Lines")
+    parser.add_argument("--glob", type=str, default="*", help="Pattern of image files inside --input_dir, e.g. '**/*.png'")
+    parser.add_argument("--concurrency", type=int, default=8, help="Number of images analyzed at the same time in directory mode")
+    parser.add_argument("--retries", type=int, default=2, help="Retries per image in directory mode")
+    parser.add_argument("--skip_existing", "--skip-existing", action="store_true", help="Skip images that already succeeded in --save_path")
     parser.add_argument("--save_path", type=str, help="Path to save the result")
     parser.add_argument("--language", type=str, default="zh", help="Language of the analysis report")
+    parser.add_argument("--checkpoint_path", type=str, default=None, help="SQLite file for per-stage checkpoints, defaults to HTP_CHECKPOINT_PATH or ~/.cache/psydraw/checkpoints.db")
     
     return parser.parse_args()
 
@@ -22,33 +37,99 @@ load_dotenv()
 config = get_args()
 
 assert config.language in ["zh", "en"], "Language should be either 'zh' or 'en'."
+assert bool(config.image_file) != bool(config.input_dir), "Specify either --image_file or --input_dir."
+assert config.save_path, "--save_path is required."
 
-text_model = ChatOpenAI(
-    api_key=os.getenv("OPENAI_API_KEY"),
-    base_url=os.getenv("OPENAI_BASE_URL"),
-    model = TEXT_MODEL,
+# OPENAI_BASE_URL / OPENAI_API_KEY 中可以用逗号分隔多个端点或 key
+endpoints = parse_endpoints(os.getenv("OPENAI_BASE_URL"), os.getenv("OPENAI_API_KEY"))
+text_model = build_chat_model(
+    TEXT_MODEL,
+    endpoints,
     temperature=0.2,
     top_p = 0.75,
+    include_response_headers=True,
     seed=42,
 )
-multimodal_model = ChatOpenAI(
-    api_key=os.getenv("OPENAI_API_KEY"),
-    base_url=os.getenv("OPENAI_BASE_URL"),
-    model = MULTIMODAL_MODEL,
+multimodal_model = build_chat_model(
+    MULTIMODAL_MODEL,
+    endpoints,
     temperature=0.2,
     top_p = 0.75,
+    include_response_headers=True,
     seed=42,
 )
+prewarm_endpoints(endpoints, connections=config.concurrency if config.input_dir else 1)
 
 model = HTPModel(
     text_model=text_model,
     multimodal_model=multimodal_model,
     language=config.language,
-    use_cache=True
+    use_cache=True,
+    checkpoints=get_checkpoint_store(config.checkpoint_path)
 )
 
+def list_images(input_dir, pattern):
+    files = glob.glob(os.path.join(input_dir, pattern), recursive=True)
+    return sorted(f for f in files if os.path.isfile(f) and f.lower().endswith(IMAGE_EXTENSIONS))
+
+def load_finished(save_path):
+    # 已成功写入结果的图片，配合 --skip_existing 跳过
+    finished = set()
+    if not os.path.exists(save_path):
+        return finished
+    with open(save_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if record.get("success"):
+                finished.add(record["file"])
+    return finished
+
+def run_directory():
+    files = list_images(config.input_dir, config.glob)
+    finished = load_finished(config.save_path) if config.skip_existing else set()
+    todo = [f for f in files if os.path.relpath(f, config.input_dir) not in finished]
+    logger.info(f"{len(files)} images found, {len(files) - len(todo)} skipped, {len(todo)} to analyze.")
+
+    runner = BatchRunner(model, language=config.language, concurrency=config.concurrency, retries=config.retries, priority=Priority.BATCH)
+    summary = {"total": len(todo), "success": 0, "failed": 0, "skipped": len(files) - len(todo), "cached": 0, "tokens": 0, "failures": []}
+    # 每完成一张图片追加一行，中途退出也不会丢失已完成的结果
+    with open(config.save_path, "a", encoding="utf-8") as f:
+        for outcome in runner.run((path, path) for path in todo):
+            name = os.path.relpath(outcome.name, config.input_dir)
+            record = {
+                "file": name,
+                "success": outcome.success,
+                "attempts": outcome.attempts,
+                "duration": round(outcome.duration, 3),
+            }
+            if outcome.success:
+                record["result"] = outcome.result
+                summary["success"] += 1
+                summary["cached"] += int(bool(outcome.result.get("cached")))
+                summary["tokens"] += outcome.result["usage"]["total"]
+            else:
+                record["error"] = outcome.error
+                summary["failed"] += 1
+                summary["failures"].append(name)
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            f.flush()
+            logger.info(f"[{runner.meter.completed}/{len(todo)}] {name}: {'ok' if outcome.success else 'failed'}")
+
+    elapsed = runner.meter.elapsed
+    summary["elapsed"] = round(elapsed, 3)
+    summary["images_per_minute"] = round(summary["total"] / elapsed * 60, 2) if elapsed > 0 and summary["total"] else 0.0
+    print(json.dumps(summary, indent=4, ensure_ascii=False))
+    return summary
+
+if config.input_dir:
+    summary = run_directory()
+    sys.exit(1 if summary["failed"] else 0)
+
 result = model.workflow(
-    image_path=config.image_file,
+    image_path=ImageInput.resolve(config.image_file),
     language=config.language
 )
 
@@ -0,0 +1,65 @@
+import asyncio
+import math
+import time
+from contextlib import asynccontextmanager
+
+
+class QueueFullError(Exception):
+    """Raised when a request can not be admitted because the queue is full."""
+    def __init__(self, retry_after: int):
+        super().__init__(f"Server busy, retry after {retry_after}s.")
+        self.retry_after = retry_after
+
+
+class AdmissionController(object):
+    """Caps in-flight workflows and bounds the number of waiting requests."""
+    def __init__(self, max_concurrency: int = 4, max_queue: int = 16):
+        assert max_concurrency > 0, "max_concurrency should be positive."
+        assert max_queue >= 0, "max_queue should not be negative."
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.in_flight = 0
+        self.waiting = 0
+        # 指数滑动平均的单次 workflow 耗时，用于估算 Retry-After
+        self.avg_duration = 60.0
+        self._semaphore = None
+
+    @property
+    def semaphore(self):
+        # 延迟创建，保证绑定到 uvicorn 的事件循环
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    @property
+    def queue_depth(self):
+        return self.waiting
+
+    def retry_after(self):
+        rounds = (self.waiting + 1) / self.max_concurrency
+        return max(1, math.ceil(rounds * self.avg_duration))
+
+    async def acquire(self) -> float:
+        """Wait for a slot and return its start time, or raise QueueFullError."""
+        if self.in_flight >= self.max_concurrency and self.waiting >= self.max_queue:
+            raise QueueFullError(self.retry_after())
+        self.waiting += 1
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.in_flight += 1
+        return time.monotonic()
+
+    def release(self, start: float):
+        self.in_flight -= 1
+        self.semaphore.release()
+        self.avg_duration = 0.8 * self.avg_duration + 0.2 * (time.monotonic() - start)
+
+    @asynccontextmanager
+    async def slot(self):
+        start = await self.acquire()
+        try:
+            yield
+        finally:
+            self.release(start)
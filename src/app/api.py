@@ -1,63 +1,307 @@
+import asyncio
+import json
+import logging
+import os
+from contextlib import asynccontextmanager
+from typing import Optional
+
 from requests import JSONDecodeError
-from src.app.models import HTPInput, HTPOutput, Usage, MethodList, AnalysisOutput
+from src.app.admission import AdmissionController, QueueFullError
+from src.client_registry import get_client_registry
+from src.image_utils import ImageInput
+from src.llm_scheduler import Priority, get_scheduler
+from src.metrics import get_metrics
+from src.app.jobs import JobStore, JobWorkerPool
+from src.app.models import HTPInput, HTPOutput, Usage, MethodList, AnalysisOutput, JobInput, JobStatus, JobResults, ReadyStatus, QueueStatus
 from fastapi import FastAPI, HTTPException, status
+from fastapi.responses import PlainTextResponse, StreamingResponse
+
+logger = logging.getLogger(__name__)
+
+
+def to_output(result: dict) -> HTPOutput:
+    return HTPOutput(
+        usage=Usage(
+            total_tokens=result["usage"]["total"],
+            prompt_tokens=result["usage"]["prompt"],
+            completion_tokens=result["usage"]["completion"]
+        ),
+        overall=AnalysisOutput(
+            feature=result["overall"]["feature"],
+            analysis=result["overall"]["analysis"],
+        ),
+        house=AnalysisOutput(
+            feature=result["house"]["feature"],
+            analysis=result["house"]["analysis"],
+        ),
+        tree=AnalysisOutput(
+            feature=result["tree"]["feature"],
+            analysis=result["tree"]["analysis"],
+        ),
+        person=AnalysisOutput(
+            feature=result["person"]["feature"],
+            analysis=result["person"]["analysis"],
+        ),
+        merge=result["merge"],
+        final=result["final"],
+        signal=result["signal"],
+        classification=result["classification"],
+        fix_signal=result["fix_signal"]
+    )
+
+
+def encode_event(event: str, payload: dict, format: str = "sse") -> str:
+    data = json.dumps(payload, ensure_ascii=False)
+    if format == "ndjson":
+        return json.dumps({"event": event, **payload}, ensure_ascii=False) + "\n"
+    return f"event: {event}\ndata: {data}\n\n"
+
+
+def register_gauges(model, admission: AdmissionController, job_store: JobStore):
+    """Expose cache, admission and scheduler state as gauges read at scrape time."""
+    registry = get_metrics()
+
+    def cache_stats():
+        samples = {}
+        if model.result_cache is not None:
+            stats = model.result_cache.stats()
+            samples[("result", "hits")] = stats["hits"]
+            samples[("result", "misses")] = stats["misses"]
+            samples[("result", "entries")] = stats["entries"]
+        if model.llm_cache is not None:
+            stats = model.llm_cache.stats()
+            samples[("llm", "hits")] = stats["hits"]
+            samples[("llm", "misses")] = stats["misses"]
+            samples[("llm", "entries")] = stats["entries"]
+            samples[("llm", "bytes")] = stats["bytes"]
+        return samples
+
+    def cache_hit_rate():
+        samples = {}
+        for name, cache in (("result", model.result_cache), ("llm", model.llm_cache)):
+            if cache is None:
+                continue
+            lookups = cache.hits + cache.misses
+            samples[(name,)] = cache.hits / lookups if lookups else 0.0
+        return samples
+
+    def scheduler_stats():
+        samples = {}
+        for name, lane in get_scheduler().stats().items():
+            for key in ("in_flight", "waiting", "limit"):
+                samples[(name, key)] = lane[key]
+        return samples
+
+    def endpoint_stats():
+        samples = {}
+        for llm in {id(model.text_model): model.text_model, id(model.multimodal_model): model.multimodal_model}.values():
+            pool = getattr(llm, "pool", None)
+            if pool is None:
+                continue
+            for label, stats in pool.stats().items():
+                for key in ("outstanding", "state", "latency"):
+                    samples[(llm.model_name, label, key)] = stats[key]
+        return samples
+
+    registry.gauge("htp_cache", "Result and LLM cache counters.", ["cache", "stat"], cache_stats)
+    registry.gauge("htp_cache_hit_rate", "Cache hit rate since process start.", ["cache"], cache_hit_rate)
+    registry.gauge("htp_requests_in_flight", "Workflows holding an admission slot.", [], lambda: {(): admission.in_flight})
+    registry.gauge("htp_requests_queued", "Requests waiting for an admission slot.", [], lambda: {(): admission.queue_depth})
+    registry.gauge("htp_jobs_queued", "Batch job items waiting in the job queue.", [], lambda: {(): job_store.queue_depth()})
+    registry.gauge("htp_llm_scheduler", "Per-model scheduler lane state.", ["model", "stat"], scheduler_stats)
+    # state: 0 正常，1 半开，2 熔断
+    registry.gauge("htp_endpoint", "Pooled endpoint state: outstanding calls, breaker state and latency EWMA.", ["model", "endpoint", "stat"], endpoint_stats)
+
+
+class AdmittedStreamingResponse(StreamingResponse):
+    """StreamingResponse that gives its admission slot back however the response ends.
+
+    The release can not live in the body generator: when the client
+    disconnects before the first chunk, the generator never starts and its
+    `finally` never runs.
+    """
+    def __init__(self, content, admission: AdmissionController, start: float, **kwargs):
+        super().__init__(content, **kwargs)
+        self.admission = admission
+        self.start = start
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.admission.release(self.start)
+
+
+def resolve_image(value: str) -> ImageInput:
+    """Resolve and check a request image, raising 400 when it is not a readable image."""
+    try:
+        return ImageInput.resolve(value).verify()
+    except (ValueError, TypeError) as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    except OSError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Image file could not be read.")
+
 
+def create_app(model, max_concurrency: int = 4, max_queue: int = 16, job_dir: Optional[str] = None, job_workers: int = 2,
+               recover_jobs: bool = True):
+    job_store = JobStore(job_dir, recover=recover_jobs)
+
+    async def run_job_item(image_path: str, language: str) -> dict:
+        result = await model.aworkflow(image_path=ImageInput.resolve(image_path), language=language, priority=Priority.BATCH)
+        return to_output(result).model_dump()
+
+    job_pool = JobWorkerPool(job_store, run_job_item, workers=job_workers)
+
+    @asynccontextmanager
+    async def lifespan(app):
+        job_pool.start()
+        app.state.ready = True
+        yield
+        app.state.ready = False
+        await job_pool.stop()
+        await get_client_registry().aclose()
 
-def create_app(model):
     app = FastAPI(
         title = "HTP Test",
         description = "A simple web application that uses the House-Tree-Person test to analyze an image.",
+        lifespan=lifespan,
     )
+    admission = AdmissionController(max_concurrency=max_concurrency, max_queue=max_queue)
+    app.state.admission = admission
+    app.state.job_store = job_store
+    app.state.ready = False
+    register_gauges(model, admission, job_store)
 
     @app.post("/v1/predict", response_model=HTPOutput, status_code=status.HTTP_200_OK)
     async def predict(data: HTPInput):
         try:
             assert data.language in ["en", "zh"], "Language must be either 'en' or 'zh'."
-            result = model.workflow(
-                image_path=data.image_path,
-                language=data.language
-            )
-            result = HTPOutput(
-                usage=Usage(
-                    total_tokens=result["usage"]["total"],
-                    prompt_tokens=result["usage"]["prompt"],
-                    completion_tokens=result["usage"]["completion"]
-                ),
-                overall=AnalysisOutput(
-                    feature=result["overall"]["feature"],
-                    analysis=result["overall"]["analysis"],
-                ),
-                house=AnalysisOutput(
-                    feature=result["house"]["feature"],
-                    analysis=result["house"]["analysis"],
-                ),
-                tree=AnalysisOutput(
-                    feature=result["tree"]["feature"],
-                    analysis=result["tree"]["analysis"],
-                ),
-                person=AnalysisOutput(
-                    feature=result["person"]["feature"],
-                    analysis=result["person"]["analysis"],
-                ),
-                merge=result["merge"],
-                final=result["final"],
-                signal=result["signal"],
-                classification=result["classification"],
-                fix_signal=result["fix_signal"]
-            )
-
-            return result
+            # 解析和校验图片在线程中进行，避免大图阻塞事件循环
+            image = await asyncio.to_thread(resolve_image, data.image_path)
+            async with admission.slot():
+                result = await model.aworkflow(
+                    image_path=image,
+                    language=data.language
+                )
+            return to_output(result)
         
+        except HTTPException:
+            raise
+        except QueueFullError as e:
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail=str(e),
+                headers={"Retry-After": str(e.retry_after)}
+            )
         except JSONDecodeError as e:
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
-        except Exception as e:
-            print(e)
-            raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+        except Exception:
+            logger.exception("Prediction failed.")
+            raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Internal server error.")
+
+    @app.post("/v1/predict/stream", status_code=status.HTTP_200_OK)
+    async def predict_stream(data: HTPInput, format: str = "sse"):
+        """Stream each stage result as it completes, as SSE or NDJSON."""
+        if data.language not in ["en", "zh"]:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Language must be either 'en' or 'zh'.")
+        if format not in ["sse", "ndjson"]:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Format must be either 'sse' or 'ndjson'.")
+        # 开始输出后无法再返回错误状态码，图片在此之前校验
+        image = await asyncio.to_thread(resolve_image, data.image_path)
+        # 在返回响应头之前占用名额，排队已满时仍能返回 429
+        try:
+            start = await admission.acquire()
+        except QueueFullError as e:
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail=str(e),
+                headers={"Retry-After": str(e.retry_after)}
+            )
+
+        async def events():
+            try:
+                async for stage, result, usage in model.astream_workflow(image, language=data.language):
+                    if stage == "result":
+                        yield encode_event("done", {"result": to_output(result).model_dump()}, format)
+                    else:
+                        yield encode_event("stage", {"stage": stage, "data": result, "usage": usage}, format)
+            except Exception:
+                # 详细错误只写入日志，不随事件发给客户端
+                logger.exception("Streaming prediction failed.")
+                yield encode_event("error", {"detail": "Internal server error."}, format)
+
+        return AdmittedStreamingResponse(
+            events(),
+            admission,
+            start,
+            media_type="text/event-stream" if format == "sse" else "application/x-ndjson",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        )
+
+    @app.post("/v1/jobs", response_model=JobStatus, status_code=status.HTTP_202_ACCEPTED)
+    async def submit_job(data: JobInput):
+        """Queue many images for background analysis and return the job id immediately."""
+        if data.language not in ["en", "zh"]:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Language must be either 'en' or 'zh'.")
+        if not data.images:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="At least one image is required.")
+        images = await asyncio.to_thread(lambda: [(image.file_name, resolve_image(image.image_path).data) for image in data.images])
+        job_id = await asyncio.to_thread(job_store.submit, data.language, images)
+        job_pool.notify()
+        return job_store.status(job_id)
+
+    @app.get("/v1/jobs/{job_id}", response_model=JobStatus, status_code=status.HTTP_200_OK)
+    async def job_status(job_id: str):
+        job = job_store.status(job_id)
+        if job is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Job not found.")
+        return job
+
+    @app.get("/v1/jobs/{job_id}/results", response_model=JobResults, status_code=status.HTTP_200_OK)
+    async def job_results(job_id: str, offset: int = 0, limit: int = 100):
+        if job_store.status(job_id) is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Job not found.")
+        items = await asyncio.to_thread(job_store.results, job_id, offset, min(limit, 1000))
+        return JobResults(job_id=job_id, offset=offset, items=items)
+
+    @app.delete("/v1/jobs/{job_id}", response_model=JobStatus, status_code=status.HTTP_200_OK)
+    async def cancel_job(job_id: str):
+        if job_store.status(job_id) is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Job not found.")
+        job_store.cancel(job_id)
+        return job_store.status(job_id)
+
+    @app.get("/v1/ready", response_model=ReadyStatus, status_code=status.HTTP_200_OK)
+    async def ready():
+        """503 while starting up, shutting down or with a full queue, so a load balancer skips this worker."""
+        is_ready = app.state.ready and (admission.in_flight < admission.max_concurrency or admission.waiting < admission.max_queue)
+        if not is_ready:
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Not ready.")
+        return ReadyStatus(ready=True, pid=os.getpid())
+
+    @app.get("/v1/queue", response_model=QueueStatus, status_code=status.HTTP_200_OK)
+    async def queue():
+        return QueueStatus(
+            pid=os.getpid(),
+            in_flight=admission.in_flight,
+            queued=admission.queue_depth,
+            max_concurrency=admission.max_concurrency,
+            max_queue=admission.max_queue,
+            retry_after=admission.retry_after(),
+            jobs_queued=await asyncio.to_thread(job_store.queue_depth),
+            llm=get_scheduler().stats(),
+        )
+
+    @app.get("/metrics", response_class=PlainTextResponse, status_code=status.HTTP_200_OK)
+    async def metrics():
+        """Prometheus text format; counters are per process, so scrape every worker."""
+        body = await asyncio.to_thread(get_metrics().render)
+        return PlainTextResponse(body, media_type="text/plain; version=0.0.4")
 
     @app.get("/v1/methods", status_code=status.HTTP_200_OK)
     async def list_methods():
         return MethodList(
-            method=["predict"]
+            method=["predict", "predict/stream", "jobs", "ready", "queue"]
         )
         
-    return app
\ No newline at end of file
+    return app
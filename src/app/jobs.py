@@ -0,0 +1,248 @@
+import asyncio
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+from typing import List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_JOB_DIR = os.path.join(os.path.expanduser("~"), ".cache", "psydraw", "jobs")
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+
+def default_job_dir() -> str:
+    return os.getenv("HTP_JOB_DIR") or DEFAULT_JOB_DIR
+
+
+class JobStore(object):
+    """Durable batch job queue backed by SQLite.
+
+    Job and item state lives in `jobs.db`; uploaded images are spooled to
+    `<root>/<job_id>/<index>` so the database stays small. Items left
+    running by a crashed process go back to the queue on start-up; with
+    several server processes only the parent passes `recover=True`, so a
+    worker starting up does not re-queue items its siblings are running.
+    """
+    def __init__(self, root: Optional[str] = None, recover: bool = True):
+        self.root = root or default_job_dir()
+        os.makedirs(self.root, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(os.path.join(self.root, "jobs.db"), timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA busy_timeout=30000")
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id TEXT PRIMARY KEY, language TEXT NOT NULL, status TEXT NOT NULL, "
+                "created REAL NOT NULL, updated REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS job_items ("
+                "job_id TEXT NOT NULL, idx INTEGER NOT NULL, file_name TEXT NOT NULL, "
+                "image_path TEXT NOT NULL, status TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, "
+                "result TEXT, error TEXT, updated REAL NOT NULL, PRIMARY KEY (job_id, idx))"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS job_items_status ON job_items (status)")
+            # 上次进程退出时仍在处理的条目重新排队，已取消任务的条目直接标记为取消
+            recovered = 0
+            if recover:
+                cancelled = [row[0] for row in self._conn.execute(
+                    "SELECT DISTINCT i.job_id FROM job_items i JOIN jobs j ON i.job_id = j.id WHERE i.status = ? AND j.status = ?",
+                    (RUNNING, CANCELLED)
+                ).fetchall()]
+                for job_id in cancelled:
+                    self._conn.execute("UPDATE job_items SET status = ? WHERE job_id = ? AND status = ?", (CANCELLED, job_id, RUNNING))
+                    self._refresh_job(job_id)
+                recovered = self._conn.execute(
+                    "UPDATE job_items SET status = ? WHERE status = ?", (QUEUED, RUNNING)
+                ).rowcount
+        if recovered:
+            logger.info(f"{recovered} interrupted job items re-queued.")
+
+    def submit(self, language: str, images: List[Tuple[str, bytes]]) -> str:
+        job_id = uuid.uuid4().hex
+        job_dir = os.path.join(self.root, job_id)
+        os.makedirs(job_dir, exist_ok=True)
+        now = time.time()
+        rows = []
+        for idx, (file_name, data) in enumerate(images):
+            image_path = os.path.join(job_dir, str(idx))
+            with open(image_path, "wb") as f:
+                f.write(data)
+            rows.append((job_id, idx, file_name, image_path, QUEUED, now))
+        with self._lock, self._conn:
+            self._conn.execute("INSERT INTO jobs VALUES (?, ?, ?, ?, ?)", (job_id, language, QUEUED, now, now))
+            self._conn.executemany(
+                "INSERT INTO job_items (job_id, idx, file_name, image_path, status, updated) VALUES (?, ?, ?, ?, ?, ?)", rows
+            )
+        logger.info(f"Job {job_id} submitted with {len(rows)} images.")
+        return job_id
+
+    def claim(self) -> Optional[dict]:
+        """Atomically take the oldest queued item and mark it running."""
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT i.job_id, i.idx, i.file_name, i.image_path, i.attempts, j.language "
+                "FROM job_items i JOIN jobs j ON i.job_id = j.id "
+                "WHERE i.status = ? AND j.status != ? ORDER BY j.created, i.idx LIMIT 1", (QUEUED, CANCELLED)
+            ).fetchone()
+            if row is None:
+                return None
+            claimed = self._conn.execute(
+                "UPDATE job_items SET status = ?, attempts = attempts + 1, updated = ? "
+                "WHERE job_id = ? AND idx = ? AND status = ?", (RUNNING, time.time(), row[0], row[1], QUEUED)
+            ).rowcount
+            if not claimed:
+                return None
+            self._conn.execute("UPDATE jobs SET status = ?, updated = ? WHERE id = ? AND status = ?", (RUNNING, time.time(), row[0], QUEUED))
+        return {
+            "job_id": row[0], "idx": row[1], "file_name": row[2],
+            "image_path": row[3], "attempts": row[4] + 1, "language": row[5],
+        }
+
+    def finish(self, job_id: str, idx: int, result: Optional[dict] = None, error: Optional[str] = None, retry: bool = False):
+        if retry:
+            status = QUEUED
+        else:
+            status = DONE if error is None else FAILED
+        with self._lock, self._conn:
+            job = self._conn.execute("SELECT status FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            # 已取消任务的条目不再放回队列
+            if status == QUEUED and job is not None and job[0] == CANCELLED:
+                status = CANCELLED
+            self._conn.execute(
+                "UPDATE job_items SET status = ?, result = ?, error = ?, updated = ? "
+                "WHERE job_id = ? AND idx = ? AND status = ?",
+                (status, json.dumps(result, ensure_ascii=False) if result is not None else None, error, time.time(), job_id, idx, RUNNING)
+            )
+            self._refresh_job(job_id)
+
+    def _refresh_job(self, job_id: str):
+        counts = dict(self._conn.execute(
+            "SELECT status, COUNT(*) FROM job_items WHERE job_id = ? GROUP BY status", (job_id,)
+        ).fetchall())
+        status = self._conn.execute("SELECT status FROM jobs WHERE id = ?", (job_id,)).fetchone()[0]
+        if counts.get(RUNNING) or (status != CANCELLED and counts.get(QUEUED)):
+            return
+        if status != CANCELLED:
+            self._conn.execute("UPDATE jobs SET status = ?, updated = ? WHERE id = ?", (DONE, time.time(), job_id))
+        # 处理完成或取消后最后一个条目结束时删除暂存的图片
+        shutil.rmtree(os.path.join(self.root, job_id), ignore_errors=True)
+
+    def cancel(self, job_id: str) -> bool:
+        with self._lock, self._conn:
+            found = self._conn.execute(
+                "UPDATE jobs SET status = ?, updated = ? WHERE id = ? AND status IN (?, ?)",
+                (CANCELLED, time.time(), job_id, QUEUED, RUNNING)
+            ).rowcount
+            self._conn.execute(
+                "UPDATE job_items SET status = ?, updated = ? WHERE job_id = ? AND status = ?",
+                (CANCELLED, time.time(), job_id, QUEUED)
+            )
+            # 仍在处理的条目还要读取图片，由最后结束的条目删除目录
+            if found:
+                self._refresh_job(job_id)
+        if found:
+            logger.info(f"Job {job_id} cancelled.")
+        return bool(found)
+
+    def status(self, job_id: str) -> Optional[dict]:
+        with self._lock:
+            job = self._conn.execute("SELECT language, status, created, updated FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if job is None:
+                return None
+            counts = dict(self._conn.execute(
+                "SELECT status, COUNT(*) FROM job_items WHERE job_id = ? GROUP BY status", (job_id,)
+            ).fetchall())
+        return {
+            "job_id": job_id,
+            "language": job[0],
+            "status": job[1],
+            "created": job[2],
+            "updated": job[3],
+            "total": sum(counts.values()),
+            "queued": counts.get(QUEUED, 0),
+            "running": counts.get(RUNNING, 0),
+            "done": counts.get(DONE, 0),
+            "failed": counts.get(FAILED, 0),
+            "cancelled": counts.get(CANCELLED, 0),
+        }
+
+    def results(self, job_id: str, offset: int = 0, limit: int = 100) -> List[dict]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT idx, file_name, status, attempts, result, error FROM job_items "
+                "WHERE job_id = ? ORDER BY idx LIMIT ? OFFSET ?", (job_id, limit, offset)
+            ).fetchall()
+        return [
+            {
+                "index": idx, "file_name": file_name, "status": status, "attempts": attempts,
+                "result": json.loads(result) if result else None, "error": error,
+            }
+            for idx, file_name, status, attempts, result, error in rows
+        ]
+
+    def queue_depth(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM job_items WHERE status = ?", (QUEUED,)).fetchone()[0]
+
+
+class JobWorkerPool(object):
+    """Drains a JobStore with `workers` concurrent coroutines around HTPModel.aworkflow."""
+    def __init__(self, store: JobStore, run, workers: int = 2, max_attempts: int = 3, poll_interval: float = 1.0):
+        self.store = store
+        # run(image_path, language) -> 结果字典的协程函数
+        self.run = run
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self._tasks = []
+        self._wakeup = None
+
+    def start(self):
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._work(i)) for i in range(self.workers)]
+        logger.info(f"Job worker pool started with {self.workers} workers.")
+
+    def notify(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _work(self, worker_id: int):
+        while True:
+            item = await asyncio.to_thread(self.store.claim)
+            if item is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            try:
+                result = await self.run(item["image_path"], item["language"])
+            except asyncio.CancelledError:
+                # 服务关闭时放回队列，重启后继续处理；所属任务已取消时 finish 会标记为取消
+                await asyncio.to_thread(self.store.finish, item["job_id"], item["idx"], None, None, True)
+                raise
+            except Exception as e:
+                retry = item["attempts"] < self.max_attempts
+                logger.warning(f"Job {item['job_id']} item {item['idx']} failed (attempt {item['attempts']}): {e}")
+                await asyncio.to_thread(self.store.finish, item["job_id"], item["idx"], None, str(e), retry)
+                continue
+            await asyncio.to_thread(self.store.finish, item["job_id"], item["idx"], result)
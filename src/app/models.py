@@ -1,5 +1,5 @@
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import Dict, List, Optional
 
 class MethodList(BaseModel):
     method: List[str]
@@ -27,4 +27,58 @@ class HTPOutput(BaseModel):
     signal: str
     usage: Usage
     classification: Optional[bool]
-    fix_signal: Optional[str] = None
\ No newline at end of file
+    fix_signal: Optional[str] = None
+
+class JobImage(BaseModel):
+    file_name: str
+    image_path: str
+
+
+class JobInput(BaseModel):
+    images: List[JobImage]
+    language: str = "zh"
+
+
+class JobStatus(BaseModel):
+    job_id: str
+    language: str
+    status: str
+    created: float
+    updated: float
+    total: int
+    queued: int
+    running: int
+    done: int
+    failed: int
+    cancelled: int
+
+
+class JobItemResult(BaseModel):
+    index: int
+    file_name: str
+    status: str
+    attempts: int
+    result: Optional[HTPOutput] = None
+    error: Optional[str] = None
+
+
+class JobResults(BaseModel):
+    job_id: str
+    offset: int
+    items: List[JobItemResult]
+
+
+class ReadyStatus(BaseModel):
+    ready: bool
+    pid: int
+
+
+class QueueStatus(BaseModel):
+    pid: int
+    in_flight: int
+    queued: int
+    max_concurrency: int
+    max_queue: int
+    retry_after: int
+    jobs_queued: int
+    llm: Dict[str, dict]
@@ -0,0 +1,106 @@
+import itertools
+import logging
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Any, Iterable, Iterator, Optional, Tuple
+
+try:
+    from src.llm_scheduler import Priority, backoff_delay
+except ImportError:
+    # streamlit 页面以 src 为根目录导入本模块
+    from llm_scheduler import Priority, backoff_delay
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class BatchOutcome:
+    """Outcome of one image in a batch."""
+    name: str
+    success: bool
+    result: Optional[dict] = None
+    error: Optional[str] = None
+    attempts: int = 0
+    duration: float = 0.0
+    extra: Any = field(default=None, repr=False)
+
+
+class ThroughputMeter(object):
+    """Measures completions per second over the most recent `window` items."""
+    def __init__(self, window: int = 20):
+        self.start = time.monotonic()
+        self.times = deque(maxlen=window)
+        self.completed = 0
+
+    def record(self):
+        self.times.append(time.monotonic())
+        self.completed += 1
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self.start
+
+    @property
+    def rate(self) -> Optional[float]:
+        if not self.times:
+            return None
+        # 只有一个样本时用开始时间作为区间起点
+        first = self.times[0] if len(self.times) > 1 else self.start
+        span = self.times[-1] - first
+        count = len(self.times) - 1 if len(self.times) > 1 else 1
+        return count / span if span > 0 else None
+
+    def eta(self, remaining: int) -> Optional[float]:
+        rate = self.rate
+        return remaining / rate if rate else None
+
+
+class BatchRunner(object):
+    """Runs HTPModel.workflow over many images with bounded concurrency and retries.
+
+    Outcomes are yielded as soon as each image finishes, not in input order.
+    All workers share one model, since each workflow keeps its language and
+    usage in its own run context.
+    """
+    def __init__(self, model, language: str = "zh", concurrency: int = 8, retries: int = 2, priority: Priority = Priority.BATCH):
+        assert concurrency > 0, "concurrency should be positive."
+        self.model = model
+        self.language = language
+        self.concurrency = concurrency
+        self.retries = retries
+        self.priority = priority
+        self.meter = ThroughputMeter()
+
+    def _run_one(self, name: str, image, extra=None) -> BatchOutcome:
+        start = time.monotonic()
+        error = None
+        for attempt in range(self.retries + 1):
+            try:
+                result = self.model.workflow(image_path=image, language=self.language, priority=self.priority)
+                return BatchOutcome(name, True, result, None, attempt + 1, time.monotonic() - start, extra)
+            except Exception as e:
+                error = str(e)
+                logger.warning(f"{name} failed (attempt {attempt + 1}/{self.retries + 1}): {e}")
+                if attempt < self.retries:
+                    time.sleep(backoff_delay(attempt))
+        return BatchOutcome(name, False, None, error, self.retries + 1, time.monotonic() - start, extra)
+
+    def run(self, items: Iterable[Tuple]) -> Iterator[BatchOutcome]:
+        """Run (name, image) or (name, image, extra) items and yield outcomes as they complete.
+
+        Items are pulled lazily and at most `2 * concurrency` are in flight, so
+        inputs and finished results do not pile up for large batches.
+        """
+        self.meter = ThroughputMeter()
+        items = iter(items)
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            pending = {executor.submit(self._run_one, *item) for item in itertools.islice(items, self.concurrency * 2)}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    for item in itertools.islice(items, 1):
+                        pending.add(executor.submit(self._run_one, *item))
+                    self.meter.record()
+                    yield future.result()
@@ -0,0 +1,129 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import weakref
+from typing import Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# 记录中只保留信号文本的开头，完整结果写在磁盘上
+SUMMARY_LENGTH = 200
+
+
+class UploadRecord(object):
+    """An uploaded image spilled to disk; only its name and location stay in memory."""
+    __slots__ = ("file_id", "file_name", "digest", "path", "size")
+
+    def __init__(self, file_id: str, file_name: str, digest: str, path: str, size: int):
+        self.file_id = file_id
+        self.file_name = file_name
+        self.digest = digest
+        self.path = path
+        self.size = size
+
+    def read(self) -> bytes:
+        with open(self.path, "rb") as f:
+            return f.read()
+
+
+class BatchRecord(object):
+    """Compact summary of one batch item, with a pointer to the full result on disk."""
+    __slots__ = ("digest", "file_name", "success", "classification", "signal", "error", "attempts", "duration", "path")
+
+    def __init__(self, digest: str, file_name: str, success: bool, classification: Optional[bool] = None,
+                 signal: Optional[str] = None, error: Optional[str] = None, attempts: int = 0,
+                 duration: float = 0.0, path: Optional[str] = None):
+        self.digest = digest
+        self.file_name = file_name
+        self.success = success
+        self.classification = classification
+        self.signal = signal
+        self.error = error
+        self.attempts = attempts
+        self.duration = duration
+        self.path = path
+
+
+class BatchStore(object):
+    """Per-session spill directory for uploads and batch results.
+
+    Uploaded images are written to `<root>/uploads/<digest>` and full
+    workflow results to `<root>/results/<digest>.json`, so memory holds only
+    `UploadRecord` and `BatchRecord` objects. Uploads are bounded by
+    `max_files` and `max_bytes`; files over the limit are rejected.
+    """
+    def __init__(self, root: Optional[str] = None, max_files: int = 1000, max_bytes: int = 2 * 1024 * 1024 * 1024):
+        self.root = root or tempfile.mkdtemp(prefix="psydraw-batch-")
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.join(self.root, "uploads"), exist_ok=True)
+        os.makedirs(os.path.join(self.root, "results"), exist_ok=True)
+        self.uploads: "dict[str, UploadRecord]" = {}
+        self.upload_bytes = 0
+        self.records: List[BatchRecord] = []
+        # 会话结束、对象被回收时删除整个目录
+        self._finalizer = weakref.finalize(self, shutil.rmtree, self.root, True)
+
+    def add_upload(self, file_id: str, file_name: str, data: bytes) -> Optional[UploadRecord]:
+        """Spill an upload to disk, returning None when the buffer is full."""
+        if file_id in self.uploads:
+            return self.uploads[file_id]
+        if len(self.uploads) >= self.max_files or self.upload_bytes + len(data) > self.max_bytes:
+            logger.warning(f"Upload buffer full, {file_name} rejected.")
+            return None
+        digest = hashlib.sha256(data).hexdigest()
+        path = os.path.join(self.root, "uploads", digest)
+        if not os.path.exists(path):
+            with open(path, "wb") as f:
+                f.write(data)
+        record = UploadRecord(file_id, file_name, digest, path, len(data))
+        self.uploads[file_id] = record
+        self.upload_bytes += record.size
+        return record
+
+    def sync_uploads(self, file_ids) -> None:
+        """Forget uploads that were removed from the uploader."""
+        for file_id in set(self.uploads) - set(file_ids):
+            record = self.uploads.pop(file_id)
+            self.upload_bytes -= record.size
+            if not any(other.digest == record.digest for other in self.uploads.values()):
+                try:
+                    os.remove(record.path)
+                except OSError:
+                    pass
+
+    def add_result(self, upload: UploadRecord, result: Optional[dict], success: bool, error: Optional[str] = None,
+                   attempts: int = 0, duration: float = 0.0) -> BatchRecord:
+        path = None
+        classification = signal = None
+        if success:
+            path = os.path.join(self.root, "results", f"{upload.digest}.json")
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(result, f, ensure_ascii=False)
+            classification = result.get("classification")
+            signal = result.get("signal") if classification is not False else result.get("fix_signal")
+            if signal:
+                signal = signal[:SUMMARY_LENGTH]
+        record = BatchRecord(upload.digest, upload.file_name, success, classification, signal, error, attempts, duration, path)
+        self.records.append(record)
+        return record
+
+    def load_result(self, record: BatchRecord) -> Optional[dict]:
+        if record.path is None:
+            return None
+        with open(record.path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def iter_uploads(self) -> Iterator[UploadRecord]:
+        return iter(list(self.uploads.values()))
+
+    def clear_results(self):
+        self.records = []
+        shutil.rmtree(os.path.join(self.root, "results"), ignore_errors=True)
+        os.makedirs(os.path.join(self.root, "results"), exist_ok=True)
+
+    def close(self):
+        self._finalizer()
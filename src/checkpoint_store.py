@@ -0,0 +1,111 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHECKPOINT_PATH = os.path.join(os.path.expanduser("~"), ".cache", "psydraw", "checkpoints.db")
+
+
+def default_checkpoint_path() -> str:
+    return os.getenv("HTP_CHECKPOINT_PATH") or DEFAULT_CHECKPOINT_PATH
+
+
+class CheckpointStore(object):
+    """Durable per-stage workflow outputs keyed by the workflow cache key.
+
+    Every finished stage is committed as soon as it returns, so a batch that
+    dies part-way resumes each image from its last completed stage. The key
+    already covers the normalized image digest, language, models and prompt
+    set. A key's checkpoints are cleared once its whole result is cached.
+    Rows older than `ttl` seconds are dropped, and beyond `max_rows` the
+    oldest go first; both run on open and then at most every
+    `prune_interval` seconds on save, so a long-running server stays bounded.
+    """
+    def __init__(self, path: Optional[str] = None, ttl: Optional[float] = 7 * 24 * 3600, max_rows: Optional[int] = 50000,
+                 prune_interval: float = 300.0):
+        self.path = path or default_checkpoint_path()
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self.ttl = ttl
+        self.max_rows = max_rows
+        self.prune_interval = prune_interval
+        self._pruned_at = 0.0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA busy_timeout=30000")
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS checkpoints ("
+                "key TEXT NOT NULL, stage TEXT NOT NULL, result TEXT NOT NULL, "
+                "updated REAL NOT NULL, PRIMARY KEY (key, stage))"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS checkpoints_updated ON checkpoints (updated)")
+            self._prune()
+
+    def _prune(self):
+        # 调用方持有锁并处于事务中
+        self._pruned_at = time.monotonic()
+        removed = 0
+        if self.ttl:
+            removed += self._conn.execute("DELETE FROM checkpoints WHERE updated < ?", (time.time() - self.ttl,)).rowcount
+        if self.max_rows:
+            excess = self._conn.execute("SELECT COUNT(*) FROM checkpoints").fetchone()[0] - self.max_rows
+            if excess > 0:
+                removed += self._conn.execute(
+                    "DELETE FROM checkpoints WHERE rowid IN (SELECT rowid FROM checkpoints ORDER BY updated LIMIT ?)", (excess,)
+                ).rowcount
+        if removed:
+            logger.info(f"{removed} expired or excess checkpoints removed.")
+
+    def load(self, key: str) -> Dict[str, Any]:
+        with self._lock:
+            rows = self._conn.execute("SELECT stage, result FROM checkpoints WHERE key = ?", (key,)).fetchall()
+        return {stage: json.loads(result) for stage, result in rows}
+
+    def save(self, key: str, stage: str, result: Any):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?, ?)",
+                (key, stage, json.dumps(result, ensure_ascii=False), time.time())
+            )
+            if time.monotonic() - self._pruned_at >= self.prune_interval:
+                self._prune()
+
+    def clear(self, key: Optional[str] = None):
+        with self._lock, self._conn:
+            if key is None:
+                self._conn.execute("DELETE FROM checkpoints")
+            else:
+                self._conn.execute("DELETE FROM checkpoints WHERE key = ?", (key,))
+
+    def stats(self) -> dict:
+        with self._lock:
+            row = self._conn.execute("SELECT COUNT(DISTINCT key), COUNT(*) FROM checkpoints").fetchone()
+        return {
+            "path": self.path,
+            "images": row[0],
+            "stages": row[1],
+        }
+
+
+_stores: Dict[str, CheckpointStore] = {}
+_stores_lock = threading.Lock()
+
+
+def get_checkpoint_store(path: Optional[str] = None) -> CheckpointStore:
+    """Return the shared store for `path`, limited by HTP_CHECKPOINT_TTL and HTP_CHECKPOINT_MAX_ROWS."""
+    path = os.path.abspath(path or default_checkpoint_path())
+    with _stores_lock:
+        if path not in _stores:
+            _stores[path] = CheckpointStore(
+                path,
+                ttl=float(os.getenv("HTP_CHECKPOINT_TTL") or 7 * 24 * 3600),
+                max_rows=int(os.getenv("HTP_CHECKPOINT_MAX_ROWS") or 50000),
+            )
+        return _stores[path]
@@ -0,0 +1,245 @@
+import asyncio
+import hashlib
+import importlib.util
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import httpx
+import openai
+from langchain_openai import ChatOpenAI
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BASE_URL = "https://api.openai.com/v1"
+# 与 openai SDK 默认值一致：总超时 600 秒，建连 5 秒
+DEFAULT_TIMEOUT = httpx.Timeout(600.0, connect=5.0)
+
+
+def _env_int(name: str, default: int) -> int:
+    value = os.getenv(name)
+    return int(value) if value else default
+
+
+def key_digest(api_key: Optional[str]) -> str:
+    # 注册表的键里只保存 key 的摘要
+    return hashlib.sha256((api_key or "").encode("utf-8")).hexdigest()[:16]
+
+
+def freeze_params(params: Dict[str, Any]) -> str:
+    return json.dumps(params, sort_keys=True, default=repr)
+
+
+class LoopBoundClient(object):
+    """Stand-in for ChatOpenAI's async client that resolves on every call.
+
+    Attribute access goes to the AsyncOpenAI returned by `factory` for the
+    running event loop, following `path` (e.g. ("chat", "completions")), so
+    a cached ChatOpenAI never holds on to a client of a loop that has ended.
+    """
+    def __init__(self, factory: Callable[[], Any], path: Tuple[str, ...] = ()):
+        self._factory = factory
+        self._path = path
+
+    def __getattr__(self, name: str):
+        target = self._factory()
+        for attr in self._path:
+            target = getattr(target, attr)
+        return getattr(target, name)
+
+
+class ClientRegistry(object):
+    """Process-wide cache of HTTP connection pools and ChatOpenAI instances.
+
+    One httpx client is kept per base URL (async clients per base URL and
+    event loop, since their connections belong to the loop that opened
+    them), so every model and key talking to the same gateway reuses its
+    keep-alive connections, over HTTP/2 when the `h2` package is installed.
+    ChatOpenAI instances are cached by (base_url, api_key, model, params),
+    keeping the `max_models` most recently used, so rebuilding HTPModel on
+    every click or rerun costs no new handshakes.
+    """
+    def __init__(self, max_connections: int = 100, max_keepalive: int = 20, keepalive_expiry: float = 60.0,
+                 http2: Optional[bool] = None, max_models: int = 64):
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.http2 = importlib.util.find_spec("h2") is not None if http2 is None else http2
+        self.max_models = max_models
+        self._lock = threading.Lock()
+        self._clients: Dict[str, httpx.Client] = {}
+        # 按事件循环分开保存，连接池本身引用着事件循环，循环关闭后在下次取用时丢弃
+        self._async_clients: Dict[asyncio.AbstractEventLoop, Dict[str, httpx.AsyncClient]] = {}
+        self._async_openai: Dict[asyncio.AbstractEventLoop, Dict[tuple, openai.AsyncOpenAI]] = {}
+        self._models: "OrderedDict[tuple, Any]" = OrderedDict()
+        self._warmed = set()
+
+    def http_client(self, base_url: Optional[str]) -> httpx.Client:
+        base_url = base_url or DEFAULT_BASE_URL
+        with self._lock:
+            if base_url not in self._clients:
+                self._clients[base_url] = httpx.Client(
+                    http2=self.http2, limits=self.limits, timeout=DEFAULT_TIMEOUT, follow_redirects=True
+                )
+            return self._clients[base_url]
+
+    def async_http_client(self, base_url: Optional[str]) -> httpx.AsyncClient:
+        # 异步连接只能在创建它的事件循环中使用，每次 asyncio.run 都是新的事件循环
+        base_url = base_url or DEFAULT_BASE_URL
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            self._drop_closed_loops()
+            clients = self._async_clients.setdefault(loop, {})
+            if base_url not in clients:
+                clients[base_url] = httpx.AsyncClient(
+                    http2=self.http2, limits=self.limits, timeout=DEFAULT_TIMEOUT, follow_redirects=True
+                )
+            return clients[base_url]
+
+    def _drop_closed_loops(self):
+        # 已关闭的事件循环无法再关闭其连接，只丢弃引用，由垃圾回收关闭套接字
+        for loop in [loop for loop in self._async_clients if loop.is_closed()]:
+            del self._async_clients[loop]
+            self._async_openai.pop(loop, None)
+
+    async def aclose(self):
+        """Close the async clients of the running event loop; call before the loop shuts down."""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            clients = list(self._async_clients.pop(loop, {}).values())
+            self._async_openai.pop(loop, None)
+        for client in clients:
+            await client.aclose()
+
+    def async_openai(self, model: ChatOpenAI) -> openai.AsyncOpenAI:
+        """AsyncOpenAI with the settings of `model`, shared within the running event loop."""
+        loop = asyncio.get_running_loop()
+        api_key = model.openai_api_key.get_secret_value() if model.openai_api_key else None
+        key = (model.openai_api_base, key_digest(api_key), model.openai_organization, freeze_params({
+            "timeout": model.request_timeout, "max_retries": model.max_retries,
+            "headers": model.default_headers, "query": model.default_query,
+        }))
+        with self._lock:
+            client = self._async_openai.get(loop, {}).get(key)
+        if client is not None:
+            return client
+        # 与 ChatOpenAI 自身创建异步客户端时的参数一致
+        client = openai.AsyncOpenAI(
+            api_key=api_key,
+            organization=model.openai_organization,
+            base_url=model.openai_api_base,
+            timeout=model.request_timeout,
+            max_retries=model.max_retries,
+            default_headers=model.default_headers,
+            default_query=model.default_query,
+            http_client=self.async_http_client(model.openai_api_base),
+        )
+        with self._lock:
+            return self._async_openai.setdefault(loop, {}).setdefault(key, client)
+
+    def get_or_create(self, key: tuple, factory: Callable[[], Any]):
+        with self._lock:
+            if key in self._models:
+                self._models.move_to_end(key)
+                return self._models[key]
+        # 在锁外构造，构造过程中会再次获取锁创建 HTTP 客户端
+        value = factory()
+        with self._lock:
+            value = self._models.setdefault(key, value)
+            self._models.move_to_end(key)
+            while len(self._models) > self.max_models:
+                self._models.popitem(last=False)
+            return value
+
+    def chat_model(self, model: str, base_url: Optional[str] = None, api_key: Optional[str] = None, **params) -> ChatOpenAI:
+        key = ("chat", base_url or None, key_digest(api_key), model, freeze_params(params))
+
+        def create():
+            # 异步客户端在每次调用时按当前事件循环取，缓存的实例不绑定任何事件循环
+            def current():
+                return self.async_openai(instance)
+
+            instance = ChatOpenAI(
+                api_key=api_key,
+                base_url=base_url,
+                model=model,
+                http_client=self.http_client(base_url),
+                root_async_client=LoopBoundClient(current),
+                async_client=LoopBoundClient(current, ("chat", "completions")),
+                **params,
+            )
+            return instance
+
+        return self.get_or_create(key, create)
+
+    def prewarm(self, base_url: Optional[str], connections: int = 2, background: bool = False) -> int:
+        """Open `connections` keep-alive connections to `base_url`, once per process.
+
+        Any HTTP answer counts, since the TCP and TLS handshakes are what is
+        being paid ahead of time. Returns the number of connections opened,
+        0 when already warmed or run in the background.
+        """
+        base_url = base_url or DEFAULT_BASE_URL
+        with self._lock:
+            if base_url in self._warmed:
+                return 0
+            self._warmed.add(base_url)
+        if background:
+            threading.Thread(target=self.prewarm_now, args=(base_url, connections), name="http-prewarm", daemon=True).start()
+            return 0
+        return self.prewarm_now(base_url, connections)
+
+    def prewarm_now(self, base_url: str, connections: int = 2) -> int:
+        client = self.http_client(base_url)
+        # HTTP/2 在一条连接上多路复用，只需要一条
+        connections = 1 if self.http2 else connections
+        url = base_url.rstrip("/") + "/models"
+
+        def open_one(_):
+            try:
+                client.get(url, timeout=httpx.Timeout(10.0, connect=5.0))
+                return True
+            except httpx.HTTPError as e:
+                logger.warning(f"Prewarming {base_url} failed: {type(e).__name__}")
+                return False
+
+        # 并发请求才会各自建立一条连接
+        with ThreadPoolExecutor(max_workers=connections) as executor:
+            opened = sum(executor.map(open_one, range(connections)))
+        logger.info(f"Prewarmed {opened} connection(s) to {base_url}.")
+        return opened
+
+    def close(self):
+        with self._lock:
+            clients = list(self._clients.values())
+            self._clients.clear()
+            # 异步客户端需要在其事件循环中关闭，这里只丢弃引用
+            self._async_clients.clear()
+            self._async_openai.clear()
+            self._models.clear()
+            self._warmed.clear()
+        for client in clients:
+            client.close()
+
+
+_registry: Optional[ClientRegistry] = None
+_registry_lock = threading.Lock()
+
+
+def get_client_registry() -> ClientRegistry:
+    """Return the shared registry, sized by HTP_HTTP_MAX_CONNECTIONS and HTP_HTTP_KEEPALIVE; HTP_HTTP2=0 turns HTTP/2 off."""
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = ClientRegistry(
+                max_connections=_env_int("HTP_HTTP_MAX_CONNECTIONS", 100),
+                keepalive_expiry=_env_int("HTP_HTTP_KEEPALIVE", 60),
+                http2=False if os.getenv("HTP_HTTP2") == "0" else None,
+            )
+        return _registry
@@ -0,0 +1,433 @@
+import logging
+import threading
+import time
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional
+
+import openai
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import BaseMessage
+from langchain_core.outputs import ChatGenerationChunk, ChatResult
+from pydantic import PrivateAttr
+
+try:
+    from src.client_registry import freeze_params, get_client_registry, key_digest
+    from src import metrics
+except ImportError:
+    from client_registry import freeze_params, get_client_registry, key_digest
+    import metrics
+
+logger = logging.getLogger(__name__)
+
+CLOSED, HALF_OPEN, OPEN = 0, 1, 2
+# 延迟的指数滑动平均系数
+EWMA_ALPHA = 0.2
+
+
+class Endpoint(object):
+    """One base URL / API key pair."""
+    def __init__(self, base_url: Optional[str], api_key: Optional[str]):
+        self.base_url = base_url or None
+        self.api_key = api_key or None
+
+    def __repr__(self):
+        # 不输出密钥，只保留末尾四位用于区分
+        suffix = self.api_key[-4:] if self.api_key else ""
+        return f"Endpoint({self.base_url or 'default'}, ...{suffix})"
+
+
+def _split(value: Optional[str]) -> List[str]:
+    return [part.strip() for part in (value or "").replace("\n", ",").split(",") if part.strip()]
+
+
+def parse_endpoints(base_url: Optional[str], api_key: Optional[str]) -> List[Endpoint]:
+    """Pair comma separated base URLs and keys.
+
+    One URL with several keys spreads the keys over that URL, several URLs
+    with one key reuse the key, otherwise URLs and keys are paired in order.
+    """
+    urls = _split(base_url) or [None]
+    keys = _split(api_key) or [None]
+    if len(urls) == 1:
+        return [Endpoint(urls[0], key) for key in keys]
+    if len(keys) == 1:
+        return [Endpoint(url, keys[0]) for url in urls]
+    assert len(urls) == len(keys), "Base URLs and API keys should be paired one to one."
+    return [Endpoint(url, key) for url, key in zip(urls, keys)]
+
+
+def is_endpoint_error(error: BaseException) -> bool:
+    """Errors that say the endpoint or key is unhealthy, rather than the request being bad."""
+    if isinstance(error, (openai.APIConnectionError, openai.RateLimitError, openai.AuthenticationError, openai.PermissionDeniedError)):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code >= 500
+
+
+def probe_openai(model: BaseChatModel, timeout: float = 5.0):
+    """Health probe: any answer to GET /models other than 429 or 5xx means the endpoint is up."""
+    try:
+        model.root_client.with_options(timeout=timeout, max_retries=0).models.list()
+    except openai.APIStatusError as e:
+        if e.status_code == 429 or e.status_code >= 500:
+            raise
+
+
+class CircuitBreaker(object):
+    """Opens after `failure_threshold` consecutive failures.
+
+    An open breaker lets one trial call through after `reset_timeout`
+    seconds, or as soon as a health probe succeeds; the trial closes it
+    again on success and reopens it on failure.
+    """
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial = False
+
+    def allow(self, now: float) -> bool:
+        if self.state == OPEN and now - self.opened_at >= self.reset_timeout:
+            self.state = HALF_OPEN
+        if self.state == HALF_OPEN:
+            return not self.trial
+        return self.state == CLOSED
+
+    def start(self):
+        if self.state == HALF_OPEN:
+            self.trial = True
+
+    def success(self):
+        self.state = CLOSED
+        self.failures = 0
+        self.trial = False
+
+    def failure(self, now: float) -> bool:
+        """Record a failure, return True if the breaker has just opened."""
+        self.failures += 1
+        self.trial = False
+        if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.failure_threshold):
+            self.state = OPEN
+            self.opened_at = now
+            return True
+        return False
+
+
+class _Member(object):
+    def __init__(self, index: int, endpoint: Endpoint, model: BaseChatModel, breaker: CircuitBreaker):
+        self.index = index
+        self.endpoint = endpoint
+        self.model = model
+        self.breaker = breaker
+        self.outstanding = 0
+        self.latency = 0.0
+        self.picked = 0
+
+    @property
+    def label(self) -> str:
+        return f"{self.index}:{self.endpoint.base_url or 'default'}"
+
+
+class EndpointPool(object):
+    """Least-expected-wait balancer over models bound to different endpoints.
+
+    A call goes to the member with the smallest (outstanding + 1) x latency
+    EWMA, so a slow endpoint gets proportionally fewer concurrent calls;
+    members without a latency sample yet count at the pool average.
+    A successful call taking more than `slow_factor` times the usual latency
+    of its stage (and at least `slow_floor` seconds) counts as a failure for
+    the breaker, so a gateway that hangs is taken out like one that errors.
+    Streaming calls are judged by the time to their first chunk, against a
+    separate baseline. While any breaker is open a background thread runs
+    `probe` against it every `probe_interval` seconds.
+    """
+    def __init__(self, members: List[_Member], slow_factor: Optional[float] = 4.0, slow_floor: float = 15.0,
+                 probe_interval: float = 10.0, probe: Optional[Callable[[BaseChatModel], None]] = probe_openai):
+        assert members, "Endpoint pool should have at least one member."
+        self.members = members
+        self.slow_factor = slow_factor
+        self.slow_floor = slow_floor
+        self.probe_interval = probe_interval
+        self.probe = probe
+        self._lock = threading.Lock()
+        self._prober = None
+        self._picks = 0
+        # 各阶段（区分是否流式）的延迟滑动平均，作为判断慢调用的基准
+        self._baselines: Dict[tuple, float] = {}
+
+    def acquire(self, exclude=()) -> Optional[_Member]:
+        with self._lock:
+            now = time.monotonic()
+            candidates = [m for m in self.members if m not in exclude]
+            if not candidates:
+                return None
+            healthy = [m for m in candidates if m.breaker.allow(now)]
+            measured = [m.latency for m in self.members if m.latency > 0]
+            default = sum(measured) / len(measured) if measured else 1.0
+            # 全部熔断时仍然放行，避免所有请求直接失败；按预计等待时间选择，相同时选最久未使用的，使各个 key 的用量均匀
+            member = min(healthy or candidates, key=lambda m: ((m.outstanding + 1) * (m.latency or default), m.picked))
+            member.breaker.start()
+            member.outstanding += 1
+            self._picks += 1
+            member.picked = self._picks
+            return member
+
+    def has_healthy(self, exclude=()) -> bool:
+        with self._lock:
+            now = time.monotonic()
+            return any(m.breaker.allow(now) for m in self.members if m not in exclude)
+
+    def _is_slow(self, seconds: float, first_chunk: Optional[float]) -> bool:
+        # 流式调用按首个分片的等待时间判断，整段输出再长也不算慢
+        sample = seconds if first_chunk is None else first_chunk
+        key = (metrics.current_stage.get(), first_chunk is not None)
+        baseline = self._baselines.get(key)
+        slow = self.slow_factor is not None and baseline is not None and sample > max(self.slow_floor, self.slow_factor * baseline)
+        # 慢调用不计入基准，否则挂起的网关会很快把基准抬高
+        if not slow:
+            self._baselines[key] = sample if baseline is None else (1 - EWMA_ALPHA) * baseline + EWMA_ALPHA * sample
+        return slow
+
+    def release(self, member: _Member, seconds: float, error: Optional[BaseException] = None, model_name: str = "",
+                first_chunk: Optional[float] = None):
+        """Return a member; `first_chunk` is the time to the first chunk for streaming calls."""
+        with self._lock:
+            member.outstanding -= 1
+            now = time.monotonic()
+            opened = False
+            if error is not None and is_endpoint_error(error):
+                opened = member.breaker.failure(now)
+            elif error is None:
+                member.latency = seconds if member.latency == 0 else (1 - EWMA_ALPHA) * member.latency + EWMA_ALPHA * seconds
+                if self._is_slow(seconds, first_chunk):
+                    opened = member.breaker.failure(now)
+                else:
+                    member.breaker.success()
+            else:
+                # 请求本身的问题（例如 400），不影响端点状态
+                member.breaker.trial = False
+            prober = None
+            if opened and self.probe is not None and self.probe_interval > 0 and self._prober is None:
+                prober = self._prober = threading.Thread(target=self._probe_loop, name="endpoint-probe", daemon=True)
+        if error is None:
+            result = "ok"
+        elif not isinstance(error, Exception):
+            result = "cancelled"
+        else:
+            result = "endpoint_error" if is_endpoint_error(error) else "request_error"
+        metrics.ENDPOINT_CALLS.inc(model=model_name, endpoint=member.label, result=result)
+        if opened:
+            logger.warning(f"Circuit opened for {member.endpoint} after {member.breaker.failures} failures.")
+        if prober is not None:
+            prober.start()
+
+    def _probe_loop(self):
+        while True:
+            time.sleep(self.probe_interval)
+            with self._lock:
+                targets = [m for m in self.members if m.breaker.state == OPEN]
+                if not targets:
+                    # 没有熔断的端点时退出，下次熔断时重新启动
+                    self._prober = None
+                    return
+            for member in targets:
+                try:
+                    self.probe(member.model)
+                except Exception as e:
+                    with self._lock:
+                        member.breaker.opened_at = time.monotonic()
+                    logger.info(f"Health probe of {member.endpoint} failed: {type(e).__name__}")
+                else:
+                    with self._lock:
+                        if member.breaker.state == OPEN:
+                            member.breaker.state = HALF_OPEN
+                    logger.info(f"Health probe of {member.endpoint} succeeded, trial call allowed.")
+
+    def stats(self) -> Dict[str, dict]:
+        with self._lock:
+            return {
+                m.label: {"outstanding": m.outstanding, "state": m.breaker.state, "latency": round(m.latency, 3)}
+                for m in self.members
+            }
+
+
+class PooledChatModel(BaseChatModel):
+    """Chat model that spreads calls over several endpoint/key pairs of the same model.
+
+    Each call goes to the member with the shortest expected wait (outstanding
+    requests times latency EWMA) among those whose circuit breaker is closed. When a member fails with an
+    endpoint error (connection, 429, 401/403, 5xx) the call is retried on
+    the next member whose breaker allows it. Once none is left the last
+    error is raised, or the 429 met on the way if there was one, so the
+    scheduler still backs off.
+    Streaming calls fail over only before the first chunk.
+    """
+    model_name: str
+    members: List[BaseChatModel]
+    endpoints: List[Any]
+    failure_threshold: int = 5
+    reset_timeout: float = 30.0
+    slow_factor: Optional[float] = 4.0
+    slow_floor: float = 15.0
+    probe_interval: float = 10.0
+    _pool: Any = PrivateAttr(default=None)
+
+    def model_post_init(self, __context: Any) -> None:
+        assert len(self.members) == len(self.endpoints), "Each member should have an endpoint."
+        members = [
+            _Member(i, endpoint, model, CircuitBreaker(self.failure_threshold, self.reset_timeout))
+            for i, (endpoint, model) in enumerate(zip(self.endpoints, self.members))
+        ]
+        self._pool = EndpointPool(members, self.slow_factor, self.slow_floor, self.probe_interval)
+
+    @property
+    def pool(self) -> EndpointPool:
+        return self._pool
+
+    @property
+    def _llm_type(self) -> str:
+        return "pooled-openai-chat"
+
+    @property
+    def _identifying_params(self) -> Dict[str, Any]:
+        # 与单个端点时相同，缓存命中不受端点数量影响
+        return self.members[0]._identifying_params
+
+    def _failover(self, member: _Member, tried: list, error: Exception) -> bool:
+        tried.append(member)
+        # 其余端点都已熔断时不再转发，熔断的端点只应收到试探请求
+        if not is_endpoint_error(error) or len(tried) >= len(self._pool.members) or not self._pool.has_healthy(tried):
+            return False
+        # 换端点重发同样计入阶段重试次数
+        metrics.STAGE_RETRIES.inc(stage=metrics.current_stage.get(), reason="failover")
+        logger.warning(f"{self.model_name} call to {member.endpoint} failed with {type(error).__name__}, trying the next endpoint.")
+        return True
+
+    @staticmethod
+    def _last_error(error: BaseException, limited: Optional[Exception]) -> BaseException:
+        # 转发后其他端点的连接错误或 5xx 会掩盖前面的 429，调度器要看到 429 才会退避
+        if limited is not None and isinstance(error, Exception) and is_endpoint_error(error) and not isinstance(error, openai.RateLimitError):
+            return limited
+        return error
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None, **kwargs) -> ChatResult:
+        tried = []
+        limited = None
+        while True:
+            member = self._pool.acquire(tried)
+            started = time.monotonic()
+            try:
+                result = member.model._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+            except BaseException as e:
+                self._pool.release(member, time.monotonic() - started, e, self.model_name)
+                if isinstance(e, Exception) and self._failover(member, tried, e):
+                    limited = e if isinstance(e, openai.RateLimitError) else limited
+                    continue
+                error = self._last_error(e, limited)
+                if error is not e:
+                    raise error from e
+                raise
+            self._pool.release(member, time.monotonic() - started, model_name=self.model_name)
+            return result
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None, **kwargs) -> ChatResult:
+        tried = []
+        limited = None
+        while True:
+            member = self._pool.acquire(tried)
+            started = time.monotonic()
+            try:
+                result = await member.model._agenerate(messages, stop=stop, run_manager=run_manager, **kwargs)
+            except BaseException as e:
+                self._pool.release(member, time.monotonic() - started, e, self.model_name)
+                if isinstance(e, Exception) and self._failover(member, tried, e):
+                    limited = e if isinstance(e, openai.RateLimitError) else limited
+                    continue
+                error = self._last_error(e, limited)
+                if error is not e:
+                    raise error from e
+                raise
+            self._pool.release(member, time.monotonic() - started, model_name=self.model_name)
+            return result
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None, **kwargs) -> Iterator[ChatGenerationChunk]:
+        tried = []
+        limited = None
+        while True:
+            member = self._pool.acquire(tried)
+            started = time.monotonic()
+            first_chunk = None
+            try:
+                for chunk in member.model._stream(messages, stop=stop, run_manager=run_manager, **kwargs):
+                    if first_chunk is None:
+                        first_chunk = time.monotonic() - started
+                    yield chunk
+            except BaseException as e:
+                # 调用方提前结束迭代时收到 GeneratorExit，同样需要归还名额
+                self._pool.release(member, time.monotonic() - started, e, self.model_name)
+                if isinstance(e, Exception) and first_chunk is None and self._failover(member, tried, e):
+                    limited = e if isinstance(e, openai.RateLimitError) else limited
+                    continue
+                error = self._last_error(e, limited)
+                if error is not e:
+                    raise error from e
+                raise
+            seconds = time.monotonic() - started
+            self._pool.release(member, seconds, model_name=self.model_name, first_chunk=seconds if first_chunk is None else first_chunk)
+            return
+
+    async def _astream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None, **kwargs) -> AsyncIterator[ChatGenerationChunk]:
+        tried = []
+        limited = None
+        while True:
+            member = self._pool.acquire(tried)
+            started = time.monotonic()
+            first_chunk = None
+            try:
+                async for chunk in member.model._astream(messages, stop=stop, run_manager=run_manager, **kwargs):
+                    if first_chunk is None:
+                        first_chunk = time.monotonic() - started
+                    yield chunk
+            except BaseException as e:
+                self._pool.release(member, time.monotonic() - started, e, self.model_name)
+                if isinstance(e, Exception) and first_chunk is None and self._failover(member, tried, e):
+                    limited = e if isinstance(e, openai.RateLimitError) else limited
+                    continue
+                error = self._last_error(e, limited)
+                if error is not e:
+                    raise error from e
+                raise
+            seconds = time.monotonic() - started
+            self._pool.release(member, seconds, model_name=self.model_name, first_chunk=seconds if first_chunk is None else first_chunk)
+            return
+
+
+def prewarm_endpoints(endpoints: List[Endpoint], connections: int = 2, background: bool = False) -> int:
+    """Open keep-alive connections to every distinct base URL ahead of the first call."""
+    registry = get_client_registry()
+    return sum(registry.prewarm(url, connections, background) for url in dict.fromkeys(e.base_url for e in endpoints))
+
+
+def build_chat_model(model: str, endpoints: List[Endpoint], **kwargs) -> BaseChatModel:
+    """ChatOpenAI for a single endpoint, a PooledChatModel over one ChatOpenAI per endpoint otherwise.
+
+    Both come from the shared client registry, so repeated calls with the
+    same settings return the same instance, connection pools and breakers.
+
+    SDK retries are always off (`max_retries=0`): every 429 has to reach
+    the scheduler so its window backs off.
+    """
+    registry = get_client_registry()
+    # 429 和临时错误由 HTPModel 经调度器退避重试，SDK 内部重试会让调度器看不到限流
+    kwargs["max_retries"] = 0
+    if len(endpoints) == 1:
+        return registry.chat_model(model, endpoints[0].base_url, endpoints[0].api_key, **kwargs)
+
+    def create():
+        # 成员同样不在 SDK 内重试，端点失败时直接换下一个端点
+        members = [registry.chat_model(model, e.base_url, e.api_key, **kwargs) for e in endpoints]
+        logger.info(f"{model} balanced over {len(members)} endpoints.")
+        return PooledChatModel(model_name=model, members=members, endpoints=endpoints)
+
+    key = ("pool", model, tuple((e.base_url, key_digest(e.api_key)) for e in endpoints), freeze_params(kwargs))
+    return registry.get_or_create(key, create)
@@ -0,0 +1,174 @@
+import asyncio
+import contextvars
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+try:
+    from src import metrics
+except ImportError:
+    import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class Hedger(object):
+    """Sends a duplicate of a slow LLM call and keeps the first response.
+
+    A call is hedged once it has run longer than the `percentile` of the
+    recent latencies of its (stage, model), and never sooner than
+    `min_delay`. Spend is capped by a token bucket: each call adds
+    `max_ratio` and a hedge costs one, holding at most `burst`, so at most
+    about `max_ratio` extra calls are made in the long run. The caller
+    supplies `acquire`, which must admit the hedge without waiting or return
+    None, and `release`, called with the hedge's ticket and future once both
+    copies have finished.
+    """
+    def __init__(self, percentile: float = 95.0, max_ratio: float = 0.05, burst: float = 10.0,
+                 min_samples: int = 20, window: int = 200, min_delay: float = 0.5, max_workers: int = 128):
+        assert 0 < percentile < 100, "Percentile should be between 0 and 100."
+        assert max_ratio >= 0, "max_ratio should not be negative."
+        self.percentile = percentile
+        self.max_ratio = max_ratio
+        self.burst = burst
+        self.min_samples = min_samples
+        self.window = window
+        self.min_delay = min_delay
+        self.max_workers = max_workers
+        self._lock = threading.Lock()
+        self._latencies: Dict[Tuple[str, str], deque] = {}
+        self._budget = 0.0
+        self._executor = None
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="hedge")
+            return self._executor
+
+    def observe(self, key: Tuple[str, str], seconds: float):
+        with self._lock:
+            samples = self._latencies.get(key)
+            if samples is None:
+                samples = self._latencies[key] = deque(maxlen=self.window)
+            samples.append(seconds)
+
+    def delay(self, key: Tuple[str, str]) -> Optional[float]:
+        """Seconds after which a call of `key` is hedged, None until enough samples are seen."""
+        with self._lock:
+            samples = self._latencies.get(key)
+            if samples is None or len(samples) < self.min_samples:
+                return None
+            ordered = sorted(samples)
+        index = min(len(ordered) - 1, int(len(ordered) * self.percentile / 100))
+        return max(self.min_delay, ordered[index])
+
+    def _earn(self):
+        with self._lock:
+            self._budget = min(self.burst, self._budget + self.max_ratio)
+
+    def _start_hedge(self, stage: str, acquire: Callable[[], Any]):
+        with self._lock:
+            if self._budget < 1:
+                ticket = None
+            else:
+                ticket = acquire()
+                if ticket is not None:
+                    self._budget -= 1
+        if ticket is None:
+            metrics.STAGE_HEDGES.inc(stage=stage, outcome="skipped")
+        return ticket
+
+    def invoke(self, stage: str, model_name: str, call: Callable[[], Any], acquire: Callable[[], Any],
+               release: Callable[[Any, Any], None]):
+        key = (stage, model_name)
+        self._earn()
+        after = self.delay(key)
+        started = time.monotonic()
+        if after is None:
+            result = call()
+            self.observe(key, time.monotonic() - started)
+            return result
+
+        primary = self.executor.submit(contextvars.copy_context().run, call)
+        try:
+            result = primary.result(timeout=after)
+        except FutureTimeoutError:
+            pass
+        else:
+            self.observe(key, time.monotonic() - started)
+            return result
+
+        ticket = self._start_hedge(stage, acquire)
+        if ticket is None:
+            result = primary.result()
+            self.observe(key, time.monotonic() - started)
+            return result
+
+        logger.info(f"{stage} slower than {after:.2f}s, hedge sent.")
+        hedge = self.executor.submit(contextvars.copy_context().run, call)
+        futures = [primary, hedge]
+        pending = set(futures)
+        winner = None
+        while pending and winner is None:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            winner = next((f for f in futures if f in done and f.exception() is None), None)
+        # 同步调用无法中断，落败的请求在后台结束后才归还备份请求占用的名额
+        loser = hedge if winner is primary else primary
+        loser.add_done_callback(lambda _: release(ticket, hedge))
+        metrics.STAGE_HEDGES.inc(stage=stage, outcome="won" if winner is hedge else "lost")
+        # 只记录主请求自身的耗时；备份请求胜出时主请求仍在后台运行，结束后再记录
+        primary.add_done_callback(lambda f: f.exception() is None and self.observe(key, time.monotonic() - started))
+        if winner is None:
+            raise primary.exception()
+        return winner.result()
+
+    async def ainvoke(self, stage: str, model_name: str, call: Callable[[], Awaitable[Any]], acquire: Callable[[], Any],
+                      release: Callable[[Any, Any], None]):
+        key = (stage, model_name)
+        self._earn()
+        after = self.delay(key)
+        started = time.monotonic()
+        if after is None:
+            result = await call()
+            self.observe(key, time.monotonic() - started)
+            return result
+
+        primary = asyncio.ensure_future(call())
+        tasks = [primary]
+        ticket = None
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=after)
+            if not done:
+                ticket = self._start_hedge(stage, acquire)
+            if ticket is None:
+                result = await primary
+                self.observe(key, time.monotonic() - started)
+                return result
+
+            logger.info(f"{stage} slower than {after:.2f}s, hedge sent.")
+            hedge = asyncio.ensure_future(call())
+            hedge.add_done_callback(lambda _: release(ticket, hedge))
+            tasks.append(hedge)
+            pending = set(tasks)
+            winner = None
+            while pending and winner is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                winner = next((t for t in tasks if t in done and not t.cancelled() and t.exception() is None), None)
+            metrics.STAGE_HEDGES.inc(stage=stage, outcome="won" if winner is hedge else "lost")
+            if winner is None:
+                raise primary.exception()
+            # 备份请求胜出时主请求会被取消，得不到它自身的耗时，不记录这次样本
+            if winner is primary:
+                self.observe(key, time.monotonic() - started)
+            return winner.result()
+        finally:
+            # 先返回的结果已被采用，取消另一份请求
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
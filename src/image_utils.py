@@ -0,0 +1,145 @@
+import base64
+import binascii
+import hashlib
+import io
+import logging
+import math
+import os
+from typing import Optional, Union
+
+from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+# gpt-4o 等视觉模型会把图片缩放到短边 768 左右，更大的分辨率只会增加上传体积
+IMAGE_MAX_PIXELS = 1024 * 1024
+IMAGE_QUALITY = 85
+IMAGE_FORMAT = "JPEG"
+
+IMAGE_MIME = {
+    "JPEG": "image/jpeg",
+    "PNG": "image/png",
+    "WEBP": "image/webp",
+}
+
+
+def flatten_alpha(image: Image.Image, background=(255, 255, 255)) -> Image.Image:
+    """Composite transparent images onto a solid background and return RGB."""
+    if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+        image = image.convert("RGBA")
+        flattened = Image.new("RGB", image.size, background)
+        flattened.paste(image, mask=image.getchannel("A"))
+        return flattened
+    if image.mode != "RGB":
+        return image.convert("RGB")
+    return image
+
+
+def normalize_image(data: bytes, max_pixels: int = IMAGE_MAX_PIXELS, quality: int = IMAGE_QUALITY, format: str = IMAGE_FORMAT) -> bytes:
+    """Decode, orient, flatten, downscale and re-encode an image once before upload."""
+    assert format in IMAGE_MIME, f"Image format should be one of {list(IMAGE_MIME)}."
+    with Image.open(io.BytesIO(data)) as image:
+        width, height = image.size
+        scale = min(1.0, math.sqrt(max_pixels / float(width * height)))
+        target = (max(1, int(width * scale)), max(1, int(height * scale)))
+        # JPEG 可在解码阶段按 1/2、1/4、1/8 缩小，省去大图的完整解码
+        image.draft("RGB", target)
+        image = ImageOps.exif_transpose(image)
+        image = flatten_alpha(image)
+        pixels = image.size[0] * image.size[1]
+        if pixels > max_pixels:
+            ratio = math.sqrt(max_pixels / float(pixels))
+            image = image.resize((max(1, int(image.size[0] * ratio)), max(1, int(image.size[1] * ratio))), Image.LANCZOS)
+        buffer = io.BytesIO()
+        image.save(buffer, format=format, quality=quality, optimize=True)
+    output = buffer.getvalue()
+    logger.info(f"Image normalized: {len(data)} -> {len(output)} bytes, {width}x{height} -> {image.size[0]}x{image.size[1]}.")
+    return output
+
+
+# 文件路径不会超过这个长度，更长的字符串直接按 base64 处理，省去 stat 调用
+MAX_PATH_LENGTH = 4096
+
+
+def classify_image_string(value: str) -> str:
+    """Classify an image string as "data_uri", "path" or "base64" without decoding it."""
+    if value.startswith("data:"):
+        return "data_uri"
+    if len(value) <= MAX_PATH_LENGTH and os.path.isfile(value):
+        return "path"
+    return "base64"
+
+
+class ImageInput(object):
+    """Image bytes resolved once from raw bytes, a file path, a data URI or base64.
+
+    The base64 form and the SHA-256 digest are computed lazily and cached, so
+    the image is decoded and encoded at most once however many stages use it.
+    """
+    __slots__ = ("data", "source", "mime", "_base64", "_digest")
+
+    def __init__(self, data: bytes, source: str = "bytes", mime: Optional[str] = None):
+        self.data = data
+        self.source = source
+        self.mime = mime
+        self._base64 = None
+        self._digest = None
+
+    @classmethod
+    def resolve(cls, value: Union["ImageInput", bytes, bytearray, memoryview, str]) -> "ImageInput":
+        if isinstance(value, ImageInput):
+            return value
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            return cls(bytes(value), "bytes")
+        if not isinstance(value, str):
+            raise TypeError(f"Unsupported image input type: {type(value).__name__}.")
+        kind = classify_image_string(value)
+        if kind == "path":
+            with open(value, "rb") as image_file:
+                return cls(image_file.read(), "path")
+        if kind == "data_uri":
+            header, _, payload = value.partition(",")
+            if not header.endswith(";base64"):
+                raise ValueError("Only base64 encoded data URIs are supported.")
+            return cls.from_base64(payload, "data_uri", mime=header[5:-7] or None)
+        return cls.from_base64(value, "base64")
+
+    @classmethod
+    def from_base64(cls, value: str, source: str = "base64", mime: Optional[str] = None) -> "ImageInput":
+        try:
+            data = base64.b64decode(value, validate=True)
+        except (binascii.Error, ValueError):
+            raise ValueError("Invalid image path or base64 string.")
+        image = cls(data, source, mime)
+        image._base64 = value
+        return image
+
+    def verify(self) -> "ImageInput":
+        """Raise ValueError unless the bytes parse as an image; pixels are not decoded."""
+        try:
+            with Image.open(io.BytesIO(self.data)) as image:
+                image.verify()
+        except Exception as e:
+            # 损坏的数据在 PIL 中可能抛出 OSError、SyntaxError、struct.error 等多种异常
+            raise ValueError("Invalid image data.") from e
+        return self
+
+    @property
+    def base64(self) -> str:
+        if self._base64 is None:
+            self._base64 = base64.b64encode(self.data).decode("utf-8")
+        return self._base64
+
+    @property
+    def digest(self) -> str:
+        if self._digest is None:
+            self._digest = hashlib.sha256(self.data).hexdigest()
+        return self._digest
+
+    def __len__(self):
+        return len(self.data)
+
+    def normalized(self, max_pixels: int = IMAGE_MAX_PIXELS, quality: int = IMAGE_QUALITY, format: str = IMAGE_FORMAT) -> "ImageInput":
+        if self.source == "normalized":
+            return self
+        return ImageInput(normalize_image(self.data, max_pixels, quality, format), "normalized", IMAGE_MIME[format])
@@ -0,0 +1,273 @@
+import atexit
+import hashlib
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+import warnings
+import zlib
+from typing import Any, Dict, Optional
+
+from langchain_core.caches import RETURN_VAL_TYPE, BaseCache
+from langchain_core.load import dumps, loads
+
+try:
+    from src.metrics import LLM_CACHE_LOOKUPS, current_stage
+except ImportError:
+    # streamlit 页面以 src 为根目录导入本模块
+    from metrics import LLM_CACHE_LOOKUPS, current_stage
+
+logger = logging.getLogger(__name__)
+warnings.filterwarnings("ignore", message="The function `loads` is in beta")
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "psydraw", "llm_cache.db")
+
+
+def default_cache_path() -> str:
+    return os.getenv("HTP_LLM_CACHE_PATH") or DEFAULT_CACHE_PATH
+
+
+class DigestSQLiteCache(BaseCache):
+    """Bounded LLM cache that stores SHA-256 digests instead of raw prompts.
+
+    Chat prompts carry the whole base64 image, so keys are hashed and values
+    are zlib-compressed. Writes and LRU touches go through a background
+    thread that commits them in batches; the database runs in WAL mode so
+    readers in other threads and processes do not block on it. The file is
+    kept under `max_bytes` by evicting least recently used rows in chunks
+    of `evict_chunk`, and rows older than `ttl` seconds are dropped. Entry
+    and byte totals are kept in memory and recounted from the table every
+    `recount_interval` seconds, which also picks up writes made by other
+    processes sharing the file.
+    """
+    def __init__(self, path: Optional[str] = None, max_bytes: int = 512 * 1024 * 1024, ttl: Optional[float] = 30 * 24 * 3600,
+                 flush_interval: float = 0.5, batch_size: int = 64, evict_chunk: int = 256, recount_interval: float = 600.0):
+        self.path = path or default_cache_path()
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.evict_chunk = evict_chunk
+        self.recount_interval = recount_interval
+        self._local = threading.local()
+        # 尚未落盘的写入，查询时优先命中
+        self._pending: Dict[str, bytes] = {}
+        self._pending_lock = threading.Lock()
+        self._queue: "queue.Queue" = queue.Queue()
+        self._stats_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+
+        conn = self._connect()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS llm_cache ("
+            "key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, "
+            "created REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS llm_cache_accessed ON llm_cache (accessed)")
+        conn.execute("CREATE INDEX IF NOT EXISTS llm_cache_created ON llm_cache (created)")
+        conn.commit()
+        # 条目数和字节数只在启动和定期校准时全表统计，写入和淘汰时增量维护
+        self.entries = 0
+        self.bytes = 0
+        self._recount(conn)
+
+        self._writer = threading.Thread(target=self._run_writer, name="llm-cache-writer", daemon=True)
+        self._writer.start()
+        atexit.register(self.close)
+        logger.info(f"LLM cache at {self.path}, max {self.max_bytes} bytes.")
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def make_key(prompt: str, llm_string: str) -> str:
+        sha = hashlib.sha256()
+        sha.update(hashlib.sha256(llm_string.encode("utf-8")).digest())
+        sha.update(prompt.encode("utf-8"))
+        return sha.hexdigest()
+
+    def lookup(self, prompt: str, llm_string: str) -> Optional[RETURN_VAL_TYPE]:
+        key = self.make_key(prompt, llm_string)
+        with self._pending_lock:
+            value = self._pending.get(key)
+        if value is None:
+            row = self._connect().execute("SELECT value FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            value = row[0] if row else None
+        if value is None:
+            with self._stats_lock:
+                self.misses += 1
+            LLM_CACHE_LOOKUPS.inc(stage=current_stage.get(), result="miss")
+            return None
+        try:
+            result = loads(zlib.decompress(value).decode("utf-8"))
+        except Exception:
+            logger.warning("Dropping an LLM cache entry that could not be deserialized.")
+            return None
+        with self._stats_lock:
+            self.hits += 1
+        LLM_CACHE_LOOKUPS.inc(stage=current_stage.get(), result="hit")
+        self._queue.put(("touch", key, None))
+        return result
+
+    def update(self, prompt: str, llm_string: str, return_val: RETURN_VAL_TYPE) -> None:
+        key = self.make_key(prompt, llm_string)
+        value = zlib.compress(dumps(return_val).encode("utf-8"))
+        with self._pending_lock:
+            self._pending[key] = value
+        self._queue.put(("set", key, value))
+
+    def clear(self, **kwargs: Any) -> None:
+        self.flush()
+        conn = self._connect()
+        conn.execute("DELETE FROM llm_cache")
+        conn.commit()
+        with self._stats_lock:
+            self.entries = 0
+            self.bytes = 0
+
+    def _recount(self, conn: sqlite3.Connection):
+        row = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM llm_cache").fetchone()
+        with self._stats_lock:
+            self.entries, self.bytes = row
+        self._counted_at = time.monotonic()
+
+    def _run_writer(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._write(batch)
+                    return
+                batch.append(item)
+            self._write(batch)
+
+    def _write(self, batch):
+        now = time.time()
+        # 同一批里重复写入的键只保留最后一次
+        sets = list({key: (key, value, len(value), now, now) for op, key, value in batch if op == "set"}.values())
+        touches = [(now, key) for op, key, _ in batch if op == "touch"]
+        flushes = [value for op, _, value in batch if op == "flush"]
+        try:
+            conn = self._connect()
+            if time.monotonic() - self._counted_at >= self.recount_interval:
+                self._recount(conn)
+            with conn:
+                if sets:
+                    # 覆盖已有的键时只计入大小的差值
+                    existing, replaced = 0, 0
+                    for key, _, _, _, _ in sets:
+                        row = conn.execute("SELECT size FROM llm_cache WHERE key = ?", (key,)).fetchone()
+                        if row:
+                            existing += 1
+                            replaced += row[0]
+                    conn.executemany("INSERT OR REPLACE INTO llm_cache VALUES (?, ?, ?, ?, ?)", sets)
+                    with self._stats_lock:
+                        self.entries += len(sets) - existing
+                        self.bytes += sum(size for _, _, size, _, _ in sets) - replaced
+                if touches:
+                    conn.executemany("UPDATE llm_cache SET accessed = ? WHERE key = ?", touches)
+                self._evict(conn, now)
+        except sqlite3.Error as e:
+            logger.warning(f"LLM cache write failed: {e}")
+            # 事务已回滚，内存中的统计可能偏离，下一批写入前重新统计
+            self._counted_at = float("-inf")
+        with self._pending_lock:
+            for key, value, _, _, _ in sets:
+                if self._pending.get(key) is value:
+                    del self._pending[key]
+        with self._stats_lock:
+            self.writes += len(sets)
+        for event in flushes:
+            event.set()
+
+    def _delete(self, conn: sqlite3.Connection, where: str, args: tuple) -> int:
+        # 先统计再删除，两条语句都只走索引覆盖的那部分行
+        count, size = conn.execute(f"SELECT COUNT(*), COALESCE(SUM(size), 0) FROM llm_cache WHERE key IN ({where})", args).fetchone()
+        if count:
+            conn.execute(f"DELETE FROM llm_cache WHERE key IN ({where})", args)
+            with self._stats_lock:
+                self.entries -= count
+                self.bytes -= size
+                self.evictions += count
+        return count
+
+    def _evict(self, conn: sqlite3.Connection, now: float):
+        if self.ttl:
+            self._delete(conn, "SELECT key FROM llm_cache WHERE created < ?", (now - self.ttl,))
+        if self.bytes <= self.max_bytes:
+            return
+        # 按最近访问时间分批淘汰，直到回落到上限的 90%
+        target = int(self.max_bytes * 0.9)
+        while self.bytes > target:
+            if not self._delete(conn, "SELECT key FROM llm_cache ORDER BY accessed LIMIT ?", (self.evict_chunk,)):
+                break
+
+    def flush(self, timeout: Optional[float] = None):
+        """Block until everything queued so far is committed."""
+        if not self._writer.is_alive():
+            return
+        event = threading.Event()
+        self._queue.put(("flush", None, event))
+        event.wait(timeout)
+
+    def close(self):
+        if self._writer.is_alive():
+            self._queue.put(None)
+            self._writer.join(timeout=5)
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            lookups = self.hits + self.misses
+            return {
+                "path": self.path,
+                "entries": self.entries,
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "writes": self.writes,
+                "evictions": self.evictions,
+            }
+
+
+_caches: Dict[str, DigestSQLiteCache] = {}
+_caches_lock = threading.Lock()
+
+
+def get_llm_cache(path: Optional[str] = None) -> DigestSQLiteCache:
+    """Return the shared cache for `path`, sized from HTP_LLM_CACHE_MAX_BYTES / HTP_LLM_CACHE_TTL."""
+    path = os.path.abspath(path or default_cache_path())
+    with _caches_lock:
+        if path not in _caches:
+            _caches[path] = DigestSQLiteCache(
+                path,
+                max_bytes=int(os.getenv("HTP_LLM_CACHE_MAX_BYTES") or 512 * 1024 * 1024),
+                ttl=float(os.getenv("HTP_LLM_CACHE_TTL") or 30 * 24 * 3600),
+            )
+        return _caches[path]
@@ -0,0 +1,353 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from enum import IntEnum
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# 粗略估算：图片按固定 token 计，文本按 4 字符 1 token 计，另加系统提示词开销
+IMAGE_TOKENS = 1100
+PROMPT_OVERHEAD_TOKENS = 1500
+RATE_WINDOW = 60.0
+# 剩余额度低于该比例时视为即将限流，提前收缩并发窗口
+LOW_REMAINING_RATIO = 0.1
+
+
+class Priority(IntEnum):
+    """Scheduling lanes, lower value is served first."""
+    INTERACTIVE = 0
+    BATCH = 1
+
+
+@dataclass
+class ModelBudget:
+    """Per-model limits. `rpm`/`tpm` of None means unlimited."""
+    max_concurrency: int = 8
+    rpm: Optional[int] = None
+    tpm: Optional[int] = None
+
+
+def _env_int(name: str) -> Optional[int]:
+    value = os.getenv(name)
+    return int(value) if value else None
+
+
+def default_budget() -> ModelBudget:
+    return ModelBudget(
+        max_concurrency=_env_int("HTP_LLM_MAX_CONCURRENCY") or 8,
+        rpm=_env_int("HTP_LLM_RPM"),
+        tpm=_env_int("HTP_LLM_TPM"),
+    )
+
+
+def parse_retry_after(error: Exception) -> Optional[float]:
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    value = headers.get("retry-after")
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+def backoff_delay(attempt: int, base: float = 1.0, cap: float = 30.0) -> float:
+    """Full-jitter exponential backoff, so retries of parallel stages spread out."""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def _remaining_ratio(headers: dict, kind: str) -> Optional[float]:
+    try:
+        remaining = float(headers[f"x-ratelimit-remaining-{kind}"])
+        limit = float(headers[f"x-ratelimit-limit-{kind}"])
+    except (KeyError, TypeError, ValueError):
+        return None
+    return remaining / limit if limit > 0 else None
+
+
+def estimate_tokens(inputs: dict, image_keys=("image_data",)) -> int:
+    tokens = PROMPT_OVERHEAD_TOKENS
+    for key, value in inputs.items():
+        if key in image_keys:
+            tokens += IMAGE_TOKENS
+        elif isinstance(value, str):
+            tokens += len(value) // 4
+    return tokens
+
+
+class _Waiter(object):
+    __slots__ = ("priority", "seq", "tokens", "event", "loop", "future", "granted", "cancelled", "entry")
+
+    def __init__(self, priority, seq, tokens, loop=None):
+        self.priority = priority
+        self.seq = seq
+        self.tokens = tokens
+        self.loop = loop
+        self.future = loop.create_future() if loop is not None else None
+        self.event = threading.Event() if loop is None else None
+        self.granted = False
+        self.cancelled = False
+        self.entry = None
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+    def grant(self):
+        self.granted = True
+        if self.future is not None:
+            self.loop.call_soon_threadsafe(self._resolve)
+        else:
+            self.event.set()
+
+    def _resolve(self):
+        if not self.future.done():
+            self.future.set_result(None)
+
+
+class Ticket(object):
+    """Handle for one admitted call; give it back with `LLMScheduler.release`."""
+    __slots__ = ("lane", "entry", "started")
+
+    def __init__(self, lane, entry):
+        self.lane = lane
+        self.entry = entry
+        self.started = time.monotonic()
+
+
+class AIMDLimit(object):
+    """Additive-increase / multiplicative-decrease concurrency window.
+
+    The window grows by roughly one slot per window's worth of successful
+    calls and is cut by `backoff` on a rate limit. Calls that started before
+    the last cut do not cut it again, so one burst of 429s counts once.
+    """
+    def __init__(self, initial: float, minimum: float = 1.0, backoff: float = 0.5):
+        self.value = float(initial)
+        self.minimum = minimum
+        self.backoff = backoff
+        self.last_decrease = 0.0
+
+    @property
+    def current(self) -> int:
+        return max(1, int(self.value))
+
+    def increase(self, maximum: int):
+        self.value = min(float(maximum), self.value + 1.0 / self.value)
+
+    def decrease(self, started: float, factor: Optional[float] = None) -> bool:
+        if started < self.last_decrease:
+            return False
+        self.value = max(self.minimum, self.value * (factor or self.backoff))
+        self.last_decrease = time.monotonic()
+        return True
+
+
+class _Lane(object):
+    def __init__(self, name: str, budget: ModelBudget):
+        self.name = name
+        self.budget = budget
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.waiters = []
+        # 最近 60 秒内已放行的调用: [时间戳, token 数]
+        self.window = deque()
+        self.timer = None
+        self.timer_at = None
+        # 服务端返回 Retry-After 时暂停放行直到该时刻
+        self.paused_until = 0.0
+        self.limit = AIMDLimit(max(1, budget.max_concurrency // 2))
+
+    def _rate_delay(self, now: float, tokens: int) -> float:
+        while self.window and now - self.window[0][0] >= RATE_WINDOW:
+            self.window.popleft()
+        if not self.window:
+            return 0.0
+        delay = 0.0
+        if self.budget.rpm is not None and len(self.window) >= self.budget.rpm:
+            delay = max(delay, self.window[-self.budget.rpm][0] + RATE_WINDOW - now)
+        if self.budget.tpm is not None:
+            used = sum(entry[1] for entry in self.window)
+            excess = used + tokens - self.budget.tpm
+            for ts, entry_tokens in self.window:
+                if excess <= 0:
+                    break
+                excess -= entry_tokens
+                delay = max(delay, ts + RATE_WINDOW - now)
+        return max(delay, self.paused_until - now)
+
+    @property
+    def capacity(self) -> int:
+        return min(self.budget.max_concurrency, self.limit.current)
+
+    def dispatch(self):
+        """Grant slots to waiting callers in priority order. Caller holds the lock."""
+        while self.waiters and self.in_flight < self.capacity:
+            waiter = self.waiters[0]
+            if waiter.cancelled:
+                heapq.heappop(self.waiters)
+                continue
+            now = time.monotonic()
+            delay = self._rate_delay(now, waiter.tokens)
+            if delay > 0:
+                self._schedule(delay)
+                return
+            heapq.heappop(self.waiters)
+            self.in_flight += 1
+            waiter.entry = [now, waiter.tokens]
+            self.window.append(waiter.entry)
+            waiter.grant()
+
+    def _schedule(self, delay: float):
+        at = time.monotonic() + delay
+        if self.timer is not None:
+            if self.timer_at <= at:
+                return
+            self.timer.cancel()
+        self.timer = threading.Timer(delay, self._on_timer)
+        self.timer.daemon = True
+        self.timer_at = at
+        self.timer.start()
+
+    def _on_timer(self):
+        with self.lock:
+            self.timer = None
+            self.timer_at = None
+            self.dispatch()
+
+    def feedback(self, ticket: "Ticket", headers: Optional[dict], rate_limited: bool, retry_after: Optional[float]):
+        """Adjust the AIMD window from the outcome of one call. Caller holds the lock."""
+        before = self.limit.current
+        if rate_limited:
+            self.limit.decrease(ticket.started)
+            if retry_after:
+                self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+        else:
+            ratios = [_remaining_ratio(headers or {}, kind) for kind in ("requests", "tokens")]
+            ratios = [ratio for ratio in ratios if ratio is not None]
+            if ratios and min(ratios) < LOW_REMAINING_RATIO:
+                self.limit.decrease(ticket.started, factor=0.75)
+            else:
+                self.limit.increase(self.budget.max_concurrency)
+        if self.limit.current != before:
+            logger.info(f"{self.name} concurrency window {before} -> {self.limit.current}")
+
+
+class LLMScheduler(object):
+    """Process-wide gate for LLM calls.
+
+    Every model gets its own lane with a concurrency cap and optional
+    requests/tokens per minute budget. Waiting calls are served by priority,
+    so interactive requests overtake queued batch work. Both threads and
+    coroutines can wait on the same lane. The effective concurrency of a lane
+    is an AIMD window below its cap, driven by 429s and rate-limit headers.
+    """
+    def __init__(self, budget: Optional[ModelBudget] = None):
+        self.default = budget if budget else default_budget()
+        self.lanes: Dict[str, _Lane] = {}
+        self._lock = threading.Lock()
+        self._seq = itertools.count()
+
+    def configure(self, model_name: str, max_concurrency: Optional[int] = None, rpm: Optional[int] = None, tpm: Optional[int] = None):
+        lane = self.lane(model_name)
+        with lane.lock:
+            if max_concurrency is not None:
+                lane.budget.max_concurrency = max_concurrency
+            if rpm is not None:
+                lane.budget.rpm = rpm
+            if tpm is not None:
+                lane.budget.tpm = tpm
+            lane.dispatch()
+        logger.info(f"Scheduler budget for {model_name}: {lane.budget}")
+
+    def lane(self, model_name: str) -> _Lane:
+        with self._lock:
+            if model_name not in self.lanes:
+                budget = ModelBudget(self.default.max_concurrency, self.default.rpm, self.default.tpm)
+                self.lanes[model_name] = _Lane(model_name, budget)
+            return self.lanes[model_name]
+
+    def _enqueue(self, lane: _Lane, priority: Priority, tokens: int, loop=None) -> _Waiter:
+        waiter = _Waiter(int(priority), next(self._seq), tokens, loop)
+        with lane.lock:
+            heapq.heappush(lane.waiters, waiter)
+            lane.dispatch()
+        return waiter
+
+    def acquire(self, model_name: str, priority: Priority = Priority.INTERACTIVE, tokens: int = 0) -> Ticket:
+        lane = self.lane(model_name)
+        waiter = self._enqueue(lane, priority, tokens)
+        waiter.event.wait()
+        return Ticket(lane, waiter.entry)
+
+    async def aacquire(self, model_name: str, priority: Priority = Priority.INTERACTIVE, tokens: int = 0) -> Ticket:
+        lane = self.lane(model_name)
+        waiter = self._enqueue(lane, priority, tokens, asyncio.get_running_loop())
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            with lane.lock:
+                granted = waiter.granted
+                waiter.cancelled = True
+            if granted:
+                self.release(Ticket(lane, None), failed=True)
+            raise
+        return Ticket(lane, waiter.entry)
+
+    def try_acquire(self, model_name: str, tokens: int = 0) -> Optional[Ticket]:
+        """Admit a call only if a slot is free now and nobody is waiting, otherwise return None."""
+        lane = self.lane(model_name)
+        with lane.lock:
+            now = time.monotonic()
+            if any(not w.cancelled for w in lane.waiters) or lane.in_flight >= lane.capacity or lane._rate_delay(now, tokens) > 0:
+                return None
+            lane.in_flight += 1
+            entry = [now, tokens]
+            lane.window.append(entry)
+        return Ticket(lane, entry)
+
+    def release(self, ticket: Ticket, used_tokens: Optional[int] = None, headers: Optional[dict] = None,
+                rate_limited: bool = False, retry_after: Optional[float] = None, failed: bool = False):
+        """Give back a slot. Successful and rate-limited calls feed the AIMD window."""
+        lane = ticket.lane
+        with lane.lock:
+            lane.in_flight -= 1
+            # 用实际消耗修正预估值，让 TPM 预算贴近真实用量
+            if ticket.entry is not None and used_tokens:
+                ticket.entry[1] = used_tokens
+            if rate_limited or not failed:
+                lane.feedback(ticket, headers, rate_limited, retry_after)
+            lane.dispatch()
+
+    def stats(self) -> Dict[str, dict]:
+        stats = {}
+        for name, lane in list(self.lanes.items()):
+            with lane.lock:
+                stats[name] = {
+                    "in_flight": lane.in_flight,
+                    "waiting": sum(1 for w in lane.waiters if not w.cancelled),
+                    "limit": lane.capacity,
+                    "max_concurrency": lane.budget.max_concurrency,
+                    "rpm": lane.budget.rpm,
+                    "tpm": lane.budget.tpm,
+                }
+        return stats
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler() -> LLMScheduler:
+    """Return the shared scheduler, creating it on first use."""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = LLMScheduler()
+        return _scheduler
@@ -0,0 +1,185 @@
+import bisect
+import contextvars
+import math
+import threading
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+# 当前正在执行的 LLM 阶段，供缓存等下游组件按阶段打标签
+current_stage: contextvars.ContextVar = contextvars.ContextVar("htp_stage", default="unknown")
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0)
+TOKEN_BUCKETS = (50, 100, 250, 500, 1000, 2000, 4000, 8000, 16000, 32000)
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(zip(names, values))
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    escaped = [(k, str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')) for k, v in pairs]
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Counter(object):
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values: Dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels) -> float:
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            return self._values.get(key, 0.0)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class Histogram(object):
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._lock = threading.Lock()
+        # labels -> [每个桶的计数, 总和, 样本数]
+        self._values: Dict[tuple, list] = {}
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    labels = _format_labels(self.labelnames, key, ("le", _format_value(bound)))
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}")
+                lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+class GaugeCallback(object):
+    """Gauge whose samples are read from `collect()` at scrape time, as {label values: value}."""
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str], collect: Callable[[], Dict[tuple, float]]):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.collect = collect
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge"]
+        for key, value in sorted(self.collect().items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class MetricsRegistry(object):
+    """Process-local metrics rendered in the Prometheus text exposition format."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics: Dict[str, object] = {}
+
+    def register(self, metric):
+        with self._lock:
+            # 重复注册（例如多次 create_app）时替换旧的回调
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str], collect: Callable[[], Dict[tuple, float]]) -> GaugeCallback:
+        return self.register(GaugeCallback(name, documentation, labelnames, collect))
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+STAGE_LATENCY = registry.histogram(
+    "htp_stage_latency_seconds", "LLM call latency per workflow stage, excluding scheduler wait.", ["stage", "model"]
+)
+STAGE_QUEUE = registry.histogram(
+    "htp_stage_queue_seconds", "Time a stage waited for a scheduler slot.", ["stage", "model"]
+)
+STAGE_PROMPT_TOKENS = registry.histogram(
+    "htp_stage_prompt_tokens", "Prompt tokens per LLM call.", ["stage", "model"], TOKEN_BUCKETS
+)
+STAGE_COMPLETION_TOKENS = registry.histogram(
+    "htp_stage_completion_tokens", "Completion tokens per LLM call.", ["stage", "model"], TOKEN_BUCKETS
+)
+STAGE_RETRIES = registry.counter(
+    "htp_stage_retries_total", "LLM call retries per stage: rate_limit, server_error or failover to another endpoint.", ["stage", "reason"]
+)
+STAGE_ERRORS = registry.counter(
+    "htp_stage_errors_total", "LLM calls that raised, per stage and exception type.", ["stage", "error"]
+)
+LLM_CACHE_LOOKUPS = registry.counter(
+    "htp_llm_cache_lookups_total", "LLM cache lookups per stage.", ["stage", "result"]
+)
+CHECKPOINT_RESUMES = registry.counter(
+    "htp_checkpoint_resumed_stages_total", "Workflow stages served from checkpoints.", ["stage"]
+)
+ENDPOINT_CALLS = registry.counter(
+    "htp_endpoint_calls_total", "LLM calls per pooled endpoint and result.", ["model", "endpoint", "result"]
+)
+# won / (won + lost) 即备份请求先于原请求返回的比例
+STAGE_HEDGES = registry.counter(
+    "htp_stage_hedges_total", "Hedged LLM calls per stage: won, lost, or skipped for budget or capacity.", ["stage", "outcome"]
+)
+WORKFLOW_LATENCY = registry.histogram(
+    "htp_workflow_latency_seconds", "End-to-end workflow latency.", ["mode", "cached"]
+)
+
+
+def record_llm_call(stage: str, model: str, seconds: float, prompt_tokens: Optional[int], completion_tokens: Optional[int]):
+    STAGE_LATENCY.observe(seconds, stage=stage, model=model)
+    if prompt_tokens is not None:
+        STAGE_PROMPT_TOKENS.observe(prompt_tokens, stage=stage, model=model)
+    if completion_tokens is not None:
+        STAGE_COMPLETION_TOKENS.observe(completion_tokens, stage=stage, model=model)
+
+
+def get_metrics() -> MetricsRegistry:
+    return registry
@@ -1,49 +1,95 @@
-import base64
+import asyncio
+import contextvars
 import logging
-import os
-import re
+import threading
+import time
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from typing import List, Optional
+from typing import Callable, Optional, Tuple, Union
 
 import openai
-from langchain_community.cache import SQLiteCache
 from langchain_community.callbacks import get_openai_callback
 from langchain_core.globals import set_llm_cache
+from langchain_core.output_parsers import JsonOutputParser
 from langchain_core.prompts import ChatPromptTemplate
 from pydantic import BaseModel, Field
 from langchain_openai import ChatOpenAI
 
+try:
+    from src.llm_scheduler import Priority, backoff_delay, estimate_tokens, get_scheduler, parse_retry_after
+    from src.prompt_registry import get_prompt_registry
+    from src.image_utils import IMAGE_FORMAT, IMAGE_MAX_PIXELS, IMAGE_MIME, IMAGE_QUALITY, ImageInput
+    from src.result_cache import ResultCache, get_result_cache, make_key
+    from src.llm_cache import get_llm_cache
+    from src.checkpoint_store import CheckpointStore, get_checkpoint_store
+    from src.hedging import Hedger
+    from src import metrics
+except ImportError:
+    # streamlit 页面以 src 为根目录导入本模块
+    from llm_scheduler import Priority, backoff_delay, estimate_tokens, get_scheduler, parse_retry_after
+    from prompt_registry import get_prompt_registry
+    from image_utils import IMAGE_FORMAT, IMAGE_MAX_PIXELS, IMAGE_MIME, IMAGE_QUALITY, ImageInput
+    from result_cache import ResultCache, get_result_cache, make_key
+    from llm_cache import get_llm_cache
+    from checkpoint_store import CheckpointStore, get_checkpoint_store
+    from hedging import Hedger
+    import metrics
+
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-def is_base64_or_path(input_string):
-    # 移除可能的前缀（如 "data:image/jpeg;base64,"）
-    stripped_string = re.sub(r'^data:image/.+;base64,', '', input_string)
-    
-    # 检查是否是有效的文件路径
-    if os.path.exists(input_string):
-        return "path"
-    
-    # 检查是否可能是 base64
-    try:
-        # 尝试解码
-        base64.b64decode(stripped_string)
-        # 检查是否只包含 base64 字符
-        if re.match(r'^[A-Za-z0-9+/]+={0,2}$', stripped_string):
-            return "base64"
-    except:
-        pass
-    # 如果既不是有效路径也不是 base64，返回 "unknown"
-    return "unknown"
-
-def encode_image(image_path):
-  with open(image_path, "rb") as image_file:
-    return base64.b64encode(image_file.read()).decode('utf-8')
+def get_total_tokens(message):
+    usage = getattr(message, "usage_metadata", None)
+    if usage:
+        return usage.get("total_tokens")
+    return None
+
+def get_token_counts(message):
+    usage = getattr(message, "usage_metadata", None) or {}
+    return usage.get("input_tokens"), usage.get("output_tokens")
+
+def get_response_headers(message):
+    # 需要在 ChatOpenAI 上开启 include_response_headers=True 才会返回
+    metadata = getattr(message, "response_metadata", None) or {}
+    return metadata.get("headers")
+
+def is_transient_error(error):
+    # 连接错误（含超时）和 5xx 可以重试，其余 4xx 重试也不会成功
+    return isinstance(error, (openai.APIConnectionError, openai.InternalServerError))
+
+BASIC_STAGES = ["overall", "house", "tree", "person"]
 
 class ClfResult(BaseModel):
     """Classification result."""
     result: bool = Field(description="true or flase, classification result.")
 
+BASIC_INPUTS = {
+    "zh": (
+        "将特征提取结果整理为**清晰明确**的markdown格式。",
+        "请结合专业知识和助手提供的图像特征，进行特征分析，结果整理为markdown格式。"
+    ),
+    "en": (
+        "Organize the feature extraction results into a **clear and concise** markdown format.",
+        "Please analyze the features based on professional knowledge and the image features provided by the assistant, and organize the results in markdown format."
+    )
+}
+
+FINAL_INPUTS = {
+    "zh": "综合分析结果: \n{merge_result}\n，输出你的专业HTP测试意见书。",
+    "en": "Based on the analysis results: \n{merge_result}\n, write your professional HTP test report."
+}
+
+def build_image_prompt(system_prompt: str, text: str):
+    return ChatPromptTemplate.from_messages([
+        ("system", system_prompt),
+        (
+            "user",
+            [
+                {"type": "image_url", "image_url": {'url': 'data:{image_mime};base64,{image_data}'}},
+                {"type": "text", "text": text}
+            ]
+        )]
+    )
+
 FIX_SIGNAL_EN="""### Assessment Opinion:
 Warning
 
@@ -70,251 +116,715 @@ FIX_SIGNAL_ZH="""### 评估意见:
 
 请记住，寻求帮助是可以的。您并不孤单。"""
 
+class RunContext(object):
+    """State of one workflow run: language, priority, token callback and usage.
+
+    The active run is held in a contextvar, so one shared HTPModel can serve
+    many concurrent workflows; stage threads and tasks started for a run see
+    the same RunContext and update its usage under a lock.
+    """
+    def __init__(self, language: str = "zh", priority: Priority = Priority.INTERACTIVE,
+                 on_token: Optional[Callable[[str, str], None]] = None):
+        assert language in ["zh", "en"], "Language should be either 'zh' or 'en'."
+        self.language = language
+        self.priority = priority
+        self.on_token = on_token
+        self.lock = threading.Lock()
+        self.reset_usage()
+
+    def reset_usage(self):
+        self.usage = {
+            "total": 0,
+            "prompt": 0,
+            "completion": 0
+        }
+        self.stage_usage = {}
+
+
+_run_context: contextvars.ContextVar = contextvars.ContextVar("htp_run_context", default=None)
+
+
 class HTPModel(object):
-    def __init__(self, text_model: ChatOpenAI, multimodal_model: Optional[ChatOpenAI] = None, language: str = "zh", use_cache: bool = True):
+    def __init__(self, text_model: ChatOpenAI, multimodal_model: Optional[ChatOpenAI] = None, language: str = "zh", use_cache: bool = True, rate_limit_retries: int = 3,
+                 image_max_pixels: int = IMAGE_MAX_PIXELS, image_quality: int = IMAGE_QUALITY, image_format: str = IMAGE_FORMAT,
+                 result_cache: Optional[ResultCache] = None, llm_cache_path: Optional[str] = None, checkpoints: Optional[CheckpointStore] = None,
+                 hedger: Optional[Hedger] = None):
         self.text_model = text_model
         self.multimodal_model = multimodal_model if multimodal_model else text_model
         # set language
         assert language in ["zh", "en"], "Language should be either 'zh' or 'en'."
-        self.language = language
+        # 不在 workflow 中直接调用各阶段方法时使用的默认上下文
+        self._default_context = RunContext(language)
         logger.info(f"HTPModel initialized with text model: {self.text_model.model_name}, multimodal model: {self.multimodal_model.model_name}, language: {language}")
+        for llm in {id(self.text_model): self.text_model, id(self.multimodal_model): self.multimodal_model}.values():
+            # SDK 内部的重试既不经过调度器也不计入 htp_stage_retries_total，应使用 build_chat_model 或 max_retries=0
+            if getattr(llm, "max_retries", 0):
+                logger.warning(f"{llm.model_name} retries inside the OpenAI SDK (max_retries={llm.max_retries}); "
+                               "those retries bypass the scheduler and are not counted in metrics.")
         # set cache
         if use_cache:
-            set_llm_cache(SQLiteCache("cache.db"))
+            # 键只保存摘要，文件大小有上限，位置可通过 llm_cache_path 或 HTP_LLM_CACHE_PATH 指定
+            self.llm_cache = get_llm_cache(llm_cache_path)
+            set_llm_cache(self.llm_cache)
             logger.info("Cache enabled.")
-        # init token usage
-        self.usage = {
-            "total": 0,
-            "prompt": 0,
-            "completion": 0
-        }
+        else:
+            self.llm_cache = None
+        # 整个 workflow 结果的缓存，未显式传入时在启用缓存的情况下使用进程级共享缓存
+        self.result_cache = result_cache if result_cache is not None else (get_result_cache() if use_cache else None)
+        # 逐阶段持久化的中间结果，批量任务中断后从最后完成的阶段继续
+        self.checkpoints = checkpoints
+        # 慢于历史延迟分位数的阶段调用会补发一份备份请求，取先返回的结果
+        self.hedger = hedger
+        self.scheduler = get_scheduler()
+        self.prompts = get_prompt_registry()
+        self.parse = JsonOutputParser(pydantic_object=ClfResult)
+        self.format_instructions = self.parse.get_format_instructions()
+        self.rate_limit_retries = rate_limit_retries
+        # 图片预处理参数
+        assert image_format in IMAGE_MIME, f"Image format should be one of {list(IMAGE_MIME)}."
+        self.image_max_pixels = image_max_pixels
+        self.image_quality = image_quality
+        self.image_format = image_format
+    
+    @property
+    def context(self) -> RunContext:
+        context = _run_context.get()
+        return context if context is not None else self._default_context
+    
+    # 以下属性都读自当前运行的上下文，并发的 workflow 互不影响；
+    # 不提供 setter，避免在 workflow 之外改写所有调用共用的默认上下文
+    @property
+    def language(self) -> str:
+        return self.context.language
+    
+    @property
+    def priority(self) -> Priority:
+        return self.context.priority
+    
+    @property
+    def on_token(self) -> Optional[Callable[[str, str], None]]:
+        # final/signal 阶段的 token 回调，参数为 (stage, token)
+        return self.context.on_token
+    
+    @property
+    def usage(self) -> dict:
+        return self.context.usage
+    
+    @property
+    def stage_usage(self) -> dict:
+        return self.context.stage_usage
     
     def refresh_usage(self):
-        self.usage = {
-            "total": 0,
-            "prompt": 0,
-            "completion": 0
-        }
+        self.context.reset_usage()
+    
+    def update_usage(self, cb, stage: Optional[str] = None):
+        context = self.context
+        # 四个基础阶段在不同线程中并发更新同一份统计
+        with context.lock:
+            context.usage["total"] += cb.total_tokens
+            context.usage["prompt"] += cb.prompt_tokens
+            context.usage["completion"] += cb.completion_tokens
+            if stage is not None:
+                context.stage_usage[stage] = {
+                    "total": cb.total_tokens,
+                    "prompt": cb.prompt_tokens,
+                    "completion": cb.completion_tokens
+                }
+        
+    def release_hedge(self, ticket, future):
+        # 流式阶段不发备份请求，这里只处理 invoke/ainvoke 的结果
+        if future.cancelled():
+            self.scheduler.release(ticket, failed=True)
+        elif future.exception() is None:
+            message = future.result()
+            self.scheduler.release(ticket, get_total_tokens(message), get_response_headers(message))
+        elif isinstance(future.exception(), openai.RateLimitError):
+            self.scheduler.release(ticket, rate_limited=True, retry_after=parse_retry_after(future.exception()))
+        else:
+            self.scheduler.release(ticket, failed=True)
     
-    def update_usage(self, cb):
-        self.usage["total"] += cb.total_tokens
-        self.usage["prompt"] += cb.prompt_tokens
-        self.usage["completion"] += cb.completion_tokens
+    def invoke_chain(self, stage: str, llm: ChatOpenAI, chain, inputs: dict, on_token: Optional[Callable[[str, str], None]] = None):
+        # 所有阶段的 LLM 调用都经过进程级调度器，按模型限流并按优先级排队
+        stage_token = metrics.current_stage.set(stage)
+        try:
+            for attempt in range(self.rate_limit_retries + 1):
+                queued_at = time.monotonic()
+                ticket = self.scheduler.acquire(llm.model_name, self.priority, estimate_tokens(inputs))
+                started = time.monotonic()
+                metrics.STAGE_QUEUE.observe(started - queued_at, stage=stage, model=llm.model_name)
+                message = None
+                try:
+                    if on_token is None and self.hedger is not None:
+                        message = self.hedger.invoke(stage, llm.model_name, lambda: chain.invoke(inputs),
+                                                     lambda: self.scheduler.try_acquire(llm.model_name, estimate_tokens(inputs)),
+                                                     self.release_hedge)
+                    elif on_token is None:
+                        message = chain.invoke(inputs)
+                    else:
+                        # 流式输出：每个 token 到达时回调，最后合并成完整消息
+                        for chunk in chain.stream(inputs):
+                            on_token(stage, chunk.content)
+                            message = chunk if message is None else message + chunk
+                except openai.RateLimitError as e:
+                    self.scheduler.release(ticket, rate_limited=True, retry_after=parse_retry_after(e))
+                    if attempt == self.rate_limit_retries:
+                        metrics.STAGE_ERRORS.inc(stage=stage, error=type(e).__name__)
+                        raise
+                    metrics.STAGE_RETRIES.inc(stage=stage, reason="rate_limit")
+                    logger.warning(f"{stage} rate limited, retry {attempt + 1}/{self.rate_limit_retries}.")
+                    time.sleep(parse_retry_after(e) or backoff_delay(attempt))
+                    continue
+                except Exception as e:
+                    # SDK 不再自行重试，临时错误在这里退避重试；流式阶段已输出 token 时不能重试
+                    self.scheduler.release(ticket, failed=True)
+                    if not is_transient_error(e) or message is not None or attempt == self.rate_limit_retries:
+                        metrics.STAGE_ERRORS.inc(stage=stage, error=type(e).__name__)
+                        raise
+                    metrics.STAGE_RETRIES.inc(stage=stage, reason="server_error")
+                    logger.warning(f"{stage} failed with {type(e).__name__}, retry {attempt + 1}/{self.rate_limit_retries}.")
+                    time.sleep(backoff_delay(attempt))
+                    continue
+                except BaseException as e:
+                    self.scheduler.release(ticket, failed=True)
+                    metrics.STAGE_ERRORS.inc(stage=stage, error=type(e).__name__)
+                    raise
+                self.scheduler.release(ticket, get_total_tokens(message), get_response_headers(message))
+                metrics.record_llm_call(stage, llm.model_name, time.monotonic() - started, *get_token_counts(message))
+                return message
+        finally:
+            metrics.current_stage.reset(stage_token)
+    
+    async def ainvoke_chain(self, stage: str, llm: ChatOpenAI, chain, inputs: dict, on_token: Optional[Callable[[str, str], None]] = None):
+        stage_token = metrics.current_stage.set(stage)
+        try:
+            for attempt in range(self.rate_limit_retries + 1):
+                queued_at = time.monotonic()
+                ticket = await self.scheduler.aacquire(llm.model_name, self.priority, estimate_tokens(inputs))
+                started = time.monotonic()
+                metrics.STAGE_QUEUE.observe(started - queued_at, stage=stage, model=llm.model_name)
+                message = None
+                try:
+                    if on_token is None and self.hedger is not None:
+                        message = await self.hedger.ainvoke(stage, llm.model_name, lambda: chain.ainvoke(inputs),
+                                                            lambda: self.scheduler.try_acquire(llm.model_name, estimate_tokens(inputs)),
+                                                            self.release_hedge)
+                    elif on_token is None:
+                        message = await chain.ainvoke(inputs)
+                    else:
+                        async for chunk in chain.astream(inputs):
+                            on_token(stage, chunk.content)
+                            message = chunk if message is None else message + chunk
+                except openai.RateLimitError as e:
+                    self.scheduler.release(ticket, rate_limited=True, retry_after=parse_retry_after(e))
+                    if attempt == self.rate_limit_retries:
+                        metrics.STAGE_ERRORS.inc(stage=stage, error=type(e).__name__)
+                        raise
+                    metrics.STAGE_RETRIES.inc(stage=stage, reason="rate_limit")
+                    logger.warning(f"{stage} rate limited, retry {attempt + 1}/{self.rate_limit_retries}.")
+                    await asyncio.sleep(parse_retry_after(e) or backoff_delay(attempt))
+                    continue
+                except Exception as e:
+                    # SDK 不再自行重试，临时错误在这里退避重试；流式阶段已输出 token 时不能重试
+                    self.scheduler.release(ticket, failed=True)
+                    if not is_transient_error(e) or message is not None or attempt == self.rate_limit_retries:
+                        metrics.STAGE_ERRORS.inc(stage=stage, error=type(e).__name__)
+                        raise
+                    metrics.STAGE_RETRIES.inc(stage=stage, reason="server_error")
+                    logger.warning(f"{stage} failed with {type(e).__name__}, retry {attempt + 1}/{self.rate_limit_retries}.")
+                    await asyncio.sleep(backoff_delay(attempt))
+                    continue
+                except BaseException as e:
+                    self.scheduler.release(ticket, failed=True)
+                    metrics.STAGE_ERRORS.inc(stage=stage, error=type(e).__name__)
+                    raise
+                self.scheduler.release(ticket, get_total_tokens(message), get_response_headers(message))
+                metrics.record_llm_call(stage, llm.model_name, time.monotonic() - started, *get_token_counts(message))
+                return message
+        finally:
+            metrics.current_stage.reset(stage_token)
         
     def get_prompt(self, stage: str):
         assert stage in ["overall", "house", "tree", "person"], "Stage should be either 'overall', 'house', 'tree', or 'person'."
 
-        if stage == "overall":
-            feature_prompt = open(f"src/prompt/{self.language}/overall_feature.txt", "r", encoding="utf-8").read()
-            analysis_prompt = open(f"src/prompt/{self.language}/overall_analysis.txt", "r", encoding="utf-8").read()
-        elif stage == "house":
-            feature_prompt = open(f"src/prompt/{self.language}/house_feature.txt", "r", encoding="utf-8").read()
-            analysis_prompt = open(f"src/prompt/{self.language}/house_analysis.txt", "r", encoding="utf-8").read()
-        elif stage == "tree":
-            feature_prompt = open(f"src/prompt/{self.language}/tree_feature.txt", "r", encoding="utf-8").read()
-            analysis_prompt = open(f"src/prompt/{self.language}/tree_analysis.txt", "r", encoding="utf-8").read()
-        elif stage == "person":
-            feature_prompt = open(f"src/prompt/{self.language}/person_feature.txt", "r", encoding="utf-8").read()
-            analysis_prompt = open(f"src/prompt/{self.language}/person_analysis.txt", "r", encoding="utf-8").read()
+        feature_prompt = self.prompts.text(self.language, f"{stage}_feature")
+        analysis_prompt = self.prompts.text(self.language, f"{stage}_analysis")
             
         return feature_prompt, analysis_prompt
     
-    def basic_analysis(self, image_path: str, stage: str):
-        feature_prompt, analysis_prompt = self.get_prompt(stage)
-        
-        if self.language == "zh":
-            feature_input = "将特征提取结果整理为**清晰明确**的markdown格式。"
-            analysis_input = "请结合专业知识和助手提供的图像特征，进行特征分析，结果整理为markdown格式。"
-        elif self.language == "en":
-            feature_input = "Organize the feature extraction results into a **clear and concise** markdown format."
-            analysis_input = "Please analyze the features based on professional knowledge and the image features provided by the assistant, and organize the results in markdown format."
-            
-        # 判断输入是 base64 还是路径
-        if is_base64_or_path(image_path) == "path":
-            image_data = encode_image(image_path)
-        elif is_base64_or_path(image_path) == "base64":
-            image_data = image_path
-        else:
-            raise ValueError("Invalid image path or base64 string.")
+    def preload_prompts(self, languages=("zh", "en")):
+        # 预先编译所有语言、所有阶段的模板，避免首个请求承担加载开销
+        for language in languages:
+            contextvars.copy_context().run(self._compile_prompts, RunContext(language))
+        logger.info("Prompt templates compiled.")
+    
+    def _compile_prompts(self, context: RunContext):
+        _run_context.set(context)
+        for stage in BASIC_STAGES:
+            self.get_basic_chains(stage)
+        self.get_merge_chain()
+        self.get_final_chain()
+        self.get_signal_chain()
+        self.get_classification_chain()
+    
+    def prepare_image(self, image_path: Union[str, bytes, ImageInput]) -> ImageInput:
+        # 每次 workflow 只解码、压缩一次，所有阶段共享同一份 base64
+        return ImageInput.resolve(image_path).normalized(
+            max_pixels=self.image_max_pixels, quality=self.image_quality, format=self.image_format
+        )
+
+    def get_basic_chains(self, stage: str):
+        assert stage in ["overall", "house", "tree", "person"], "Stage should be either 'overall', 'house', 'tree', or 'person'."
+        feature_input, analysis_input = BASIC_INPUTS[self.language]
         
-        feature_prompt = ChatPromptTemplate.from_messages([
-            ("system", feature_prompt),
-            (
-                "user", 
-                [
-                    {"type": "image_url", "image_url": {'url': 'data:image/jpeg;base64,{image_data}'}},
-                    {"type": "text", "text": feature_input}
-                ]
-            )]
+        feature_prompt = self.prompts.template(
+            self.language, f"{stage}_feature", [f"{stage}_feature"],
+            lambda system: build_image_prompt(system, feature_input)
         )
-        analysis_prompt = ChatPromptTemplate.from_messages([
-            ("system", analysis_prompt),
-            (
-                "user",
-                [
-                    {"type": "image_url", "image_url": {'url': 'data:image/jpeg;base64,{image_data}'}},
-                    {"type": "text", "text": analysis_input}
-                ]
-            )]
+        analysis_prompt = self.prompts.template(
+            self.language, f"{stage}_analysis", [f"{stage}_analysis"],
+            lambda system: build_image_prompt(system, analysis_input)
         )
+        return feature_prompt | self.multimodal_model, analysis_prompt | self.text_model
+    
+    def basic_analysis(self, image_path: Union[str, bytes, ImageInput], stage: str, key: Optional[str] = None,
+                       feature_result: Optional[str] = None):
+        image = ImageInput.resolve(image_path)
+        image_data, image_mime = image.base64, image.mime or "image/jpeg"
+        feature_chain, analysis_chain = self.get_basic_chains(stage)
+        
         logger.info(f"{stage} analysis started.")
         with get_openai_callback() as cb:
-            chain = feature_prompt | self.multimodal_model
-            feature_result = chain.invoke({
-                "image_data": image_data
-            }).content
+            if feature_result is None:
+                feature_result = self.invoke_chain(f"{stage}_feature", self.multimodal_model, feature_chain, {
+                    "image_data": image_data,
+                    "image_mime": image_mime
+                }).content
+                # 特征单独保存，分析失败后重跑时不再重复调用视觉模型
+                self.save_checkpoint(key, f"{stage}_feature", feature_result)
             
-            chain = analysis_prompt | self.text_model
-            analysis_result = chain.invoke({
+            analysis_result = self.invoke_chain(f"{stage}_analysis", self.text_model, analysis_chain, {
                 "image_data": image_data,
+                "image_mime": image_mime,
                 "FEATURES": feature_result
             }).content
             
-            self.update_usage(cb)
+            self.update_usage(cb, stage)
+            
+        logger.info(f"{stage} analysis completed.")
+        
+        return feature_result, analysis_result
+    
+    async def abasic_analysis(self, image_path: Union[str, bytes, ImageInput], stage: str, key: Optional[str] = None,
+                              feature_result: Optional[str] = None):
+        image = ImageInput.resolve(image_path)
+        image_data, image_mime = image.base64, image.mime or "image/jpeg"
+        feature_chain, analysis_chain = self.get_basic_chains(stage)
+        
+        logger.info(f"{stage} analysis started.")
+        with get_openai_callback() as cb:
+            if feature_result is None:
+                feature_result = (await self.ainvoke_chain(f"{stage}_feature", self.multimodal_model, feature_chain, {
+                    "image_data": image_data,
+                    "image_mime": image_mime
+                })).content
+                await asyncio.to_thread(self.save_checkpoint, key, f"{stage}_feature", feature_result)
+            
+            analysis_result = (await self.ainvoke_chain(f"{stage}_analysis", self.text_model, analysis_chain, {
+                "image_data": image_data,
+                "image_mime": image_mime,
+                "FEATURES": feature_result
+            })).content
+            
+            self.update_usage(cb, stage)
             
         logger.info(f"{stage} analysis completed.")
         
         return feature_result, analysis_result
     
+    def get_merge_chain(self):
+        prompt = self.prompts.template(
+            self.language, "merge", ["analysis_merge", "merge_format"],
+            lambda merge_prompt, merge_inputs: ChatPromptTemplate.from_messages([
+                ("system", merge_prompt),
+                (
+                    "user",
+                    [
+                        {"type": "text", "text": merge_inputs}
+                    ]
+                )]
+            )
+        )
+        return prompt | self.text_model
+    
+    def get_merge_inputs(self, results: dict):
+        return {
+            "overall_analysis": results["overall"]["analysis"],
+            "house_analysis": results["house"]["analysis"],
+            "tree_analysis": results["tree"]["analysis"],
+            "person_analysis": results["person"]["analysis"]
+        }
+    
     def merge_analysis(self, results: dict):
         logger.info("merge analysis started.")
-        merge_prompt = open(f"src/prompt/{self.language}/analysis_merge.txt", "r", encoding="utf-8").read()
-        merge_inputs = open(f"src/prompt/{self.language}/merge_format.txt", "r", encoding="utf-8").read()
+        chain = self.get_merge_chain()
+        with get_openai_callback() as cb:
+            result = self.invoke_chain("merge", self.text_model, chain, self.get_merge_inputs(results)).content
+
+            self.update_usage(cb, "merge")
         
-        prompt = ChatPromptTemplate.from_messages([
-            ("system", merge_prompt),
-            (
-                "user",
-                [
-                    {"type": "text", "text": merge_inputs}
-                ]
-            )]
-        )
+        logger.info("merge analysis completed.")
+        return result
+    
+    async def amerge_analysis(self, results: dict):
+        logger.info("merge analysis started.")
+        chain = self.get_merge_chain()
         with get_openai_callback() as cb:
-            chain = prompt | self.text_model
-            result = chain.invoke({
-                "overall_analysis": results["overall"]["analysis"],
-                "house_analysis": results["house"]["analysis"],
-                "tree_analysis": results["tree"]["analysis"],
-                "person_analysis": results["person"]["analysis"]
-            }).content
+            result = (await self.ainvoke_chain("merge", self.text_model, chain, self.get_merge_inputs(results))).content
 
-            self.update_usage(cb)
+            self.update_usage(cb, "merge")
         
         logger.info("merge analysis completed.")
         return result
     
+    def get_text_model(self, streaming: bool = False):
+        # 流式调用时要求服务端在最后一个分块里返回 token 用量
+        return self.text_model.bind(stream_usage=True) if streaming else self.text_model
+    
+    def get_final_chain(self, streaming: bool = False):
+        inputs = FINAL_INPUTS[self.language]
+        prompt = self.prompts.template(
+            self.language, "final", ["final_result"],
+            lambda final_prompt: ChatPromptTemplate.from_messages([
+                ("system", final_prompt),
+                ("user", inputs)
+            ])
+        )
+        return prompt | self.get_text_model(streaming)
+    
     def final_analysis(self, results: dict):
         logger.info("final analysis started.")
-        final_prompt = open(f"src/prompt/{self.language}/final_result.txt", "r", encoding="utf-8").read()
-        
-        if self.language == "zh":
-            inputs = "综合分析结果: \n{merge_result}\n，输出你的专业HTP测试意见书。"
-        else:
-            inputs = "Based on the analysis results: \n{merge_result}\n, write your professional HTP test report."
-            
-        prompt = ChatPromptTemplate.from_messages([
-            ("system", final_prompt),
-            ("user", inputs)
-        ])
+        chain = self.get_final_chain(streaming=self.on_token is not None)
+        with get_openai_callback() as cb:
+            result = self.invoke_chain("final", self.text_model, chain, {
+                "merge_result": results["merge"]
+            }, on_token=self.on_token).content
+
+            self.update_usage(cb, "final")
         
+        logger.info("final analysis completed.")
+        return result
+    
+    async def afinal_analysis(self, results: dict):
+        logger.info("final analysis started.")
+        chain = self.get_final_chain(streaming=self.on_token is not None)
         with get_openai_callback() as cb:
-            chain = prompt | self.text_model
-            result = chain.invoke({
+            result = (await self.ainvoke_chain("final", self.text_model, chain, {
                 "merge_result": results["merge"]
-            }).content
+            }, on_token=self.on_token)).content
 
-            self.update_usage(cb)
+            self.update_usage(cb, "final")
         
         logger.info("final analysis completed.")
         return result
     
+    def get_signal_chain(self, streaming: bool = False):
+        prompt = self.prompts.template(
+            self.language, "signal", ["signal_judge"],
+            lambda signal_prompt: ChatPromptTemplate.from_messages([
+                ("system", signal_prompt),
+                ("user", "{final_result}")
+            ])
+        )
+        return prompt | self.get_text_model(streaming)
+    
     def signal_analysis(self, results: dict):
         logger.info("signal analysis started.")
-        signal_prompt = open(f"src/prompt/{self.language}/signal_judge.txt", "r", encoding="utf-8").read()
-        inputs = "{final_result}"
-        
-        prompt = ChatPromptTemplate.from_messages([
-            ("system", signal_prompt),
-            ("user", inputs)
-        ])
+        chain = self.get_signal_chain(streaming=self.on_token is not None)
+        with get_openai_callback() as cb:
+            result = self.invoke_chain("signal", self.text_model, chain, {
+                "final_result": results["final"]
+            }, on_token=self.on_token).content
+
+            self.update_usage(cb, "signal")
         
+        logger.info("signal analysis completed.")
+        return result
+    
+    async def asignal_analysis(self, results: dict):
+        logger.info("signal analysis started.")
+        chain = self.get_signal_chain(streaming=self.on_token is not None)
         with get_openai_callback() as cb:
-            chain = prompt | self.text_model
-            result = chain.invoke({
+            result = (await self.ainvoke_chain("signal", self.text_model, chain, {
                 "final_result": results["final"]
-            }).content
+            }, on_token=self.on_token)).content
 
-            self.update_usage(cb)
+            self.update_usage(cb, "signal")
         
         logger.info("signal analysis completed.")
         return result
     
+    def get_classification_chain(self):
+        prompt = self.prompts.template(
+            self.language, "classification", ["clf"],
+            lambda classification_prompt: ChatPromptTemplate.from_messages([
+                ("system", classification_prompt),
+                ("user", "{result}" + "{format_instructions}")
+            ])
+        )
+        # chain = prompt | self.multimodal_model.with_structured_output(ClfResult)
+        return prompt | self.multimodal_model, self.parse
+    
+    def parse_classification(self, result):
+        if type(result) == dict:
+            result = result["result"]
+        if type(result) == str:
+            if result == "true":
+                result = True
+            elif result == "false":
+                result = False
+        
+        logger.info(f"result classification completed. Result: {result}")
+        if type(result) == bool:
+            return result
+        else:
+            return True
+    
     def result_classification(self, results: dict):
         logger.info("result classification started.")
-        classification_prompt = open(f"src/prompt/{self.language}/clf.txt", "r", encoding="utf-8").read()
-        inputs = "{result}"
-        
-        prompt = ChatPromptTemplate.from_messages([
-            ("system", classification_prompt),
-            ("user", inputs + "{format_instructions}")
-        ])
+        chain, parse = self.get_classification_chain()
         with get_openai_callback() as cb:
-            # chain = prompt | self.multimodal_model.with_structured_output(ClfResult)
-            from langchain_core.output_parsers import JsonOutputParser
-            
-            parse = JsonOutputParser(pydantic_object=ClfResult)
-            chain = prompt | self.multimodal_model | parse
-            result = chain.invoke({
+            message = self.invoke_chain("classification", self.multimodal_model, chain, {
                 "result": results["signal"],
-                "format_instructions": parse.get_format_instructions()
+                "format_instructions": self.format_instructions
             })
+            result = parse.invoke(message)
             
-            if type(result) == dict:
-                result = result["result"]
-            if type(result) == str:
-                if result == "true":
-                    result = True
-                elif result == "false":
-                    result = False
+            self.update_usage(cb, "classification")
+        
+        return self.parse_classification(result)
+    
+    async def aresult_classification(self, results: dict):
+        logger.info("result classification started.")
+        chain, parse = self.get_classification_chain()
+        with get_openai_callback() as cb:
+            message = await self.ainvoke_chain("classification", self.multimodal_model, chain, {
+                "result": results["signal"],
+                "format_instructions": self.format_instructions
+            })
+            result = parse.invoke(message)
             
-            self.update_usage(cb)
-                
-        logger.info(f"result classification completed. Result: {result}")
-        if type(result) == bool:
-            return result
+            self.update_usage(cb, "classification")
+        
+        return self.parse_classification(result)
+    
+    def get_cache_key(self, image: ImageInput) -> str:
+        parts = [
+            image.digest, self.language, self.text_model.model_name, self.multimodal_model.model_name,
+            self.prompts.digest([self.language])
+        ]
+        if image.source != "normalized":
+            # 原始上传的摘要要带上预处理参数，才能唯一对应一张规范化后的图片
+            parts += ["raw", self.image_max_pixels, self.image_quality, self.image_format]
+        return make_key(*parts)
+    
+    def load_cached_result(self, image: ImageInput, record: bool = True):
+        if self.result_cache is None:
+            return None
+        result = self.result_cache.get(self.get_cache_key(image), record=record)
+        if result is not None:
+            # 命中缓存时没有消耗 token
+            result["usage"] = {
+                "total": 0,
+                "prompt": 0,
+                "completion": 0
+            }
+            result["cached"] = True
+            logger.info("HTP analysis result loaded from cache.")
+        return result
+    
+    def save_result(self, image: ImageInput, image_data: ImageInput, results: dict):
+        results["cached"] = False
+        if self.result_cache is not None:
+            self.result_cache.set(self.get_cache_key(image_data), results, alias=self.get_cache_key(image))
+    
+    def load_checkpoints(self, image_data: ImageInput) -> Tuple[Optional[str], dict]:
+        if self.checkpoints is None:
+            return None, {}
+        key = self.get_cache_key(image_data)
+        saved = self.checkpoints.load(key)
+        if saved:
+            logger.info(f"Resuming from checkpoint, completed stages: {', '.join(saved)}.")
+            for stage in saved:
+                metrics.CHECKPOINT_RESUMES.inc(stage=stage)
+        return key, saved
+    
+    def save_checkpoint(self, key: Optional[str], stage: str, result):
+        if key is not None:
+            self.checkpoints.save(key, stage, result)
+    
+    def clear_checkpoints(self, key: Optional[str]):
+        # 完整结果已写入结果缓存后，逐阶段的检查点不再需要
+        if key is not None and self.result_cache is not None:
+            self.checkpoints.clear(key)
+    
+    def set_fix_signal(self, results: dict):
+        if results["classification"] == False:
+            results["fix_signal"] = FIX_SIGNAL_ZH if self.language == "zh" else FIX_SIGNAL_EN
         else:
-            return True
+            results["fix_signal"] = None
         
-    def workflow(self, image_path: str, language: str = "zh"):
-        self.refresh_usage()
-        # update language
-        self.language = language
+    def workflow(self, image_path: Union[str, bytes, ImageInput], language: str = "zh", priority: Priority = Priority.INTERACTIVE,
+                 on_token: Optional[Callable[[str, str], None]] = None):
+        # 每次调用在独立的上下文中运行，语言、优先级和用量只属于本次请求
+        context = RunContext(language, priority, on_token)
+        return contextvars.copy_context().run(self._run_workflow, context, image_path)
+    
+    def _run_workflow(self, context: RunContext, image_path: Union[str, bytes, ImageInput]):
+        _run_context.set(context)
+        started = time.monotonic()
+        image = ImageInput.resolve(image_path)
+        cached = self.load_cached_result(image, record=False)
+        if cached is None:
+            image_data = self.prepare_image(image)
+            cached = self.load_cached_result(image_data)
+        if cached is not None:
+            metrics.WORKFLOW_LATENCY.observe(time.monotonic() - started, mode="sync", cached="true")
+            return cached
+        
+        key, saved = self.load_checkpoints(image_data)
         
         with ThreadPoolExecutor(max_workers = 4) as executor:
+            # 线程不会继承 contextvars，每个阶段带上当前上下文的副本
             futures = {
-                executor.submit(self.basic_analysis, image_path, stage): stage for stage in ["overall", "house", "tree", "person"]
+                executor.submit(contextvars.copy_context().run, self.basic_analysis, image_data, stage, key,
+                                saved.get(f"{stage}_feature")): stage
+                for stage in BASIC_STAGES if stage not in saved
             }
             
-            results = {}
+            results = {stage: saved[stage] for stage in BASIC_STAGES if stage in saved}
+            errors = []
             for future in as_completed(futures):
                 stage = futures[future]
-                feature_result, analysis_result = future.result()
+                # 某个阶段失败时其余阶段照常完成并保存检查点，全部结束后再抛出
+                try:
+                    feature_result, analysis_result = future.result()
+                except Exception as e:
+                    errors.append(e)
+                    continue
                 results[stage] = {
                     "feature": feature_result,
                     "analysis": analysis_result
                 }
+                self.save_checkpoint(key, stage, results[stage])
+            if errors:
+                raise errors[0]
             results["usage"] = self.usage
         
-        results["merge"] = self.merge_analysis(results)
-        results["final"] = self.final_analysis(results)
-        results["signal"] = self.signal_analysis(results)
-        results["classification"] = self.result_classification(results)
-        if results["classification"] == False:
-            results["fix_signal"] = FIX_SIGNAL_ZH if self.language == "zh" else FIX_SIGNAL_EN
-        else:
-            results["fix_signal"] = None
+        for stage, run in (("merge", self.merge_analysis), ("final", self.final_analysis),
+                           ("signal", self.signal_analysis), ("classification", self.result_classification)):
+            if stage in saved:
+                results[stage] = saved[stage]
+            else:
+                results[stage] = run(results)
+                self.save_checkpoint(key, stage, results[stage])
+        self.set_fix_signal(results)
+        self.save_result(image, image_data, results)
+        self.clear_checkpoints(key)
+        metrics.WORKFLOW_LATENCY.observe(time.monotonic() - started, mode="sync", cached="false")
+            
+        logger.info("HTP analysis workflow completed.")
+        
+        return results
+    
+    async def astream_workflow(self, image_path: Union[str, bytes, ImageInput], language: str = "zh", priority: Priority = Priority.INTERACTIVE,
+                               on_token: Optional[Callable[[str, str], None]] = None):
+        """Yield (stage, result, usage) as each stage finishes, then ("result", results, usage)."""
+        started = time.monotonic()
+        # 生成器在调用方的上下文中执行，本次请求的状态放在单独的 Context 里：
+        # 同步步骤用 context.run 执行，协程作为在该 Context 中创建的任务执行
+        run_context = RunContext(language, priority, on_token)
+        context = contextvars.copy_context()
+        context.run(_run_context.set, run_context)
+        
+        def spawn(fn, *args):
+            return context.run(asyncio.ensure_future, fn(*args))
+        
+        image = ImageInput.resolve(image_path)
+        cached = context.run(self.load_cached_result, image, False)
+        if cached is None:
+            # 图片解码与压缩是 CPU 密集操作，放到线程中避免阻塞事件循环
+            image_data = await asyncio.to_thread(self.prepare_image, image)
+            cached = context.run(self.load_cached_result, image_data)
+        if cached is not None:
+            metrics.WORKFLOW_LATENCY.observe(time.monotonic() - started, mode="stream", cached="true")
+            for stage in BASIC_STAGES + ["merge", "final", "signal", "classification"]:
+                yield stage, cached[stage], None
+            yield "result", cached, cached["usage"]
+            return
+        
+        key, saved = await spawn(asyncio.to_thread, self.load_checkpoints, image_data)
+        
+        async def run_basic(stage):
+            try:
+                return stage, await self.abasic_analysis(image_data, stage, key, saved.get(f"{stage}_feature"))
+            except Exception as e:
+                return stage, e
+        
+        # 已有检查点的阶段直接返回，其余基础阶段在同一个事件循环中并发执行，按完成顺序逐个返回
+        results = {}
+        for stage in BASIC_STAGES:
+            if stage in saved:
+                results[stage] = saved[stage]
+                yield stage, results[stage], None
+        tasks = [spawn(run_basic, stage) for stage in BASIC_STAGES if stage not in saved]
+        errors = []
+        try:
+            for future in asyncio.as_completed(tasks):
+                stage, outcome = await future
+                # 某个阶段失败时其余阶段照常完成并保存检查点，全部结束后再抛出
+                if isinstance(outcome, Exception):
+                    errors.append(outcome)
+                    continue
+                feature_result, analysis_result = outcome
+                results[stage] = {
+                    "feature": feature_result,
+                    "analysis": analysis_result
+                }
+                await asyncio.to_thread(self.save_checkpoint, key, stage, results[stage])
+                yield stage, results[stage], run_context.stage_usage.get(stage)
+        finally:
+            for task in tasks:
+                task.cancel()
+        if errors:
+            raise errors[0]
+        results["usage"] = run_context.usage
+        
+        for stage, run in (("merge", self.amerge_analysis), ("final", self.afinal_analysis),
+                           ("signal", self.asignal_analysis), ("classification", self.aresult_classification)):
+            if stage in saved:
+                results[stage] = saved[stage]
+            else:
+                task = spawn(run, results)
+                try:
+                    results[stage] = await task
+                finally:
+                    task.cancel()
+                await asyncio.to_thread(self.save_checkpoint, key, stage, results[stage])
+            if stage == "classification":
+                context.run(self.set_fix_signal, results)
+            yield stage, results[stage], run_context.stage_usage.get(stage)
+        context.run(self.save_result, image, image_data, results)
+        await asyncio.to_thread(self.clear_checkpoints, key)
+        metrics.WORKFLOW_LATENCY.observe(time.monotonic() - started, mode="stream", cached="false")
             
         logger.info("HTP analysis workflow completed.")
         
-        return results
\ No newline at end of file
+        yield "result", results, results["usage"]
+    
+    async def aworkflow(self, image_path: Union[str, bytes, ImageInput], language: str = "zh", priority: Priority = Priority.INTERACTIVE,
+                        on_token: Optional[Callable[[str, str], None]] = None):
+        results = None
+        async for stage, result, _ in self.astream_workflow(image_path, language, priority, on_token):
+            if stage == "result":
+                results = result
+        return results
@@ -1,17 +1,12 @@
-import base64
-import os
-import shutil
-import tempfile
 import time
-import zipfile
-from io import BytesIO
 
 import streamlit as st
-from docx import Document
-from langchain_openai import ChatOpenAI
-from PIL import Image
 
-from model_langchain import HTPModel
+from batch_runner import BatchRunner
+from batch_store import BatchStore
+from endpoint_pool import build_chat_model, parse_endpoints, prewarm_endpoints
+from report_export import ReportZipWriter
+from model_langchain import HTPModel, Priority, get_checkpoint_store
 
 SUPPORTED_LANGUAGES = {
     "English": "en",
@@ -36,6 +31,14 @@ LANGUAGES = {
         "upload_images": "Upload Images for Batch Analysis",
         "images_uploaded": "{} images uploaded successfully.",
         "upload_images_prompt": "Please upload images to start batch analysis.",
+        "concurrency_label": "Concurrent images:",
+        "retries_label": "Retries per image:",
+        "column_file": "File",
+        "column_status": "Status",
+        "column_classification": "Classification",
+        "column_attempts": "Attempts",
+        "column_seconds": "Seconds",
+        "upload_buffer_full": "Upload limit reached, {} images were not added.",
     "batch_instructions": """
     **Please read the following instructions carefully before proceeding with batch analysis:**
 
@@ -118,133 +121,107 @@ LANGUAGES = {
         "upload_images": "上传图片进行批量分析",
         "images_uploaded": "已成功上传 {} 张图片。",
         "upload_images_prompt": "请上传图片以开始批量分析。",
+        "concurrency_label": "并发图片数：",
+        "retries_label": "单张图片重试次数：",
+        "column_file": "文件",
+        "column_status": "状态",
+        "column_classification": "分类",
+        "column_attempts": "尝试次数",
+        "column_seconds": "耗时（秒）",
+        "upload_buffer_full": "已达到上传上限，{} 张图片未加入。",
     }
 }
 
-@st.cache_resource
-def get_uploaded_files():
-    return []
-
-def pil_to_base64(image: Image.Image, format: str = "JPEG") -> str:
-    """Convert PIL image to base64 string."""
-    buffered = BytesIO()
-    image.save(buffered, format=format)
-    return base64.b64encode(buffered.getvalue()).decode('utf-8')
+def get_batch_store() -> BatchStore:
+    # 每个会话一个落盘缓冲区，上传的图片和完整结果不常驻内存
+    if 'batch_store' not in st.session_state:
+        st.session_state['batch_store'] = BatchStore()
+    return st.session_state['batch_store']
 
 def get_text(key):
     return LANGUAGES[st.session_state['language_code']][key]
 
-def save_results(results):
-    with tempfile.TemporaryDirectory() as temp_dir:
-        for result in results:
-            file_name = result['file_name']
-            file_name_without_ext = os.path.splitext(file_name)[0]
-            
-            result_folder = os.path.join(temp_dir, file_name_without_ext)
-            os.makedirs(result_folder, exist_ok=True)
-            
-            # 保存上传的图片
-            if result['image']:
-                image_path = os.path.join(result_folder, file_name)
-                result['image'].save(image_path)
-            
-            doc = Document()
-            if result['success']:
-                doc.add_paragraph(get_text("ai_disclaimer"))
-                if result['analysis_result']['classification'] is True:
-                    signal = result['analysis_result']['signal']
-                    final = result['analysis_result']['final']
-                    doc.add_paragraph(signal)
-                    doc.add_paragraph(final)
-                else:
-                    signal = result['analysis_result']['fix_signal']
-                    doc.add_paragraph(signal)
-            else:
-                doc.add_paragraph("failed")
-            doc_path = os.path.join(result_folder, f"{file_name_without_ext}.docx")
-            doc.save(doc_path)
-        
-        failed_path = os.path.join(temp_dir, "failed.txt")
-        with open(failed_path, "w") as f:
-            for result in results:
-                if not result['success']:
-                    f.write(f"{result['file_name']}\n")
-                    
-        zip_path = os.path.join(temp_dir, "results.zip")
-        with zipfile.ZipFile(zip_path, 'w') as zipf:
-            for root, _, files in os.walk(temp_dir):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    arcname = os.path.relpath(file_path, temp_dir)
-                    zipf.write(file_path, arcname)
-        with open(zip_path, "rb") as f:
-            zip_content = f.read()
-    
-    return zip_content    
-        
-def batch_analyze(uploaded_files):
-    results = []
-    
+def batch_analyze(store: BatchStore, writer: ReportZipWriter):
     MULTIMODAL_MODEL="gpt-4o-2024-08-06"
     TEXT_MODEL="claude-3-5-sonnet-20240620"
     
-    text_model = ChatOpenAI(
-        api_key=st.session_state.api_key,
-        base_url=st.session_state.base_url,
-        model = TEXT_MODEL,
+    endpoints = parse_endpoints(st.session_state.base_url, st.session_state.api_key)
+    text_model = build_chat_model(
+        TEXT_MODEL,
+        endpoints,
         temperature=0.2,
         top_p = 0.75,
+        include_response_headers=True,
     )
-    multimodal_model = ChatOpenAI(
-        api_key=st.session_state.api_key,
-        base_url=st.session_state.base_url,
-        model = MULTIMODAL_MODEL,
+    multimodal_model = build_chat_model(
+        MULTIMODAL_MODEL,
+        endpoints,
         temperature=0.2,
         top_p = 0.75,
+        include_response_headers=True,
     )
     model = HTPModel(
         text_model=text_model,
         multimodal_model=multimodal_model,
         language=st.session_state['language_code'],
-        use_cache=True
+        use_cache=True,
+        # 中断后重新上传同一批图片，可从各图片最后完成的阶段继续
+        checkpoints=get_checkpoint_store()
+    )
+    runner = BatchRunner(
+        model,
+        language=st.session_state['language_code'],
+        concurrency=st.session_state.get('concurrency', 8),
+        retries=st.session_state.get('retries', 2),
+        priority=Priority.BATCH,
     )
-    progress_bar = st.progress(0, text=f"Progressing: 0/{len(uploaded_files)}")
-    start_time = time.time()
+    # 模型和连接池在各批次之间共享，首次运行时按并发数预先建立连接
+    prewarm_endpoints(endpoints, connections=runner.concurrency)
+    store.clear_results()
+    total = len(store.uploads)
+    progress_bar = st.progress(0, text=f"Progressing: 0/{total}")
+    table_placeholder = st.empty()
     success = 0
-    for i, uploaded_file in enumerate(uploaded_files):
-        try:
-            image = Image.open(uploaded_file)
-            image_data = pil_to_base64(image)
-            
-            response = model.workflow(image_path=image_data, language=st.session_state['language_code'])
-            results.append({
-                "file_name": uploaded_file.name,
-                "analysis_result": response,
-                "success": True,
-                "image": image
-            })
+
+    def items():
+        # 按需从磁盘读取，同时在途的图片数量由 BatchRunner 限制
+        for upload in store.iter_uploads():
+            yield upload.file_name, upload.read(), upload
+
+    # 结果按完成顺序返回，逐条写入压缩包并刷新表格和进度
+    for outcome in runner.run(items()):
+        upload = outcome.extra
+        writer.add(outcome.name, upload.read(), outcome.result, outcome.success)
+        store.add_result(upload, outcome.result, outcome.success, outcome.error, outcome.attempts, outcome.duration)
+        if outcome.success:
             success += 1
-        except Exception as e:
-            results.append({
-                "file_name": uploaded_file.name,
-                "analysis_result": str(e),
-                "success": False,
-                "image": image
-            })
-        
-        elapsed_time = time.time() - start_time
-        progress = (i + 1) / len(uploaded_files)
-        estimated_total_time = elapsed_time / progress if progress > 0 else 0
-        remaining_time = estimated_total_time - elapsed_time
-        
-        elapsed_str = time.strftime("%H:%M:%S", time.gmtime(elapsed_time))
-        remaining_str = time.strftime("%H:%M:%S", time.gmtime(remaining_time))
-        
-        progress_bar.progress(progress, text=f"Progressing: {i + 1}/{len(uploaded_files)} | Elapsed: {elapsed_str} | Remaining: {remaining_str}")
+        table_placeholder.dataframe(result_rows(store), use_container_width=True)
+
+        meter = runner.meter
+        eta = meter.eta(total - meter.completed)
+        elapsed_str = time.strftime("%H:%M:%S", time.gmtime(meter.elapsed))
+        remaining_str = time.strftime("%H:%M:%S", time.gmtime(eta)) if eta is not None else "--:--:--"
+        rate_str = f"{meter.rate * 60:.1f}/min" if meter.rate else "-"
+        progress_bar.progress(
+            meter.completed / total,
+            text=f"Progressing: {meter.completed}/{total} | Elapsed: {elapsed_str} | Remaining: {remaining_str} | Throughput: {rate_str}"
+        )
     
-    st.success(get_text("batch_results").format(success, len(uploaded_files) - success))
+    st.success(get_text("batch_results").format(success, total - success))
     
-    return results, success
+    return success
+
+def result_rows(store: BatchStore):
+    return [
+        {
+            get_text("column_file"): record.file_name,
+            get_text("column_status"): "✅" if record.success else "❌",
+            get_text("column_classification"): record.classification,
+            get_text("column_attempts"): record.attempts,
+            get_text("column_seconds"): round(record.duration, 1),
+        }
+        for record in store.records
+    ]
 
 def sidebar() -> None: 
     """Render sidebar components."""
@@ -265,8 +242,10 @@ def sidebar() -> None:
         st.rerun()
     # Model Settings
     st.sidebar.markdown(f"## {get_text('model_settings')}")
-    st.session_state.base_url = st.sidebar.text_input("API Base URL", value=st.session_state.get('base_url', ''), key="base_url_input")
-    st.session_state.api_key = st.sidebar.text_input("API Key", value=st.session_state.get('api_key', ''), type="password", key="api_key_input")
+    st.session_state.base_url = st.sidebar.text_input("API Base URL", value=st.session_state.get('base_url', ''), key="base_url_input", help="Separate several base URLs with commas")
+    st.session_state.api_key = st.sidebar.text_input("API Key", value=st.session_state.get('api_key', ''), type="password", key="api_key_input", help="Separate several keys with commas")
+    st.session_state.concurrency = st.sidebar.number_input(get_text("concurrency_label"), min_value=1, max_value=32, value=st.session_state.get('concurrency', 8), step=1)
+    st.session_state.retries = st.sidebar.number_input(get_text("retries_label"), min_value=0, max_value=5, value=st.session_state.get('retries', 2), step=1)
     
     # Buttons
     st.sidebar.markdown("---")
@@ -303,22 +282,29 @@ def main():
     
     uploaded_files = st.file_uploader(get_text("upload_images"), accept_multiple_files=True, type=['png', 'jpg', 'jpeg'], key="file_uploader")
     status_placeholder = st.empty()
-    if uploaded_files:
-        cached_files = get_uploaded_files()
-        cached_files.extend(uploaded_files)
-        status_placeholder.success(get_text("images_uploaded").format(len(cached_files)))
+    store = get_batch_store()
+    store.sync_uploads([uploaded_file.file_id for uploaded_file in uploaded_files or []])
+    rejected = [
+        uploaded_file.name for uploaded_file in uploaded_files or []
+        if uploaded_file.file_id not in store.uploads
+        and store.add_upload(uploaded_file.file_id, uploaded_file.name, uploaded_file.getvalue()) is None
+    ]
+    if store.uploads:
+        status_placeholder.success(get_text("images_uploaded").format(len(store.uploads)))
+    if rejected:
+        st.warning(get_text("upload_buffer_full").format(len(rejected)))
         
     if st.session_state.get('start_analysis'):
     # if st.sidebar.button(get_text("start_batch_analysis"), type="primary"):
         if not st.session_state.api_key:
             st.error(get_text("error_no_api_key"))
-        elif uploaded_files:
-            results, success = batch_analyze(uploaded_files=uploaded_files)
+        elif store.uploads:
+            writer = ReportZipWriter(disclaimer=get_text("ai_disclaimer"))
+            batch_analyze(store=store, writer=writer)
             
-            zip_content = save_results(results)
             st.download_button(
                 label = get_text("download_batch_results"),
-                data=zip_content,
+                data=writer.getvalue(),
                 file_name="batch_analysis_results.zip",
                 mime="application/zip"
             )
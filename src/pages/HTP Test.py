@@ -1,13 +1,12 @@
-import base64
 import os
 from io import BytesIO
 
 import requests
 import streamlit as st
-from langchain_openai import ChatOpenAI
 from PIL import Image
 
-from model_langchain import HTPModel
+from endpoint_pool import build_chat_model, parse_endpoints, prewarm_endpoints
+from model_langchain import HTPModel, ImageInput
 
 # Constants
 BASE_URL = "https://api.openai.com/v1"
@@ -126,12 +125,6 @@ def get_text(key):
     return LANGUAGES[st.session_state['language_code']][key]
 
 # Helper functions
-def pil_to_base64(image: Image.Image, format: str = "JPEG") -> str:
-    """Convert PIL image to base64 string."""
-    buffered = BytesIO()
-    image.save(buffered, format=format)
-    return base64.b64encode(buffered.getvalue()).decode('utf-8')
-    
 def resize_image(image: Image.Image, max_size: tuple = MAX_IMAGE_SIZE) -> Image.Image:
     """Resize image if it exceeds max_size."""
     if image.size[0] > max_size[0] or image.size[1] > max_size[1]:
@@ -149,10 +142,20 @@ def analyze_image(model) -> None:
         "language": st.session_state['language_code']
     }
 
+    # final/signal 阶段边生成边显示，不必等整个流程结束
+    stream_placeholder = st.empty()
+    streamed = {}
+
+    def on_token(stage: str, token: str) -> None:
+        streamed[stage] = streamed.get(stage, "") + token
+        text = streamed[stage].replace("<output>", "").replace("</output>", "")
+        stream_placeholder.markdown(text)
+
     try:
         with st.spinner(get_text("analyzing_image")):
-            response = model.workflow(**inputs)
+            response = model.workflow(**inputs, on_token=on_token)
             st.session_state['analysis_result'] = response
+        stream_placeholder.empty()
     except requests.RequestException as e:
         st.error(f"{get_text('error_analysis')}{str(e)}")
 
@@ -194,12 +197,11 @@ def sidebar(model) -> None:
         col = col1 if idx % 2 == 0 else col2
         with col:
             if st.button(get_text("load_sample").format(idx+1), key=f"load_sample_{idx}"):
-                with open(sample_path, "rb") as f:
-                    image = Image.open(f)
-                    image = resize_image(image)
-                    st.session_state['image_data'] = pil_to_base64(image)
-                    st.session_state['image_display'] = image
-                    st.session_state['current_sample'] = sample_name
+                image_data = ImageInput.resolve(sample_path)
+                image = resize_image(Image.open(BytesIO(image_data.data)))
+                st.session_state['image_data'] = image_data
+                st.session_state['image_display'] = image
+                st.session_state['current_sample'] = sample_name
 
     st.sidebar.markdown(f"## {get_text('analysis_settings')}")
     # Language Selection
@@ -222,14 +224,14 @@ def sidebar(model) -> None:
         help=get_text("upload_drawing")
     )
     if uploaded_file:
-        image = Image.open(uploaded_file)
-        image = resize_image(image)
-        st.session_state['image_data'] = pil_to_base64(image)
+        image_data = ImageInput.resolve(uploaded_file.getvalue())
+        image = resize_image(Image.open(BytesIO(image_data.data)))
+        st.session_state['image_data'] = image_data
         st.session_state['image_display'] = image  # For displaying in main content
     
     st.sidebar.markdown(f"## {get_text('model_settings')}")
-    base_url = st.sidebar.text_input("API Base URL", value=BASE_URL, help="Base URL of the API server")
-    api_key = st.sidebar.text_input("API Key", help="API Key for authentication", type="password")
+    base_url = st.sidebar.text_input("API Base URL", value=BASE_URL, help="Base URL of the API server, separate several with commas")
+    api_key = st.sidebar.text_input("API Key", help="API Key for authentication, separate several with commas", type="password")
     st.session_state.api_key = api_key
     st.session_state.base_url = base_url
     
@@ -304,25 +306,28 @@ def main() -> None:
     MULTIMODAL_MODEL = "gpt-4o-2024-08-06"
     TEXT_MODEL = "claude-3-5-sonnet-20240620"
     
-    text_model = ChatOpenAI(
-        api_key=st.session_state.api_key,
-        base_url=st.session_state.base_url,
-        model=TEXT_MODEL,
+    endpoints = parse_endpoints(st.session_state.base_url, st.session_state.api_key)
+    text_model = build_chat_model(
+        TEXT_MODEL,
+        endpoints,
         temperature=0.2,
         top_p=0.75,
+        include_response_headers=True,
     )
-    multimodal_model = ChatOpenAI(
-        api_key=st.session_state.api_key,
-        base_url=st.session_state.base_url,
-        model=MULTIMODAL_MODEL,
+    multimodal_model = build_chat_model(
+        MULTIMODAL_MODEL,
+        endpoints,
         temperature=0.2,
         top_p=0.75,
+        include_response_headers=True,
     )
     model = HTPModel(
         text_model=text_model,
         multimodal_model=multimodal_model,
         use_cache=True,
     )
+    # 模型和连接池在各次 rerun 之间共享，用户选择图片时在后台建立连接
+    prewarm_endpoints(endpoints, background=True)
 
     sidebar(model)
     main_content()
@@ -0,0 +1,105 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+from typing import Callable, Dict, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 提示词目录相对于本文件解析，不依赖启动时的工作目录
+PROMPT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "prompt")
+
+
+class PromptRegistry(object):
+    """Loads `prompt/{language}/{name}.txt` once and keeps compiled templates.
+
+    Files are re-read only when their mtime changes, and mtimes are checked at
+    most once per `check_interval` seconds, so steady-state lookups do no I/O.
+    """
+    def __init__(self, root: str = PROMPT_DIR, check_interval: float = 2.0):
+        self.root = root
+        self.check_interval = check_interval
+        self._lock = threading.RLock()
+        # (language, name) -> (mtime, text)
+        self._texts: Dict[Tuple[str, str], Tuple[float, str]] = {}
+        # (language, key) -> (mtimes, template)
+        self._templates: Dict[Tuple[str, str], Tuple[tuple, object]] = {}
+        self._checked: Dict[Tuple[str, str], float] = {}
+        self._digests: Dict[tuple, Tuple[float, str]] = {}
+
+    def path(self, language: str, name: str) -> str:
+        return os.path.join(self.root, language, f"{name}.txt")
+
+    def _load(self, language: str, name: str) -> Tuple[float, str]:
+        key = (language, name)
+        now = time.monotonic()
+        cached = self._texts.get(key)
+        if cached is not None and now - self._checked.get(key, 0.0) < self.check_interval:
+            return cached
+        path = self.path(language, name)
+        mtime = os.stat(path).st_mtime
+        self._checked[key] = now
+        if cached is not None and cached[0] == mtime:
+            return cached
+        with open(path, "r", encoding="utf-8") as f:
+            text = f.read()
+        if cached is not None:
+            logger.info(f"Prompt {language}/{name} reloaded.")
+        self._texts[key] = (mtime, text)
+        return self._texts[key]
+
+    def text(self, language: str, name: str) -> str:
+        with self._lock:
+            return self._load(language, name)[1]
+
+    def template(self, language: str, key: str, names: Sequence[str], build: Callable[..., object]):
+        """Return the template built by `build(*texts)`, rebuilt only when a source file changed."""
+        with self._lock:
+            loaded = [self._load(language, name) for name in names]
+            mtimes = tuple(mtime for mtime, _ in loaded)
+            cached = self._templates.get((language, key))
+            if cached is not None and cached[0] == mtimes:
+                return cached[1]
+            template = build(*[text for _, text in loaded])
+            self._templates[(language, key)] = (mtimes, template)
+            return template
+
+    def names(self, language: str):
+        directory = os.path.join(self.root, language)
+        return sorted(f[:-4] for f in os.listdir(directory) if f.endswith(".txt"))
+
+    def preload(self, languages: Sequence[str] = ("zh", "en")):
+        for language in languages:
+            for name in self.names(language):
+                self.text(language, name)
+        logger.info(f"Prompts preloaded from {self.root}.")
+
+    def digest(self, languages: Sequence[str] = ("zh", "en")) -> str:
+        """SHA-256 over every prompt file, identifies the prompt set in use."""
+        with self._lock:
+            key = tuple(languages)
+            now = time.monotonic()
+            cached = self._digests.get(key)
+            if cached is not None and now - cached[0] < self.check_interval:
+                return cached[1]
+            sha = hashlib.sha256()
+            for language in languages:
+                for name in self.names(language):
+                    sha.update(f"{language}/{name}\0".encode("utf-8"))
+                    sha.update(self.text(language, name).encode("utf-8"))
+            self._digests[key] = (now, sha.hexdigest())
+            return self._digests[key][1]
+
+
+_registry: Optional[PromptRegistry] = None
+_registry_lock = threading.Lock()
+
+
+def get_prompt_registry() -> PromptRegistry:
+    """Return the shared registry, reading from HTP_PROMPT_DIR if set."""
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = PromptRegistry(os.getenv("HTP_PROMPT_DIR") or PROMPT_DIR)
+        return _registry
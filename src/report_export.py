@@ -0,0 +1,59 @@
+import os
+import tempfile
+import zipfile
+from io import BytesIO
+from typing import Optional
+
+from docx import Document
+
+
+def build_report(result: Optional[dict], success: bool, disclaimer: str) -> bytes:
+    """Render one analysis result as a .docx document."""
+    doc = Document()
+    if success:
+        doc.add_paragraph(disclaimer)
+        if result["classification"] is True:
+            doc.add_paragraph(result["signal"])
+            doc.add_paragraph(result["final"])
+        else:
+            doc.add_paragraph(result["fix_signal"])
+    else:
+        doc.add_paragraph("failed")
+    buffer = BytesIO()
+    doc.save(buffer)
+    return buffer.getvalue()
+
+
+class ReportZipWriter(object):
+    """Writes each image and its report into a zip archive as soon as it completes.
+
+    Entries are written from in-memory buffers straight into an unnamed
+    temporary file, so memory use does not grow with the batch and nothing
+    is staged in a directory tree. The layout matches the old export:
+    `<name>/<file_name>` and `<name>/<name>.docx` per image, plus `failed.txt`.
+    """
+    def __init__(self, disclaimer: str = "", fileobj=None):
+        self.disclaimer = disclaimer
+        self.file = fileobj if fileobj is not None else tempfile.TemporaryFile()
+        self.zip = zipfile.ZipFile(self.file, "w")
+        self.failed = []
+        self.count = 0
+
+    def add(self, file_name: str, image: Optional[bytes], result: Optional[dict], success: bool):
+        name = os.path.splitext(file_name)[0]
+        if image:
+            self.zip.writestr(f"{name}/{file_name}", image)
+        self.zip.writestr(f"{name}/{name}.docx", build_report(result, success, self.disclaimer))
+        if not success:
+            self.failed.append(file_name)
+        self.count += 1
+
+    def close(self):
+        """Finish the archive and return the file object positioned at the start."""
+        self.zip.writestr("failed.txt", "".join(f"{file_name}\n" for file_name in self.failed))
+        self.zip.close()
+        self.file.seek(0)
+        return self.file
+
+    def getvalue(self) -> bytes:
+        return self.close().read()
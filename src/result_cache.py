@@ -0,0 +1,94 @@
+import copy
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+def make_key(*parts) -> str:
+    return hashlib.sha256("\0".join(str(part) for part in parts).encode("utf-8")).hexdigest()
+
+
+class ResultCache(object):
+    """In-memory LRU cache of whole workflow results with a TTL.
+
+    Entries are keyed on the normalized image digest plus everything else
+    that changes the output (language, model ids, prompt set). Aliases map a
+    key derived from the raw upload to the same entry, so an exact re-submit
+    skips image normalization as well.
+    """
+    def __init__(self, max_entries: int = 1024, ttl: Optional[float] = 7 * 24 * 3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # key -> (expires_at, result)
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._aliases: "OrderedDict[str, str]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _resolve(self, key: str) -> str:
+        return self._aliases.get(key, key)
+
+    def get(self, key: str, record: bool = True) -> Optional[dict]:
+        with self._lock:
+            key = self._resolve(key)
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] is not None and entry[0] < time.time():
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                if record:
+                    self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            # 返回副本，调用方修改结果不会污染缓存
+            return copy.deepcopy(entry[1])
+
+    def set(self, key: str, result: dict, alias: Optional[str] = None):
+        expires_at = time.time() + self.ttl if self.ttl else None
+        with self._lock:
+            self._entries[key] = (expires_at, copy.deepcopy(result))
+            self._entries.move_to_end(key)
+            if alias is not None:
+                self._aliases[alias] = key
+                self._aliases.move_to_end(alias)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            while len(self._aliases) > self.max_entries:
+                self._aliases.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._aliases.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+_cache: Optional[ResultCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_result_cache() -> ResultCache:
+    """Return the shared result cache, sized from HTP_RESULT_CACHE_SIZE / HTP_RESULT_CACHE_TTL."""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResultCache(
+                max_entries=int(os.getenv("HTP_RESULT_CACHE_SIZE") or 1024),
+                ttl=float(os.getenv("HTP_RESULT_CACHE_TTL") or 7 * 24 * 3600),
+            )
+        return _cache